@@ -4,7 +4,12 @@ Library providing convenient classes and methods for writing data to files.
 """
 import logging
 import json
+import os
 import pickle
+import struct
+from collections.abc import MutableMapping
+
+import numpy as np
 
 try:
     import yaml
@@ -76,12 +81,350 @@ class PickleSerializer(Serializer):
         return pickle.loads(input_bytes)
 
 
+class BinarySerializer(Serializer):
+    """ Columnar binary serializer for alignments data.
+
+        The file is a header followed by one or more segments. Each segment holds a frame table
+        (face counts and names) and, for every face, a row in contiguous int32 bounding box and
+        landmark arrays and a fixed width hash table. Anything that does not fit these columns
+        (legacy keys, non integer co-ordinates) is held in a JSON blob at the end of the
+        segment.
+
+        Segments are only ever appended, with frames in later segments replacing frames of the
+        same name in earlier segments. A face count of -1 marks a frame as deleted. Files are
+        loaded lazily from a memory map with :func:`load` and saved incrementally with
+        :func:`save` """
+    ext = "fsa"
+    woptions = "wb"
+    roptions = "rb"
+    magic = b"FSA\x00"
+    version = 1
+    file_header = struct.Struct("<4sI")
+    segment_header = struct.Struct("<4sIIIQQ")
+    segment_magic = b"SEG\x00"
+    hash_dtype = np.dtype("S40")
+
+    @classmethod
+    def marshal(cls, input_data):
+        return cls.file_header.pack(cls.magic, cls.version) + cls.segment(input_data.items())
+
+    @classmethod
+    def unmarshal(cls, input_bytes):  # pylint: disable=arguments-differ
+        return dict(LazyAlignments(np.frombuffer(input_bytes, dtype="uint8")))
+
+    @classmethod
+    def load(cls, filename):
+        """ Return the alignments in the given file as a lazily loaded mapping """
+        return LazyAlignments(filename)
+
+    @classmethod
+    def save(cls, filename, data):
+        """ Save the alignments data to the given file. If data was loaded from this file then
+            only the frames that have changed since it was loaded or last saved are appended """
+        if (isinstance(data, LazyAlignments) and data.filename == filename and
+                os.path.isfile(filename)):
+            data.save()
+            return
+        with open(filename, cls.woptions) as out_file:
+            out_file.write(cls.marshal(data))
+        if isinstance(data, LazyAlignments) and data.filename == filename:
+            data.refresh()
+
+    @classmethod
+    def append(cls, filename, frames, deleted=tuple(), size=None):
+        """ Append a segment holding the given (frame name, faces) pairs, and the deleted frame
+            names, to the given file and sync it to disk. The file is created if it does not
+            exist. If size is given, the file is first truncated to that many bytes to discard
+            an incomplete segment """
+        if not os.path.isfile(filename):
+            with open(filename, cls.woptions) as out_file:
+                out_file.write(cls.file_header.pack(cls.magic, cls.version))
+        with open(filename, "r+b") as out_file:
+            if size is not None:
+                out_file.truncate(size)
+            out_file.seek(0, os.SEEK_END)
+            out_file.write(cls.segment(frames, deleted=deleted))
+            out_file.flush()
+            os.fsync(out_file.fileno())
+
+    @classmethod
+    def segment(cls, frames, deleted=tuple()):
+        """ Return a segment holding the given (frame name, faces) pairs, with the frame names
+            in deleted marked as deleted """
+        frames = list(frames)
+        faces = [face for _, frame_faces in frames for face in frame_faces]
+        points = [cls.columnar_landmarks(face) for face in faces]
+        n_points = next((len(pts) for pts in points if pts is not None), 0)
+
+        counts = np.array([-1] * len(deleted) + [len(frame_faces) for _, frame_faces in frames],
+                          dtype="<i4")
+        names = [name.encode("utf-8") for name in deleted] + [name.encode("utf-8")
+                                                              for name, _ in frames]
+        name_lengths = np.array([len(name) for name in names], dtype="<i4")
+        name_blob = cls.pad(b"".join(names))
+
+        bboxes = np.zeros((len(faces), 4), dtype="<i4")
+        landmarks = np.zeros((len(faces), n_points, 2), dtype="<i4")
+        hashes = np.zeros((len(faces), ), dtype=cls.hash_dtype)
+        flags = np.zeros((len(faces), ), dtype="uint8")
+        extras = dict()
+        for idx, (face, pts) in enumerate(zip(faces, points)):
+            bbox = [face.get(key, None) for key in ("x", "w", "y", "h")]
+            if pts is None or len(pts) != n_points or not all(cls.is_int(val) for val in bbox):
+                extras[str(idx)] = face
+                continue
+            flags[idx] |= 1
+            bboxes[idx] = bbox
+            landmarks[idx] = pts
+            columns = ["x", "w", "y", "h", "landmarksXY"]
+            if "hash" in face and cls.is_hash(face["hash"]):
+                columns.append("hash")
+                flags[idx] |= 2
+                hashes[idx] = (face["hash"] or "").encode("ascii")
+            extra = {key: val for key, val in face.items() if key not in columns}
+            if extra:
+                extras[str(idx)] = extra
+        extras = cls.pad(json.dumps(extras).encode("utf-8") if extras else b"")
+
+        header = cls.segment_header.pack(cls.segment_magic, n_points, len(names), len(faces),
+                                         len(name_blob), len(extras))
+        return b"".join([header,
+                         cls.pad(counts.tobytes() + name_lengths.tobytes()),
+                         name_blob,
+                         bboxes.tobytes(),
+                         landmarks.tobytes(),
+                         cls.pad(hashes.tobytes() + flags.tobytes()),
+                         extras])
+
+    @staticmethod
+    def is_int(value):
+        """ Return whether the given value can be stored in an int32 column """
+        return isinstance(value, (int, np.integer)) and not isinstance(value, bool)
+
+    @classmethod
+    def is_hash(cls, value):
+        """ Return whether the given value can be stored in the hash column """
+        if value is None:
+            return True
+        return (isinstance(value, str) and 0 < len(value) <= cls.hash_dtype.itemsize and
+                all(ord(char) < 128 for char in value))
+
+    @classmethod
+    def columnar_landmarks(cls, face):
+        """ Return the face's landmarks as an int32 array, or None if they cannot be held in
+            the landmarks column without loss """
+        landmarks = face.get("landmarksXY", None)
+        if landmarks is None:
+            return None
+        try:
+            retval = np.array(landmarks)
+        except ValueError:
+            return None
+        if retval.ndim != 2 or retval.shape[1] != 2 or retval.dtype.kind not in ("i", "u"):
+            return None
+        return retval
+
+    @staticmethod
+    def pad(buffer):
+        """ Pad a buffer with null bytes to a multiple of 8 bytes """
+        return buffer + b"\x00" * (-len(buffer) % 8)
+
+
+class LazyAlignments(MutableMapping):
+    """ Alignments data held in a binary alignments file.
+
+        Behaves as the frame name to faces dictionary used for other alignments formats. Frame
+        records are only built from the memory mapped file when they are first requested, and
+        are held once built so that they can be edited in place. Frames which have been
+        edited, added or deleted since loading are written back as a new segment by
+        :func:`save`.
+
+        filename:   The file to map, or a buffer of uint8 to read from """
+    def __init__(self, filename):
+        logger.debug("Initializing %s: (filename: '%s')", self.__class__.__name__,
+                     filename if isinstance(filename, str) else type(filename))
+        self.filename = filename if isinstance(filename, str) else None
+        self._buffer = None if self.filename else filename
+        self._segments = list()
+        self._keys = dict()  # Frame name to (segment, row), or None if not yet saved
+        self._frames = dict()  # Frame records that have been built, added or edited
+        self._deleted = set()
+        self._rows = 0  # Number of frame rows held across all segments
+        self._size = 0  # Size of the complete segments held in the file
+        self.refresh()
+        logger.debug("Initialized %s: (frames: %s, segments: %s)", self.__class__.__name__,
+                     len(self._keys), len(self._segments))
+
+    def __getitem__(self, key):
+        if key in self._frames:
+            return self._frames[key]
+        location = self._keys[key]
+        retval = self._frames[key] = self._read_frame(*location)
+        return retval
+
+    def __setitem__(self, key, value):
+        self._frames[key] = value
+        if key not in self._keys:
+            self._keys[key] = None
+
+    def __delitem__(self, key):
+        location = self._keys.pop(key)
+        self._frames.pop(key, None)
+        if location is not None:
+            self._deleted.add(key)
+
+    def __iter__(self):
+        return iter(self._keys)
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __contains__(self, key):
+        return key in self._keys
+
+    def refresh(self):
+        """ Map the file and index its frames. Frames already built are kept, and become the
+            saved state of the data """
+        if self.filename is not None:
+            self.close()
+            self._buffer = np.memmap(self.filename, dtype="uint8", mode="r")
+        magic, version = BinarySerializer.file_header.unpack_from(self._buffer, 0)
+        if magic != BinarySerializer.magic or version > BinarySerializer.version:
+            raise ValueError("'{}' is not a supported binary alignments file".format(
+                self.filename))
+        self._segments = list()
+        self._rows = 0
+        keys = dict()
+        offset = BinarySerializer.file_header.size
+        while offset < len(self._buffer):
+            try:
+                segment, end = self._read_segment(offset)
+            except (struct.error, ValueError) as err:
+                # An append that was interrupted leaves an incomplete segment at the end
+                logger.warning("Ignoring incomplete data at the end of alignments file '%s' "
+                               "(%s bytes)", self.filename, len(self._buffer) - offset)
+                logger.debug("Error reading segment: %s", str(err))
+                break
+            offset = end
+            seg_idx = len(self._segments)
+            self._segments.append(segment)
+            self._rows += len(segment["names"])
+            for row, (name, count) in enumerate(zip(segment["names"], segment["counts"])):
+                if count < 0:
+                    keys.pop(name, None)
+                else:
+                    keys[name] = (seg_idx, row)
+        # Keep the order and content of frames that have been edited or added in memory
+        for key in self._keys:
+            if key not in keys and key in self._frames:
+                keys[key] = None
+        self._keys = keys
+        self._deleted = set()
+        self._size = offset
+
+    def close(self):
+        """ Release the memory map of the file, so that it can be written to """
+        if self.filename is None:
+            return
+        self._segments = list()
+        self._buffer = None
+
+    def _read_segment(self, offset):
+        """ Return the arrays of the segment at the given offset and the offset of the next
+            segment """
+        buffer = self._buffer
+        (magic, n_points, n_frames, n_faces,
+         names_len, extras_len) = BinarySerializer.segment_header.unpack_from(buffer, offset)
+        if magic != BinarySerializer.segment_magic:
+            raise ValueError("Corrupt binary alignments file: '{}'".format(self.filename))
+        offset += BinarySerializer.segment_header.size
+
+        def take(dtype, shape, align=False):
+            """ View the next block of the buffer as an array """
+            nonlocal offset
+            dtype = np.dtype(dtype)
+            size = int(np.prod(shape)) * dtype.itemsize
+            retval = buffer[offset:offset + size].view(dtype).reshape(shape)
+            offset += size
+            if align:
+                offset += -offset % 8
+            return retval
+
+        counts = take("<i4", (n_frames, ))
+        name_lengths = take("<i4", (n_frames, ), align=True)
+        name_blob = take("uint8", (names_len, ), align=True).tobytes()
+        name_ends = np.cumsum(name_lengths)
+        names = [name_blob[end - length:end].decode("utf-8")
+                 for end, length in zip(name_ends.tolist(), name_lengths.tolist())]
+        segment = dict(counts=counts.tolist(),
+                       names=names,
+                       starts=np.concatenate(([0], np.cumsum(np.maximum(counts, 0)))).tolist(),
+                       bboxes=take("<i4", (n_faces, 4)),
+                       landmarks=take("<i4", (n_faces, n_points, 2)),
+                       hashes=take(BinarySerializer.hash_dtype, (n_faces, )),
+                       flags=take("uint8", (n_faces, ), align=True))
+        extras = take("uint8", (extras_len, )).tobytes().rstrip(b"\x00")
+        segment["extras"] = json.loads(extras.decode("utf-8")) if extras else dict()
+        return segment, offset
+
+    def _read_frame(self, seg_idx, row):
+        """ Build the list of face alignments for a frame from its segment """
+        segment = self._segments[seg_idx]
+        retval = list()
+        for idx in range(segment["starts"][row], segment["starts"][row + 1]):
+            flags = int(segment["flags"][idx])
+            extra = segment["extras"].get(str(idx), dict())
+            if not flags & 1:
+                retval.append(dict(extra))
+                continue
+            x, w, y, h = segment["bboxes"][idx].tolist()
+            face = dict(x=x, w=w, y=y, h=h, landmarksXY=segment["landmarks"][idx].tolist())
+            if flags & 2:
+                face["hash"] = segment["hashes"][idx].decode("ascii") or None
+            face.update(extra)
+            retval.append(face)
+        return retval
+
+    def changes(self):
+        """ Return the frames which have been added or edited, and the names of frames which
+            have been deleted, since the data was loaded or last saved """
+        updated = [(key, faces) for key, faces in self._frames.items()
+                   if self._keys[key] is None or faces != self._read_frame(*self._keys[key])]
+        deleted = [key for key in self._deleted if key not in self._keys]
+        return updated, deleted
+
+    def save(self):
+        """ Append the changes to the mapped file as a new segment. The file is rewritten in
+            full instead once more than half of its frame rows have been replaced """
+        updated, deleted = self.changes()
+        if not updated and not deleted:
+            logger.debug("No alignments changes to save")
+            return
+        if self._rows + len(updated) + len(deleted) > 2 * max(len(self._keys), 1):
+            logger.debug("Compacting alignments file: (rows: %s, frames: %s)",
+                         self._rows, len(self._keys))
+            data = dict(self.items())
+            self.close()
+            tmp_file = "{}.tmp".format(self.filename)
+            with open(tmp_file, BinarySerializer.woptions) as out_file:
+                out_file.write(BinarySerializer.marshal(data))
+            os.replace(tmp_file, self.filename)
+        else:
+            logger.debug("Appending alignments: (updated: %s, deleted: %s)",
+                         len(updated), len(deleted))
+            self.close()
+            BinarySerializer.append(self.filename, updated, deleted=deleted, size=self._size)
+        self.refresh()
+
+
 def get_serializer(serializer):
     """ Return requested serializer """
     if serializer == "json":
         return JSONSerializer
     if serializer == "pickle":
         return PickleSerializer
+    if serializer == "binary":
+        return BinarySerializer
     if serializer == "yaml" and yaml is not None:
         return YAMLSerializer
     if serializer == "yaml" and yaml is None:
@@ -96,6 +439,8 @@ def get_serializer_from_ext(ext):
         return JSONSerializer
     if ext == ".p":
         return PickleSerializer
+    if ext == ".fsa":
+        return BinarySerializer
     if ext in (".yaml", ".yml") and yaml is not None:
         return YAMLSerializer
     if ext in (".yaml", ".yml") and yaml is None:
@@ -23,8 +23,8 @@ class Alignments():
                     decide the serializer, and the serializer argument will
                     be ignored.
         serializer: If provided, this will be the format that the data is
-                    saved in (if data is to be saved). Can be 'json', 'pickle'
-                    or 'yaml'
+                    saved in (if data is to be saved). Can be 'json', 'pickle',
+                    'yaml' or 'binary'
     """
     # pylint: disable=too-many-public-methods
     def __init__(self, folder, filename="alignments", serializer="json"):
@@ -83,12 +83,12 @@ class Alignments():
         logger.debug("Getting serializer: (filename: '%s', serializer: '%s')",
                      filename, serializer)
         extension = os.path.splitext(filename)[1]
-        if extension in (".json", ".p", ".yaml", ".yml"):
+        if extension in (".json", ".p", ".yaml", ".yml", ".fsa"):
             logger.debug("Serializer set from file extension: '%s'", extension)
             retval = Serializer.get_serializer_from_ext(extension)
-        elif serializer not in ("json", "pickle", "yaml"):
+        elif serializer not in ("json", "pickle", "yaml", "binary"):
             raise ValueError("Error: {} is not a valid serializer. Use "
-                             "'json', 'pickle' or 'yaml'")
+                             "'json', 'pickle', 'yaml' or 'binary'")
         else:
             logger.debug("Serializer set from argument: '%s'", serializer)
             retval = Serializer.get_serializer(serializer)
@@ -99,7 +99,7 @@ class Alignments():
         """ Return the path to alignments file """
         logger.debug("Getting location: (folder: '%s', filename: '%s')", folder, filename)
         extension = os.path.splitext(filename)[1]
-        if extension in (".json", ".p", ".yaml", ".yml"):
+        if extension in (".json", ".p", ".yaml", ".yml", ".fsa"):
             logger.debug("File extension set from filename: '%s'", extension)
             location = os.path.join(str(folder), filename)
         else:
@@ -122,14 +122,21 @@ class Alignments():
 
         try:
             logger.info("Reading alignments from: '%s'", self.file)
-            with open(self.file, self.serializer.roptions) as align:
-                data = self.serializer.unmarshal(align.read())
+            data = self.read_file()
         except IOError as err:
             logger.error("'%s' not read: %s", self.file, err.strerror)
             exit(1)
         logger.debug("Loaded alignments")
         return data
 
+    def read_file(self):
+        """ Read and deserialize the alignments file. Binary alignments are mapped
+            lazily rather than read in full """
+        if hasattr(self.serializer, "load"):
+            return self.serializer.load(self.file)
+        with open(self.file, self.serializer.roptions) as align:
+            return self.serializer.unmarshal(align.read())
+
     def reload(self):
         """ Read the alignments data from the correct format """
         logger.debug("Re-loading alignments")
@@ -137,15 +144,21 @@ class Alignments():
         logger.debug("Re-loaded alignments")
 
     def save(self):
-        """ Write the serialized alignments file """
+        """ Write the serialized alignments file. Returns whether the file was written """
         logger.debug("Saving alignments")
         try:
             logger.info("Writing alignments to: '%s'", self.file)
-            with open(self.file, self.serializer.woptions) as align:
-                align.write(self.serializer.marshal(self.data))
+            if hasattr(self.serializer, "save"):
+                self.serializer.save(self.file, self.data)
+            else:
+                data = self.data if isinstance(self.data, dict) else dict(self.data)
+                with open(self.file, self.serializer.woptions) as align:
+                    align.write(self.serializer.marshal(data))
             logger.debug("Saved alignments")
         except IOError as err:
             logger.error("'%s' not written: %s", self.file, err.strerror)
+            return False
+        return True
 
     def backup(self):
         """ Backup copy of old alignments """
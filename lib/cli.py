@@ -496,6 +496,30 @@ class ExtractConvertArgs(FaceSwapArgs):
                               "group": "Data",
                               "help": "Optional path to an alignments file. Leave blank if the "
                                       "alignments file is at the default location."})
+        argument_list.append({"opts": ("-lt", "--load-threads"),
+                              "type": int,
+                              "action": Slider,
+                              "dest": "load_threads",
+                              "min_max": (0, 32),
+                              "rounding": 1,
+                              "default": 0,
+                              "group": "settings",
+                              "help": "The number of threads to use for decoding frames when the "
+                                      "input is a folder of images. Frames are still processed "
+                                      "in order. Setting this to 0 will use the number of cpus "
+                                      "available, up to a maximum of 8."})
+        argument_list.append({"opts": ("-pf", "--prefetch"),
+                              "type": int,
+                              "action": Slider,
+                              "dest": "prefetch",
+                              "min_max": (1, 256),
+                              "rounding": 1,
+                              "default": 32,
+                              "group": "settings",
+                              "help": "The maximum number of frames to decode ahead of the frame "
+                                      "currently being processed when the input is a folder of "
+                                      "images. Higher values keep the decoding threads busy for "
+                                      "longer, at the cost of holding more frames in RAM."})
         return argument_list
 
 
@@ -514,11 +538,13 @@ class ExtractArgs(ExtractConvertArgs):
                               "type": str.lower,
                               "dest": "serializer",
                               "default": "json",
-                              "choices": ("json", "pickle", "yaml"),
+                              "choices": ("json", "pickle", "yaml", "binary"),
                               "group": "Data",
                               "help": "Serializer for alignments file. If yaml is chosen and not "
                                       "available, then json will be used as the default "
-                                      "fallback."})
+                                      "fallback. Binary is a compact format which loads "
+                                      "quickly and only writes changes when saving, for large "
+                                      "alignments files."})
         s3fd = "s3fd"
         fan = "fan"
         if backend == "cpu":
@@ -682,13 +708,18 @@ class ExtractArgs(ExtractConvertArgs):
                               "rounding": 10,
                               "default": 0,
                               "group": "output",
-                              "help": "Automatically save the alignments file after a set amount "
-                                      "of frames. By default the alignments file is only saved at "
-                                      "the end of the extraction process. NB: If extracting in 2 "
-                                      "passes then the alignments file will only start to be "
-                                      "saved out during the second pass. WARNING: Don't interrupt "
-                                      "the script when writing the file because it might get "
-                                      "corrupted. Set to 0 to turn off"})
+                              "help": "Automatically save the alignments extracted so far after "
+                                      "a set amount of frames. By default the alignments file is "
+                                      "only saved at the end of the extraction process. The new "
+                                      "frames are appended to a journal beside the alignments "
+                                      "file, which is merged into the alignments file at the end "
+                                      "of the extraction process. An existing alignments file "
+                                      "that is being replaced is backed up when the journal is "
+                                      "started. If extraction is interrupted, run again with "
+                                      "'skip-existing' to recover the journaled frames and "
+                                      "continue. NB: If extracting in 2 passes then "
+                                      "the alignments will only start to be saved out during the "
+                                      "second pass. Set to 0 to turn off"})
         argument_list.append({"opts": ("-dl", "--debug-landmarks"),
                               "action": "store_true",
                               "dest": "debug_landmarks",
@@ -710,6 +741,21 @@ class ExtractArgs(ExtractConvertArgs):
                               "help": "Don't run extraction in parallel. Will run detection first "
                                       "then alignment (2 passes). Useful if VRAM is at a "
                                       "premium."})
+        argument_list.append({"opts": ("-fc", "--frame-cache"),
+                              "type": int,
+                              "action": Slider,
+                              "dest": "frame_cache",
+                              "min_max": (0, 16384),
+                              "rounding": 256,
+                              "default": 1024,
+                              "group": "settings",
+                              "help": "The amount of RAM, in megabytes, to use for holding the "
+                                      "regions of each frame around its detected faces between "
+                                      "the detection and alignment passes when extraction runs "
+                                      "in 2 passes. Regions that do not fit in RAM are held in a "
+                                      "temporary file on disk, so frames do not need to be "
+                                      "loaded from the source again for the alignment pass. "
+                                      "Set to 0 to disable the cache and reload every frame."})
         argument_list.append({"opts": ("-s", "--skip-existing"),
                               "action": "store_true",
                               "dest": "skip_existing",
@@ -72,10 +72,13 @@ class Converter():
                 disable_logging=disable_logging)(configfile=self.configfile, config=config)
         logger.debug("Loaded plugins: %s", self.adjustments)
 
-    def process(self, in_queue, out_queue, completion_queue=None):
-        """ Process items from the queue """
+    def process(self, in_queue, out_queue, completion_queue=None, frame_pool=None):
+        """ Process items from the queue
+
+            If a frame pool is passed in, frames are viewed from, and patched frames returned
+            to, shared memory """
         logger.debug("Starting convert process. (in_queue: %s, out_queue: %s, completion_queue: "
-                     "%s)", in_queue, out_queue, completion_queue)
+                     "%s, frame_pool: %s)", in_queue, out_queue, completion_queue, frame_pool)
         while True:
             items = in_queue.get()
             if items == "EOF":
@@ -88,6 +91,8 @@ class Converter():
 
             for item in items:
                 logger.trace("Patch queue got: '%s'", item["filename"])
+                if frame_pool is not None:
+                    frame_pool.get_frame(item)
                 try:
                     image = self.patch_image(item)
                 except Exception as err:  # pylint: disable=broad-except
@@ -102,15 +107,45 @@ class Converter():
                     # traceback.print_exception(*exc_info)
 
                 logger.trace("Out queue put: %s", item["filename"])
-                out_queue.put((item["filename"], image))
+                out_queue.put(self.get_out_item(item, image, frame_pool))
         logger.debug("Completed convert process")
         # Signal that this process has finished
         if completion_queue is not None:
             completion_queue.put(1)
 
+    @staticmethod
+    def get_out_item(item, image, frame_pool):
+        """ Return the patched image for the out queue.
+
+            Without a frame pool this is a (filename, image) tuple. With a frame pool it is a
+            frame pool item. Frames patched in place keep their shared memory slot, otherwise
+            the source frame's slot is released and the new image is moved into the pool """
+        if frame_pool is None:
+            return item["filename"], image
+        out_item = dict(filename=item["filename"], image=image)
+        if image is item["image"] and item.get("frame_slot") is not None:
+            out_item["frame_slot"] = item["frame_slot"]
+        else:
+            frame_pool.release(item)
+        return frame_pool.put_frame(out_item)
+
     def patch_image(self, predicted):
         """ Patch the image """
         logger.trace("Patching image: '%s'", predicted["filename"])
+        if self.adjustments["scaling"] is not None or self.scale != 1:
+            patched_face = self.patch_frame(predicted)
+        else:
+            patched_face = self.patch_roi(predicted)
+        if self.writer_pre_encode is not None:
+            patched_face = self.writer_pre_encode(patched_face)
+        logger.trace("Patched image: '%s'", predicted["filename"])
+        return patched_face
+
+    def patch_frame(self, predicted):
+        """ Patch the full frame in float32.
+
+            Used when a scaling adjustment or output scale is requested, as these operate on
+            the whole frame """
         frame_size = (predicted["image"].shape[1], predicted["image"].shape[0])
         new_image, background = self.get_new_image(predicted, frame_size)
         patched_face = self.post_warp_adjustments(background, new_image)
@@ -121,9 +156,42 @@ class Converter():
             out=np.empty(patched_face.shape, dtype="uint8"),
             casting='unsafe'
         )
-        if self.writer_pre_encode is not None:
-            patched_face = self.writer_pre_encode(patched_face)
-        logger.trace("Patched image: '%s'", predicted["filename"])
+        return patched_face
+
+    def patch_roi(self, predicted):
+        """ Patch only the regions of the frame that the swapped faces are warped into.
+
+            Each region is composited in float32 exactly as for the full frame, then written
+            back to the uint8 frame in place. Pixels outside of these regions are never
+            touched """
+        frame = predicted["image"]
+        frame_size = (frame.shape[1], frame.shape[0])
+        new_faces = self.get_new_faces(predicted)
+        rois = self.merge_rois([self.get_roi(new_face, detected_face, frame_size)
+                                for new_face, detected_face in new_faces])
+        # Composite all regions prior to writing any, so that the frame is left untouched if
+        # any face fails to convert
+        patches = list()
+        for (left, top, right, bottom), indices in rois:
+            background = frame[top:bottom, left:right] / np.array(255.0, dtype="float32")
+            placeholder = np.zeros(background.shape[:2] + (4, ), dtype="float32")
+            placeholder[:, :, :3] = background
+            self.warp_faces([new_faces[idx] for idx in indices], placeholder, (left, top))
+            np.clip(placeholder, 0.0, 1.0, out=placeholder)
+            patch = self.post_warp_adjustments(background, placeholder)
+            patch *= 255.0
+            patches.append(((left, top, right, bottom), patch))
+
+        if self.draw_transparent:
+            patched_face = np.concatenate((frame, np.zeros(frame.shape[:2] + (1, ),
+                                                           dtype="uint8")), -1)
+        elif not frame.flags.writeable:
+            patched_face = frame.copy()
+        else:
+            patched_face = frame
+        for (left, top, right, bottom), patch in patches:
+            np.rint(patch, out=patched_face[top:bottom, left:right], casting='unsafe')
+        logger.trace("Patched regions: %s", [roi for roi, _ in patches])
         return patched_face
 
     def get_new_image(self, predicted, frame_size):
@@ -135,29 +203,96 @@ class Converter():
         background = predicted["image"] / np.array(255.0, dtype="float32")
         placeholder[:, :, :3] = background
 
+        self.warp_faces(self.get_new_faces(predicted), placeholder)
+
+        np.clip(placeholder, 0.0, 1.0, out=placeholder)
+        logger.trace("Got filename: '%s'. (placeholders: %s)",
+                     predicted["filename"], placeholder.shape)
+
+        return placeholder, background
+
+    def get_new_faces(self, predicted):
+        """ Return the swapped faces with pre-warp adjustments applied, paired with the
+            detected face that each is to be warped back to """
+        new_faces = list()
         for new_face, detected_face in zip(predicted["swapped_faces"],
                                            predicted["detected_faces"]):
             predicted_mask = new_face[:, :, -1] if new_face.shape[2] == 4 else None
             new_face = new_face[:, :, :3]
             src_face = detected_face.reference_face
-            interpolator = detected_face.reference_interpolators[1]
-
             new_face = self.pre_warp_adjustments(src_face, new_face, detected_face, predicted_mask)
+            new_faces.append((new_face, detected_face))
+        return new_faces
+
+    @staticmethod
+    def warp_faces(new_faces, placeholder, offset=None):
+        """ Warp the new faces with their masks onto the placeholder.
 
-            # Warp face with the mask
+            If an offset is given then the placeholder is a region of the frame, with its top
+            left corner at offset (x, y), and the warp matrix is translated to that region """
+        dims = (placeholder.shape[1], placeholder.shape[0])
+        for new_face, detected_face in new_faces:
+            interpolator = detected_face.reference_interpolators[1]
+            matrix = detected_face.reference_matrix
+            if offset is not None:
+                matrix = np.array(matrix, dtype="float64")
+                matrix[:, 2] += matrix[:, :2] @ np.array(offset, dtype="float64")
             cv2.warpAffine(  # pylint: disable=no-member
                 new_face,
-                detected_face.reference_matrix,
-                frame_size,
+                matrix,
+                dims,
                 placeholder,
                 flags=cv2.WARP_INVERSE_MAP | interpolator,  # pylint: disable=no-member
                 borderMode=cv2.BORDER_TRANSPARENT)  # pylint: disable=no-member
 
-        np.clip(placeholder, 0.0, 1.0, out=placeholder)
-        logger.trace("Got filename: '%s'. (placeholders: %s)",
-                     predicted["filename"], placeholder.shape)
+    @staticmethod
+    def get_roi(new_face, detected_face, frame_size):
+        """ Return the (left, top, right, bottom) region of the frame that the new face is
+            warped into, clipped to the frame.
 
-        return placeholder, background
+            This is the face's original_roi, but for the reference face that is patched rather
+            than the aligned face, padded to cover the interpolation kernel at the face's edges """
+        size = new_face.shape[0]
+        matrix = cv2.invertAffineTransform(  # pylint: disable=no-member
+            detected_face.reference_matrix)
+        points = np.array([[-2, -2], [-2, size + 1], [size + 1, size + 1], [size + 1, -2]],
+                          dtype="float32").reshape((-1, 1, 2))
+        points = cv2.transform(points, matrix).squeeze()  # pylint: disable=no-member
+        left, top = np.maximum(np.floor(points.min(axis=0)).astype("int32") - 1, 0)
+        right, bottom = np.minimum(np.ceil(points.max(axis=0)).astype("int32") + 2, frame_size)
+        retval = (int(left), int(top), int(right), int(bottom))
+        logger.trace("Returning: %s", retval)
+        return retval
+
+    @staticmethod
+    def merge_rois(rois):
+        """ Merge overlapping regions so that overlapping faces are composited together, as
+            they would be on a full frame.
+
+            Returns a list of ((left, top, right, bottom), face indices) for each region that
+            lies within the frame """
+        merged = list()
+        for idx, roi in enumerate(rois):
+            if roi[2] <= roi[0] or roi[3] <= roi[1]:
+                logger.trace("Face %s is outside of the frame", idx)
+                continue
+            indices = [idx]
+            overlapping = True
+            while overlapping:
+                overlapping = False
+                for other in merged:
+                    o_roi = other[0]
+                    if (roi[0] < o_roi[2] and o_roi[0] < roi[2] and
+                            roi[1] < o_roi[3] and o_roi[1] < roi[3]):
+                        merged.remove(other)
+                        roi = (min(roi[0], o_roi[0]), min(roi[1], o_roi[1]),
+                               max(roi[2], o_roi[2]), max(roi[3], o_roi[3]))
+                        indices = sorted(other[1] + indices)
+                        overlapping = True
+                        break
+            merged.append((roi, indices))
+        logger.trace("Merged regions: %s", merged)
+        return merged
 
     def pre_warp_adjustments(self, old_face, new_face, detected_face, predicted_mask):
         """ Run the pre-warp adjustments """
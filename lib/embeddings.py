@@ -0,0 +1,105 @@
+#!/usr/bin python3
+""" On disk cache of face embeddings keyed by face hash """
+
+import json
+import logging
+import os
+
+import numpy as np
+
+logger = logging.getLogger(__name__)  # pylint: disable=invalid-name
+
+
+class EmbeddingCache():
+    """ Cache of face embeddings for a model, held in a folder as a float16 .npy file of
+        embeddings and a json index mapping each face's hash to its row in the .npy file.
+
+        The cached embeddings are memory mapped, so only the rows that are requested are read
+        from disk. New embeddings are held in memory until save is called """
+
+    def __init__(self, folder, model_name):
+        logger.debug("Initializing %s: (folder: '%s', model_name: '%s')",
+                     self.__class__.__name__, folder, model_name)
+        self.folder = folder
+        self.model_name = model_name
+        self.index = dict()
+        self.embeddings = None
+        self.new_embeddings = dict()
+        self.load()
+        logger.debug("Initialized %s", self.__class__.__name__)
+
+    @property
+    def embeddings_file(self):
+        """ Return the full path to the .npy embeddings file """
+        return os.path.join(self.folder, ".{}_embeddings.npy".format(self.model_name))
+
+    @property
+    def index_file(self):
+        """ Return the full path to the json index file """
+        return os.path.join(self.folder, ".{}_embeddings.json".format(self.model_name))
+
+    def __len__(self):
+        return len(self.index) + len(self.new_embeddings)
+
+    def __contains__(self, face_hash):
+        return face_hash in self.index or face_hash in self.new_embeddings
+
+    def load(self):
+        """ Load the index and memory map the embeddings if they exist and agree """
+        if not os.path.exists(self.index_file) or not os.path.exists(self.embeddings_file):
+            logger.debug("No embeddings cache found at '%s'", self.folder)
+            return
+        try:
+            with open(self.index_file, "r") as index:
+                index = json.load(index)
+            embeddings = np.load(self.embeddings_file, mmap_mode="r")
+        except (OSError, ValueError) as err:
+            logger.warning("Unable to load embeddings cache '%s'. It will be rebuilt: %s",
+                           self.embeddings_file, str(err))
+            return
+        if index.get("model") != self.model_name or len(index["hashes"]) != len(embeddings):
+            logger.warning("Embeddings cache '%s' does not match its index. It will be rebuilt",
+                           self.embeddings_file)
+            return
+        self.index = {face_hash: row for row, face_hash in enumerate(index["hashes"])}
+        self.embeddings = embeddings
+        logger.verbose("Loaded %s cached %s embeddings", len(self.index), self.model_name)
+
+    def get(self, face_hash):
+        """ Return the float32 embedding for the given face hash """
+        if face_hash in self.new_embeddings:
+            return self.new_embeddings[face_hash].astype("float32")
+        return self.embeddings[self.index[face_hash]].astype("float32")
+
+    def add(self, face_hash, embedding):
+        """ Add an embedding to the cache. It is stored as float16, so the embedding returned
+            from get will differ from the embedding added """
+        self.new_embeddings[face_hash] = np.asarray(embedding, dtype="float16")
+
+    def save(self):
+        """ Write the cache to disk if any embeddings have been added """
+        if not self.new_embeddings:
+            logger.debug("No new embeddings to save")
+            return
+        hashes = [None] * len(self.index)
+        for face_hash, row in self.index.items():
+            hashes[row] = face_hash
+        new_embeddings = np.array(list(self.new_embeddings.values()), dtype="float16")
+        if self.embeddings is not None:
+            new_embeddings = np.concatenate((self.embeddings, new_embeddings))
+        hashes.extend(self.new_embeddings.keys())
+        logger.debug("Saving %s embeddings to '%s'", len(hashes), self.embeddings_file)
+
+        # Write alongside and replace, so an interrupted save leaves the old cache intact
+        tmp_embeddings = self.embeddings_file + ".tmp"
+        with open(tmp_embeddings, "wb") as out_file:
+            np.save(out_file, new_embeddings)
+        tmp_index = self.index_file + ".tmp"
+        with open(tmp_index, "w") as out_file:
+            json.dump({"model": self.model_name, "hashes": hashes}, out_file)
+        self.embeddings = None
+        os.replace(tmp_embeddings, self.embeddings_file)
+        os.replace(tmp_index, self.index_file)
+
+        self.new_embeddings = dict()
+        self.load()
@@ -2,7 +2,9 @@
 """ Face Filterer for extraction in faceswap.py """
 
 import logging
+from hashlib import sha1
 
+from lib.embeddings import EmbeddingCache
 from lib.faces_detect import DetectedFace
 from lib.logger import get_loglevel
 from lib.vgg_face import VGGFace
@@ -22,13 +24,15 @@ class FaceFilter():
         NB: we take only first face, so the reference file should only contain one face. """
 
     def __init__(self, reference_file_paths, nreference_file_paths, detector, aligner, loglevel,
-                 multiprocess=False, threshold=0.4):
+                 multiprocess=False, threshold=0.4, cache_dir=None):
         logger.debug("Initializing %s: (reference_file_paths: %s, nreference_file_paths: %s, "
-                     "detector: %s, aligner: %s. loglevel: %s, multiprocess: %s, threshold: %s)",
+                     "detector: %s, aligner: %s. loglevel: %s, multiprocess: %s, threshold: %s, "
+                     "cache_dir: %s)",
                      self.__class__.__name__, reference_file_paths, nreference_file_paths,
-                     detector, aligner, loglevel, multiprocess, threshold)
+                     detector, aligner, loglevel, multiprocess, threshold, cache_dir)
         self.numeric_loglevel = get_loglevel(loglevel)
         self.vgg_face = VGGFace()
+        self.cache = None if cache_dir is None else EmbeddingCache(cache_dir, "vggface")
         self.filters = self.load_images(reference_file_paths, nreference_file_paths)
         self.align_faces(detector, aligner, loglevel, multiprocess)
         self.get_filter_encodings()
@@ -115,18 +119,47 @@ class FaceFilter():
 
     def get_filter_encodings(self):
         """ Return filter face encodings from Keras VGG Face """
-        for filename, face in self.filters.items():
-            logger.debug("Getting encodings for: '%s'", filename)
-            encodings = self.vgg_face.predict(face["face"])
-            logger.debug("Filter Filename: %s, encoding shape: %s", filename, encodings.shape)
-            face["encoding"] = encodings
+        encodings = self.vgg_face.predict_batch([face["face"] for face in self.filters.values()])
+        for (filename, face), encoding in zip(self.filters.items(), encodings):
+            logger.debug("Filter Filename: %s, encoding shape: %s", filename, encoding.shape)
+            face["encoding"] = encoding
             del face["face"]
 
+    def get_encodings(self, faces):
+        """ Return the encodings for a list of aligned faces. Faces found in the cache are
+            taken from it, and the remainder are run through VGG Face in a single batch """
+        if self.cache is None:
+            return list(self.vgg_face.predict_batch(faces)) if faces else list()
+        hashes = [sha1(face).hexdigest() for face in faces]
+        missing = {face_hash: face for face_hash, face in zip(hashes, faces)
+                   if face_hash not in self.cache}
+        logger.trace("Cached encodings: %s, To encode: %s",
+                     len(faces) - len(missing), len(missing))
+        if missing:
+            encodings = self.vgg_face.predict_batch(list(missing.values()))
+            for face_hash, encoding in zip(missing, encodings):
+                self.cache.add(face_hash, encoding)
+        return [self.cache.get(face_hash) for face_hash in hashes]
+
+    def save_cache(self):
+        """ Save any new encodings to the cache """
+        if self.cache is not None:
+            self.cache.save()
+
     def check(self, detected_face):
         """ Check the extracted Face """
+        return self.check_batch([detected_face])[0]
+
+    def check_batch(self, detected_faces):
+        """ Check a list of extracted faces, encoding them as a single batch. Returns a list of
+            whether each face was accepted """
+        encodings = self.get_encodings([face.aligned_face for face in detected_faces])
+        return [self.check_encoding(encoding) for encoding in encodings]
+
+    def check_encoding(self, encodings):
+        """ Check the encoding of an extracted face against the filters """
         logger.trace("Checking face with FaceFilter")
         distances = {"filter": list(), "nfilter": list()}
-        encodings = self.vgg_face.predict(detected_face.aligned_face)
         for filt in self.filters.values():
             similarity = self.vgg_face.find_cosine_similiarity(filt["encoding"], encodings)
             distances[filt["type"]].append(similarity)
@@ -92,6 +92,7 @@ class FileHandler():
                      "alignments": [("JSON", "*.json"),
                                     ("Pickle", "*.p"),
                                     ("YAML", "*.yaml *.yml"),
+                                    ("Faceswap binary", "*.fsa"),
                                     all_files],
                      "config": [("Faceswap GUI config files", "*.fsw"), all_files],
                      "csv": [("Comma separated values", "*.csv"), all_files],
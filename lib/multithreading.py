@@ -4,9 +4,10 @@
 import logging
 import multiprocessing as mp
 from multiprocessing.sharedctypes import RawArray
-from ctypes import c_float
+from ctypes import c_float, c_uint8
 
 import queue as Queue
+import random
 import sys
 import threading
 import numpy as np
@@ -14,6 +15,7 @@ from lib.logger import LOG_QUEUE, set_root_logger
 
 logger = logging.getLogger(__name__)  # pylint: disable=invalid-name
 _launched_processes = set()  # pylint: disable=invalid-name
+_pool_inherited = dict()  # pylint: disable=invalid-name
 
 
 def total_cpus():
@@ -88,9 +90,13 @@ class FixedProducerDispatcher():
 
     As soon as one worker finishes all worker are shutdown.
 
+    Each worker seeds the python and numpy random number generators with its own seed, and
+    is passed its index and the total number of workers as the keyword arguments
+    `worker_index` and `workers` so that work can be divided between them.
+
     Example:
         # Producer side
-        def do_work(memory_gen):
+        def do_work(memory_gen, worker_index=0, workers=1):
             for memory_wrap in memory_gen:
                 # alternative memory_wrap.get and memory_wrap.ready can be used
                 with memory_wrap as memory:
@@ -141,9 +147,12 @@ class FixedProducerDispatcher():
             'log_queue': LOG_QUEUE,
             'log_level': logger.getEffectiveLevel(),
             'args': args,
-            'kwargs': kwargs
+            'kwargs': kwargs,
+            'workers': workers,
+            'seed': np.random.randint(2 ** 31)
         }
-        self._worker = tuple(self._create_worker(proc_args) for _ in range(workers))
+        self._worker = tuple(self._create_worker(dict(proc_args, worker_index=idx))
+                             for idx in range(workers))
         self._open_worker = len(self._worker)
         logger.debug("Initialized %s", self.__class__.__name__)
 
@@ -249,11 +258,14 @@ class FixedProducerDispatcher():
     def _runner(cls, data=None, stop_event=None, target=None,
                 buffer_tokens=None, result_tokens=None, dtype=None,
                 shapes=None, log_queue=None, log_level=None,
-                args=None, kwargs=None):
+                args=None, kwargs=None, workers=1, worker_index=0, seed=0):
         """ Shared Memory Object runner """
         # Fork inherits the queue handler, so skip registration with "fork"
         set_root_logger(log_level, queue=log_queue)
-        logger.debug("FixedProducerDispatcher worker for %s started", str(target))
+        logger.debug("FixedProducerDispatcher worker %s of %s for %s started (seed: %s)",
+                     worker_index + 1, workers, str(target), seed + worker_index)
+        random.seed(seed + worker_index)
+        np.random.seed(seed + worker_index)
         np_data = [cls._np_from_shared(d, shapes, dtype) for d in data]
 
         def get_free_slot():
@@ -264,6 +276,7 @@ class FixedProducerDispatcher():
                 yield WorkerBuffer(i, np_data[i], stop_event, result_tokens)
 
         args = tuple((get_free_slot(),)) + tuple(args)
+        kwargs = dict(kwargs, worker_index=worker_index, workers=workers)
         try:
             target(*args, **kwargs)
         except Exception as ex:
@@ -273,18 +286,150 @@ class FixedProducerDispatcher():
         logger.debug("FixedProducerDispatcher worker for %s shutdown", str(target))
 
 
+class SharedFramePool():
+    """
+    A pool of fixed size shared memory slots for passing frames between processes.
+
+    The producer copies a frame into a free slot and only the slot id, shape and dtype are
+    sent through the process queues. Consumers view the frame directly from shared memory and
+    the final consumer releases the slot back to the pool. The free slot queue provides
+    backpressure to the producer. If no slot frees up within `timeout` seconds, or a frame is
+    larger than a slot, the frame is sent inline through the queue instead.
+
+    The pool must be created in the parent process and passed to spawned processes as an
+    argument.
+
+    Example:
+        # Producer
+        queue.put(frame_pool.put_frame({"filename": filename, "image": image}))
+
+        # Intermediate consumer
+        item = frame_pool.get_frame(in_queue.get())
+        process(item["image"])
+        out_queue.put(frame_pool.put_frame(item))
+
+        # Final consumer
+        item = frame_pool.get_frame(out_queue.get())
+        save(item["image"])
+        frame_pool.release(item)
+    """
+    def __init__(self, slot_bytes, slots, free_queue, timeout=1):
+        logger.debug("Initializing %s: (slot_bytes: %s, slots: %s, free_queue: %s, "
+                     "timeout: %s)", self.__class__.__name__, slot_bytes, slots, free_queue,
+                     timeout)
+        self._slot_bytes = int(slot_bytes)
+        self._slots = slots
+        self._timeout = timeout
+        self._data = RawArray(c_uint8, self._slot_bytes * slots)
+        self._array = None
+        self._free = free_queue
+        for idx in range(slots):
+            self._free.put(idx)
+        logger.debug("Initialized %s", self.__class__.__name__)
+
+    @property
+    def array(self):
+        """ numpy view of the shared memory, one row per slot """
+        if self._array is None:
+            self._array = np.frombuffer(self._data,
+                                        dtype="uint8").reshape(self._slots, self._slot_bytes)
+        return self._array
+
+    def __getstate__(self):
+        """ Numpy views are rebuilt on first access in the receiving process """
+        state = self.__dict__.copy()
+        state["_array"] = None
+        return state
+
+    def _view(self, slot, shape, dtype):
+        """ Return a numpy array of the given shape and dtype viewing the given slot """
+        dtype = np.dtype(dtype)
+        count = int(np.prod(shape)) * dtype.itemsize
+        return self.array[slot, :count].view(dtype).reshape(shape)
+
+    def _acquire(self):
+        """ Return a free slot id or None if no slot frees up in time """
+        try:
+            slot = self._free.get(timeout=self._timeout)
+        except Queue.Empty:
+            logger.trace("No free frame slots. Sending inline")
+            return None
+        if slot == "EOF":
+            # Queues have been terminated. Leave the sentinel for other producers
+            self._free.put(slot)
+            return None
+        return slot
+
+    def put_frame(self, item):
+        """ Move the item's image into shared memory, ready to be put to a queue.
+
+            Frames which are already in shared memory are not copied again. Items which are not
+            dicts containing a numpy image are returned unchanged """
+        if not isinstance(item, dict) or not isinstance(item.get("image"), np.ndarray):
+            return item
+        if item.get("frame_slot") is not None:
+            item["image"] = None
+            return item
+        image = item["image"]
+        if image.nbytes > self._slot_bytes:
+            logger.trace("Frame too large for slot. Sending inline: (frame: %s, slot: %s)",
+                         image.nbytes, self._slot_bytes)
+            return item
+        slot = self._acquire()
+        if slot is None:
+            return item
+        self._view(slot, image.shape, image.dtype)[...] = image
+        item["frame_slot"] = (slot, image.shape, image.dtype.str)
+        item["image"] = None
+        return item
+
+    def get_frame(self, item):
+        """ Populate the item's image with a view of its frame in shared memory """
+        if isinstance(item, dict) and item.get("frame_slot") is not None:
+            item["image"] = self._view(*item["frame_slot"])
+        return item
+
+    def release(self, item):
+        """ Return the item's slot to the pool. The item's image must not be used after
+            release """
+        if not isinstance(item, dict) or item.get("frame_slot") is None:
+            return
+        slot = item.pop("frame_slot")[0]
+        item.pop("image", None)
+        self._free.put(slot)
+
+
+def _init_pool_process(log_level, log_queue, inherited):
+    """ Initialize a pooled process with the logger and the objects it inherits """
+    set_root_logger(log_level, log_queue)
+    _pool_inherited.update(inherited)
+
+
+def _run_pool_target(method, args, kwargs):
+    """ Run the pooled process's target with the inherited objects added to its kwargs """
+    kwargs.update(_pool_inherited)
+    return method(*args, **kwargs)
+
+
 class PoolProcess():
-    """ Pool multiple processes """
-    def __init__(self, method, in_queue, out_queue, *args, processes=None, **kwargs):
+    """ Pool multiple processes
+
+        Objects which can only be shared between processes through inheritance (eg.
+        SharedFramePool) should be passed in the inherit dict. These are sent to each process
+        when it is launched and are added to the target's kwargs """
+    def __init__(self, method, in_queue, out_queue, *args, processes=None, inherit=None,
+                 **kwargs):
         self._name = method.__qualname__
-        logger.debug("Initializing %s: (target: '%s', processes: %s)",
-                     self.__class__.__name__, self._name, processes)
+        logger.debug("Initializing %s: (target: '%s', processes: %s, inherit: %s)",
+                     self.__class__.__name__, self._name, processes, inherit)
 
         self.procs = self.set_procs(processes)
         ctx = mp.get_context("spawn")
         self.pool = ctx.Pool(processes=self.procs,
-                             initializer=set_root_logger,
-                             initargs=(logger.getEffectiveLevel(), LOG_QUEUE))
+                             initializer=_init_pool_process,
+                             initargs=(logger.getEffectiveLevel(),
+                                       LOG_QUEUE,
+                                       dict() if inherit is None else inherit))
         self._method = method
         self._kwargs = self.build_target_kwargs(in_queue, out_queue, kwargs)
         self._args = args
@@ -314,7 +459,7 @@ class PoolProcess():
         for idx in range(self.procs):
             logger.debug("Adding process %s of %s to mp.Pool '%s'",
                          idx + 1, self.procs, self._name)
-            self.pool.apply_async(self._method, args=self._args, kwds=self._kwargs)
+            self.pool.apply_async(_run_pool_target, args=(self._method, self._args, self._kwargs))
             _launched_processes.add(self.pool)
         logging.debug("Pooled Processes: '%s'", self._name)
 
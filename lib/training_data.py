@@ -2,16 +2,21 @@
 """ Process training data for model training """
 
 import logging
+import multiprocessing as mp
+import os
 
+from ctypes import c_int32, c_int64, c_uint8
 from hashlib import sha1
-from random import random, shuffle, choice
+from multiprocessing.sharedctypes import RawArray
+from random import random, choice
 
 import cv2
 import numpy as np
 from scipy.interpolate import griddata
+from scipy.spatial import Delaunay  # pylint:disable=no-name-in-module
 
 from lib.model import masks
-from lib.multithreading import FixedProducerDispatcher
+from lib.multithreading import FixedProducerDispatcher, total_cpus
 from lib.queue_manager import queue_manager
 from lib.umeyama import umeyama
 from lib.utils import cv2_read_img, FaceswapError
@@ -21,26 +26,41 @@ logger = logging.getLogger(__name__)  # pylint: disable=invalid-name
 
 class TrainingDataGenerator():
     """ Generate training data for models """
+    MAX_DEFAULT_WORKERS = 4  # Cap for the worker count when it is not set in config
+
     def __init__(self, model_input_size, model_output_shapes, training_opts, config):
         logger.debug("Initializing %s: (model_input_size: %s, model_output_shapes: %s, "
                      "training_opts: %s, landmarks: %s, config: %s)",
                      self.__class__.__name__, model_input_size, model_output_shapes,
-                     {key: val for key, val in training_opts.items() if key != "landmarks"},
+                     {key: val for key, val in training_opts.items()
+                      if key not in ("landmarks", "face_hashes", "nearest_landmarks",
+                                     "masks")},
                      bool(training_opts.get("landmarks", None)), config)
         self.batchsize = 0
         self.model_input_size = model_input_size
         self.model_output_shapes = model_output_shapes
         self.training_opts = training_opts
+        self.config = config
         self.mask_class = self.set_mask_class()
         self.landmarks = self.training_opts.get("landmarks", None)
         self.fixed_producer_dispatcher = None  # Set by FPD when loading
-        self._nearest_landmarks = None
+        self.face_cache = None  # Set when batching if a cache size has been configured
+        self.face_hashes = self.training_opts.get("face_hashes", None)
+        self.nearest_landmarks = self.training_opts.get("nearest_landmarks", None)
+        self.mask_files = self.training_opts.get("masks", None)
+        self._stored_masks = dict()  # Memory mapped in each worker when first required
         self.processing = ImageManipulation(model_input_size,
                                             model_output_shapes,
                                             training_opts.get("coverage_ratio", 0.625),
                                             config)
         logger.debug("Initialized %s", self.__class__.__name__)
 
+    def __getstate__(self):
+        """ Memory mapped masks are opened by each worker, so drop them when pickling """
+        state = self.__dict__.copy()
+        state["_stored_masks"] = dict()
+        return state
+
     def set_mask_class(self):
         """ Set the mask function to use if using mask """
         mask_type = self.training_opts.get("mask_type", None)
@@ -68,17 +88,49 @@ class TrainingDataGenerator():
         # Target images
         batch_shape.extend(tuple([(batchsize, ) + shape for shape in self.model_output_shapes]))
         logger.debug("Batch shapes: %s", batch_shape)
+        if not is_display:
+            self.face_cache = self.set_face_cache(images, training_size)
 
         self.fixed_producer_dispatcher = FixedProducerDispatcher(
             method=self.load_batches,
             shapes=batch_shape,
             in_queue=queue_in,
             out_queue=queue_out,
-            args=(images, side, is_display, do_shuffle, batchsize))
+            args=(images, side, is_display, do_shuffle, batchsize),
+            kwargs=dict(shuffle_seed=np.random.randint(2 ** 31)),
+            workers=1 if is_display else self.get_worker_count(len(images), batchsize,
+                                                               batch_shape))
         self.fixed_producer_dispatcher.start()
         logger.debug("Batching to queue: (side: '%s', is_display: %s)", side, is_display)
         return self.minibatch(side, is_display, self.fixed_producer_dispatcher)
 
+    def get_worker_count(self, image_count, batchsize, batch_shape):
+        """ Return the number of worker processes to use for producing batches for one side.
+
+            If not set in config then the available cores are split between the 2 sides, up to
+            a maximum of :attr:`MAX_DEFAULT_WORKERS`. Every worker holds its own copy of the
+            landmarks and has 2 batches of shared memory, so memory use grows with the worker
+            count. Workers are never given less than a full batch of images per epoch """
+        workers = self.config.get("workers", 0)
+        if not workers:
+            workers = min(total_cpus() // 2, self.MAX_DEFAULT_WORKERS)
+        retval = max(1, min(workers, image_count // max(batchsize, 1)))
+        batch_bytes = sum(int(np.prod(shape)) for shape in batch_shape) * 4  # float32
+        logger.verbose("Using %s workers for side with %sMB of shared batch memory",
+                       retval, (batch_bytes * retval * 2) // (1024 * 1024))
+        logger.debug("Worker count: %s (configured: %s, image_count: %s, batchsize: %s)",
+                     retval, self.config.get("workers", 0), image_count, batchsize)
+        return retval
+
+    def set_face_cache(self, images, training_size):
+        """ Create the shared decoded face cache if a cache size has been configured """
+        cache_size = self.config.get("cache_size", 0)
+        if not cache_size:
+            logger.debug("Face cache disabled")
+            return None
+        retval = FaceCache(images, (training_size, training_size, 3), cache_size * 1024 * 1024)
+        return retval if retval.slots else None
+
     def join_subprocess(self):
         """ Join the FixedProduceerDispatcher subprocess from outside this module """
         logger.debug("Joining FixedProducerDispatcher")
@@ -104,20 +156,27 @@ class TrainingDataGenerator():
         return queues
 
     def load_batches(self, mem_gen, images, side, is_display,
-                     do_shuffle=True, batchsize=0):
-        """ Load the warped images and target images to queue """
+                     do_shuffle=True, batchsize=0, shuffle_seed=0, worker_index=0, workers=1):
+        """ Load the warped images and target images to queue.
+
+            Every worker shuffles the images with the same seed for each pass through the
+            images, and then takes every nth image from the shuffled list, so that workers do
+            not hand out the same images as each other within a pass """
         logger.debug("Loading batch: (image_count: %s, side: '%s', is_display: %s, "
-                     "do_shuffle: %s)", len(images), side, is_display, do_shuffle)
+                     "do_shuffle: %s, worker_index: %s, workers: %s)", len(images), side,
+                     is_display, do_shuffle, worker_index, workers)
         self.validate_samples(images)
-        # Intialize this for each subprocess
-        self._nearest_landmarks = dict()
 
         def _img_iter(imgs):
+            img_pass = 0
             while True:
                 if do_shuffle:
-                    shuffle(imgs)
-                for img in imgs:
-                    yield img
+                    order = np.random.RandomState(shuffle_seed + img_pass).permutation(len(imgs))
+                    img_pass += 1
+                else:
+                    order = range(len(imgs))
+                for idx in order[worker_index::workers]:
+                    yield imgs[idx]
 
         img_iter = _img_iter(images)
         epoch = 0
@@ -125,13 +184,9 @@ class TrainingDataGenerator():
             memory = memory_wrapper.get()
             logger.trace("Putting to batch queue: (side: '%s', is_display: %s)",
                          side, is_display)
-            for i, img_path in enumerate(img_iter):
-                imgs = self.process_face(img_path, side, is_display)
-                for j, img in enumerate(imgs):
-                    memory[j][i][:] = img
-                epoch += 1
-                if i == batchsize - 1:
-                    break
+            filenames = [next(img_iter) for _ in range(batchsize)]
+            self.process_batch(filenames, side, is_display, memory)
+            epoch += batchsize
             memory_wrapper.ready()
         logger.debug("Finished batching: (epoch: %s, side: '%s', is_display: %s)",
                      epoch, side, is_display)
@@ -167,44 +222,108 @@ class TrainingDataGenerator():
                      side, is_display)
         load_process.join()
 
-    def process_face(self, filename, side, is_display):
-        """ Load an image and perform transformation and warping """
-        logger.trace("Process face: (filename: '%s', side: '%s', is_display: %s)",
+    def process_batch(self, filenames, side, is_display, memory):
+        """ Load a batch of images, perform transformation and warping and write the results
+            straight into the batch memory.
+
+            memory is laid out as [samples, warped images, target images, [target masks]] """
+        logger.trace("Process batch: (filenames: %s, side: '%s', is_display: %s)",
+                     len(filenames), side, is_display)
+        face_hashes = list()
+        faces = None
+        for idx, filename in enumerate(filenames):
+            image, face_hash = self.load_face(filename, side, is_display)
+            if faces is None:
+                channels = 4 if self.mask_class else 3
+                faces = self.processing.get_buffer("faces",
+                                                   (len(filenames), ) + image.shape[:2] +
+                                                   (channels, ))
+            faces[idx, :, :, :3] = image
+            if self.mask_class:
+                np.divide(self.get_mask(face_hash, side, image), 255.0, out=faces[idx, :, :, 3:])
+            face_hashes.append(face_hash)
+
+        if is_display:
+            memory[0][:] = faces[..., :3]
+        else:
+            # Without a mask the transformed faces can be written straight into the samples
+            out = memory[0] if faces.shape[-1] == 3 else None
+            faces = self.processing.random_transform_batch(faces,
+                                                           not self.training_opts["no_flip"],
+                                                           out=out)
+            if out is None:
+                memory[0][:] = faces[..., :3]
+
+        if self.training_opts["warp_to_landmarks"]:
+            for idx, face_hash in enumerate(face_hashes):
+                src_pts = self.landmarks[side][face_hash]
+                dst_pts = self.get_closest_match(face_hash, side)
+                processed = self.processing.random_warp_landmarks(faces[idx], src_pts, dst_pts)
+                for j, img in enumerate(processed):
+                    memory[j + 1][idx][:] = img
+        else:
+            self.processing.random_warp_batch(faces, memory[1:])
+        logger.trace("Processed batch: (side: '%s', shapes: %s)",
+                     side, [item.shape for item in memory])
+
+    def load_face(self, filename, side, is_display):
+        """ Load an image and perform color augmentation.
+
+            Returns the float32 image and the face's hash (None if landmarks are not
+            required) """
+        logger.trace("Load face: (filename: '%s', side: '%s', is_display: %s)",
                      filename, side, is_display)
-        image = cv2_read_img(filename, raise_error=True)
+        if self.face_cache is None:
+            image = cv2_read_img(filename, raise_error=True)
+        else:
+            image = self.face_cache.load(filename)
+        face_hash = None
         if self.mask_class or self.training_opts["warp_to_landmarks"]:
-            src_pts = self.get_landmarks(filename, image, side)
-        if self.mask_class:
-            image = self.mask_class(src_pts, image, channels=4).mask
+            face_hash = self.get_face_hash(filename, image, side)
 
         image = self.processing.color_adjust(image,
                                              self.training_opts["augment_color"],
                                              is_display)
-
-        if not is_display:
-            image = self.processing.random_transform(image)
-            if not self.training_opts["no_flip"]:
-                image = self.processing.do_random_flip(image)
-        sample = image.copy()[:, :, :3]
-
-        if self.training_opts["warp_to_landmarks"]:
-            dst_pts = self.get_closest_match(filename, side, src_pts)
-            processed = self.processing.random_warp_landmarks(image, src_pts, dst_pts)
-        else:
-            processed = self.processing.random_warp(image)
-
-        processed.insert(0, sample)
-        logger.trace("Processed face: (filename: '%s', side: '%s', shapes: %s)",
-                     filename, side, [img.shape for img in processed])
-        return processed
-
-    def get_landmarks(self, filename, image, side):
-        """ Return the landmarks for this face """
-        logger.trace("Retrieving landmarks: (filename: '%s', side: '%s'", filename, side)
-        lm_key = sha1(image).hexdigest()
-        try:
-            src_points = self.landmarks[side][lm_key]
-        except KeyError as err:
+        return image, face_hash
+
+    def get_mask(self, face_hash, side, image):
+        """ Return the single channel mask for the given face.
+
+            Masks for training images are built once when training starts and read from the
+            side's memory mapped mask file. Masks for any other face (eg: timelapse images) are
+            built from the landmarks """
+        stored = self.get_stored_masks(side)
+        if stored is not None:
+            masks_array, rows = stored
+            row = rows.get(face_hash, None)
+            if row is not None and masks_array.shape[1:3] == image.shape[:2]:
+                logger.trace("Stored mask: (face_hash: %s, row: %s)", face_hash, row)
+                return masks_array[row]
+        logger.trace("Building mask: (face_hash: %s)", face_hash)
+        return self.mask_class(self.landmarks[side][face_hash], image, channels=1).mask
+
+    def get_stored_masks(self, side):
+        """ Return the memory mapped masks and the {face_hash: row} index for a side, or None
+            if masks have not been stored for the side """
+        if side not in self._stored_masks:
+            stored = self.mask_files.get(side, None) if self.mask_files else None
+            if stored is not None:
+                filename, rows = stored
+                logger.debug("Loading stored masks: '%s'", filename)
+                stored = (np.load(filename, mmap_mode="r"), rows)
+            self._stored_masks[side] = stored
+        return self._stored_masks[side]
+
+    def get_face_hash(self, filename, image, side):
+        """ Return the hash for this face, checking that it has landmarks.
+
+            Training images are hashed when training starts, so the image only needs to be
+            hashed here if it is not a training image (eg: timelapse images) """
+        logger.trace("Retrieving face hash: (filename: '%s', side: '%s'", filename, side)
+        lm_key = self.face_hashes[side].get(filename, None) if self.face_hashes else None
+        if lm_key is None:
+            lm_key = sha1(image).hexdigest()
+        if lm_key not in self.landmarks[side]:
             msg = ("At least one of your images does not have a matching entry in your alignments "
                    "file."
                    "\nIf you are training with a mask or using 'warp to landmarks' then every "
@@ -212,28 +331,111 @@ class TrainingDataGenerator():
                    "\nThe specific file that caused the failure was '{}' which has a hash of {}."
                    "\nMost likely there will be more than just this file missing from the "
                    "alignments file. You can use the Alignments Tool to help identify missing "
-                   "alignments".format(lm_key, filename))
-            raise FaceswapError(msg) from err
-        logger.trace("Returning: (src_points: %s)", src_points)
-        return src_points
-
-    def get_closest_match(self, filename, side, src_points):
-        """ Return closest matched landmarks from opposite set """
-        logger.trace("Retrieving closest matched landmarks: (filename: '%s', src_points: '%s'",
-                     filename, src_points)
+                   "alignments".format(filename, lm_key))
+            raise FaceswapError(msg)
+        logger.trace("Returning: (face_hash: %s)", lm_key)
+        return lm_key
+
+    def get_closest_match(self, face_hash, side):
+        """ Return closest matched landmarks from opposite set, from the nearest landmarks
+            calculated when training started """
+        logger.trace("Retrieving closest matched landmarks: (face_hash: '%s', side: '%s'",
+                     face_hash, side)
         landmarks = self.landmarks["a"] if side == "b" else self.landmarks["b"]
-        closest_hashes = self._nearest_landmarks.get(filename)
-        if not closest_hashes:
-            dst_points_items = list(landmarks.items())
-            dst_points = list(x[1] for x in dst_points_items)
-            closest = (np.mean(np.square(src_points - dst_points), axis=(1, 2))).argsort()[:10]
-            closest_hashes = tuple(dst_points_items[i][0] for i in closest)
-            self._nearest_landmarks[filename] = closest_hashes
+        closest_hashes = self.nearest_landmarks[side][face_hash]
         dst_points = landmarks[choice(closest_hashes)]
         logger.trace("Returning: (dst_points: %s)", dst_points)
         return dst_points
 
 
+class FaceCache():
+    """ Cache of decoded training faces held in shared memory.
+
+        The cache is created in the parent process and passed to each
+        :class:`~lib.multithreading.FixedProducerDispatcher` worker, so a face decoded by any
+        worker is available to all of them. Faces are keyed by path and modification time.
+        Once the byte budget has been filled the least recently used face is evicted.
+
+        Faces that do not match the given shape are read from disk and not cached.
+    """
+    CTX = mp.get_context("spawn")
+
+    def __init__(self, filenames, face_shape, max_bytes):
+        logger.debug("Initializing %s: (filenames: %s, face_shape: %s, max_bytes: %s)",
+                     self.__class__.__name__, len(filenames), face_shape, max_bytes)
+        self._face_shape = tuple(face_shape)
+        self._face_bytes = int(np.prod(face_shape))
+        self.slots = int(min(len(filenames), max_bytes // self._face_bytes))
+        self._keys = {(filename, os.path.getmtime(filename)): idx
+                      for idx, filename in enumerate(filenames)}
+        self._lock = self.CTX.Lock()
+        self._shared = dict(data=RawArray(c_uint8, max(self.slots, 1) * self._face_bytes),
+                            lookup=RawArray(c_int32, len(filenames)),
+                            owner=RawArray(c_int32, max(self.slots, 1)),
+                            access=RawArray(c_int64, max(self.slots, 1)),
+                            stats=RawArray(c_int64, 3))  # clock, hits, misses
+        self._arrays = None
+        self.arrays["lookup"][:] = -1
+        self.arrays["owner"][:] = -1
+        logger.info("Caching up to %s of %s decoded faces (%sMB)",
+                    self.slots, len(filenames), (self.slots * self._face_bytes) // (1024 * 1024))
+        logger.debug("Initialized %s", self.__class__.__name__)
+
+    @property
+    def arrays(self):
+        """ dict: Numpy views of the shared memory for the current process """
+        if self._arrays is None:
+            self._arrays = {key: np.frombuffer(val, dtype=np.dtype(val._type_))
+                            for key, val in self._shared.items()}
+            self._arrays["data"] = self._arrays["data"].reshape((-1, ) + self._face_shape)
+        return self._arrays
+
+    @property
+    def hit_rate(self):
+        """ float: The percentage of face loads that have been served from the cache """
+        _, hits, misses = self.arrays["stats"]
+        total = hits + misses
+        return 0.0 if total == 0 else (hits / total) * 100
+
+    def __getstate__(self):
+        """ Numpy views cannot be shared between processes, so drop them when pickling """
+        state = self.__dict__.copy()
+        state["_arrays"] = None
+        return state
+
+    def load(self, filename):
+        """ Return a copy of the decoded face for the given filename, reading it from disk and
+            adding it to the cache if it is not already cached """
+        arrays = self.arrays
+        idx = self._keys.get((filename, os.path.getmtime(filename)), None)
+        if idx is not None:
+            with self._lock:
+                slot = arrays["lookup"][idx]
+                if slot != -1:
+                    arrays["stats"][0] += 1
+                    arrays["stats"][1] += 1
+                    arrays["access"][slot] = arrays["stats"][0]
+                    logger.trace("Cache hit: '%s'", filename)
+                    return arrays["data"][slot].copy()
+
+        image = cv2_read_img(filename, raise_error=True)
+        with self._lock:
+            arrays["stats"][2] += 1
+            if idx is None or image.shape != self._face_shape or arrays["lookup"][idx] != -1:
+                return image
+            slot = int(np.argmin(arrays["access"]))
+            if arrays["owner"][slot] != -1:
+                logger.trace("Evicting slot %s for '%s'", slot, filename)
+                arrays["lookup"][arrays["owner"][slot]] = -1
+            arrays["data"][slot] = image
+            arrays["stats"][0] += 1
+            arrays["access"][slot] = arrays["stats"][0]
+            arrays["owner"][slot] = idx
+            arrays["lookup"][idx] = slot
+        logger.trace("Cached: '%s' (slot: %s)", filename, slot)
+        return image
+
+
 class ImageManipulation():
     """ Manipulations to be performed on training images """
     def __init__(self, input_size, output_shapes, coverage_ratio, config):
@@ -252,8 +454,21 @@ class ImageManipulation():
         # Warp args
         self.coverage_ratio = coverage_ratio  # Coverage ratio of full image. Eg: 256 * 0.625 = 160
         self.scale = 5  # Normal random variable scale
+        self._target_matrices = dict()
+        self._buffers = dict()
         logger.debug("Initialized %s", self.__class__.__name__)
 
+    def get_buffer(self, name, shape, dtype="float32"):
+        """ Return a reusable working array of the given shape, so that batch operations do not
+            need to allocate new memory for every batch """
+        buffer = self._buffers.get(name, None)
+        if buffer is None or buffer.shape != shape or buffer.dtype != dtype:
+            logger.debug("Allocating buffer: (name: '%s', shape: %s, dtype: %s)",
+                         name, shape, dtype)
+            buffer = np.empty(shape, dtype=dtype)
+            self._buffers[name] = buffer
+        return buffer
+
     def color_adjust(self, img, augment_color, is_display):
         """ Color adjust RGB image """
         logger.trace("Color adjusting image")
@@ -349,6 +564,57 @@ class ImageManipulation():
         logger.trace("Randomly transformed image")
         return result
 
+    def get_transform_matrices(self, batchsize, width, height, do_flip):
+        """ Return the random transformation matrices for a batch of images in one pass.
+
+            The matrices are equivalent to those generated by :func:`random_transform`, with the
+            random horizontal flip from :func:`do_random_flip` folded in when do_flip is True """
+        rotation_range = self.config.get("rotation_range", 10)
+        rotation = np.deg2rad(np.random.uniform(-rotation_range, rotation_range, batchsize))
+
+        zoom_range = self.config.get("zoom_range", 5) / 100
+        scale = np.random.uniform(1 - zoom_range, 1 + zoom_range, batchsize)
+
+        shift_range = self.config.get("shift_range", 5) / 100
+        tnx = np.random.uniform(-shift_range, shift_range, batchsize) * width
+        tny = np.random.uniform(-shift_range, shift_range, batchsize) * height
+
+        center_x, center_y = width // 2, height // 2
+        alpha = scale * np.cos(rotation)
+        beta = scale * np.sin(rotation)
+        mats = np.empty((batchsize, 2, 3), dtype="float64")
+        mats[:, 0, 0] = alpha
+        mats[:, 0, 1] = beta
+        mats[:, 0, 2] = (1 - alpha) * center_x - beta * center_y + tnx
+        mats[:, 1, 0] = -beta
+        mats[:, 1, 1] = alpha
+        mats[:, 1, 2] = beta * center_x + (1 - alpha) * center_y + tny
+
+        if do_flip:
+            flip = np.random.random(batchsize) < self.config.get("random_flip", 50) / 100
+            mats[flip, 0] *= -1
+            mats[flip, 0, 2] += width - 1
+        logger.trace("Transform matrices: %s", mats)
+        return mats
+
+    def random_transform_batch(self, images, do_flip, out=None):
+        """ Randomly transform (and optionally flip) a batch of images.
+
+            The result is written to out if it is given, otherwise to a reused buffer, so the
+            result is only valid until the next call """
+        logger.trace("Randomly transforming batch: %s", images.shape)
+        batchsize, height, width = images.shape[:3]
+        mats = self.get_transform_matrices(batchsize, width, height, do_flip)
+        retval = self.get_buffer("transformed", images.shape) if out is None else out
+        for image, mat, result in zip(images, mats, retval):
+            cv2.warpAffine(image,  # pylint:disable=no-member
+                           mat,
+                           (width, height),
+                           dst=result,
+                           borderMode=cv2.BORDER_REPLICATE)  # pylint:disable=no-member
+        logger.trace("Randomly transformed batch")
+        return retval
+
     def do_random_flip(self, image):
         """ Perform flip on image if random number is within threshold """
         logger.trace("Randomly flipping image")
@@ -362,11 +628,9 @@ class ImageManipulation():
         logger.trace("Randomly flipped image")
         return retval
 
-    def random_warp(self, image):
-        """ get pair of random warped images from aligned face image """
-        logger.trace("Randomly warping image")
-        height, width = image.shape[0:2]
-        coverage = self.get_coverage(image) // 2
+    @staticmethod
+    def validate_size(height, width):
+        """ Check that the training image is square and has an even number of pixels """
         try:
             assert height == width and height % 2 == 0
         except AssertionError as err:
@@ -377,14 +641,40 @@ class ImageManipulation():
                    "from the Extract process.".format(width, height))
             raise FaceswapError(msg) from err
 
-        range_ = np.linspace(height // 2 - coverage, height // 2 + coverage, 5, dtype='float32')
+    def get_warp_grid(self, size):
+        """ Return the un-warped 5x5 grid of x and y co-ordinates that the warp is built from """
+        coverage = int(size * self.coverage_ratio) // 2
+        range_ = np.linspace(size // 2 - coverage, size // 2 + coverage, 5, dtype='float32')
         mapx = np.broadcast_to(range_, (5, 5)).copy()
         mapy = mapx.T
+        return mapx, mapy
+
+    def get_target_matrices(self, size):
+        """ Return the affine matrices to produce each target image from the training image.
+
+            These only depend on the image size, so are calculated once and cached """
+        if size in self._target_matrices:
+            return self._target_matrices[size]
+        mapx, mapy = self.get_warp_grid(size)
+        src_points = np.stack([mapx.ravel(), mapy.ravel()], axis=-1)
+        dst_slices = [slice(0, (out_size + 1), (out_size // 4)) for out_size in self.output_sizes]
+        dst_points = [np.mgrid[dst_slice, dst_slice] for dst_slice in dst_slices]
+        mats = [umeyama(src_points, True, dst_pts.T.reshape(-1, 2))[0:2]
+                for dst_pts in dst_points]
+        logger.debug("Target matrices for size %s: %s", size, mats)
+        self._target_matrices[size] = mats
+        return mats
+
+    def random_warp(self, image):
+        """ get pair of random warped images from aligned face image """
+        logger.trace("Randomly warping image")
+        height, width = image.shape[0:2]
+        self.validate_size(height, width)
+        mapx, mapy = self.get_warp_grid(height)
         # mapx, mapy = np.float32(np.meshgrid(range_,range_)) # instead of broadcast
 
         pad = int(1.25 * self.input_size)
         slices = slice(pad // 10, -pad // 10)
-        dst_slices = [slice(0, (size + 1), (size // 4)) for size in self.output_sizes]
         interp = np.empty((2, self.input_size, self.input_size), dtype='float32')
 
         for i, map_ in enumerate([mapx, mapy]):
@@ -395,19 +685,70 @@ class ImageManipulation():
             image, interp[0], interp[1], cv2.INTER_LINEAR)  # pylint:disable=no-member
         logger.trace("Warped image shape: %s", warped_image.shape)
 
-        src_points = np.stack([mapx.ravel(), mapy.ravel()], axis=-1)
-        dst_points = [np.mgrid[dst_slice, dst_slice] for dst_slice in dst_slices]
-        mats = [umeyama(src_points, True, dst_pts.T.reshape(-1, 2))[0:2]
-                for dst_pts in dst_points]
-
         target_images = [cv2.warpAffine(image,  # pylint:disable=no-member
                                         mat,
                                         (self.output_sizes[idx], self.output_sizes[idx]))
-                         for idx, mat in enumerate(mats)]
+                         for idx, mat in enumerate(self.get_target_matrices(height))]
 
         logger.trace("Target image shapes: %s", [tgt.shape for tgt in target_images])
         return self.compile_images(warped_image, target_images)
 
+    def get_warp_maps(self, batchsize, size):
+        """ Return the random warp maps for a batch of images in one pass.
+
+            The 5x5 grids for every image are stacked as channels so that they can all be
+            upscaled with a single resize. Returns an array of shape
+            (batchsize, input_size, input_size, 2) for use as a cv2.remap map """
+        mapx, mapy = self.get_warp_grid(size)
+        grids = np.empty((5, 5, batchsize, 2), dtype="float32")
+        grids[..., 0] = mapx[..., None]
+        grids[..., 1] = mapy[..., None]
+        grids += np.random.normal(size=grids.shape, scale=self.scale)
+        grids = grids.reshape(5, 5, batchsize * 2)
+
+        pad = int(1.25 * self.input_size)
+        slices = slice(pad // 10, -pad // 10)
+        max_channels = 512  # cv2.CV_CN_MAX
+        interp = np.concatenate(
+            [cv2.resize(grids[..., idx:idx + max_channels],  # pylint:disable=no-member
+                        (pad, pad)).reshape(pad, pad, -1)
+             for idx in range(0, batchsize * 2, max_channels)], axis=-1)[slices, slices]
+        retval = np.ascontiguousarray(
+            interp.reshape(self.input_size, self.input_size, batchsize, 2).transpose(2, 0, 1, 3))
+        logger.trace("Warp maps shape: %s", retval.shape)
+        return retval
+
+    def random_warp_batch(self, images, outputs):
+        """ Randomly warp a batch of aligned face images, writing the warped images, target
+            images and target mask directly into outputs.
+
+            outputs is laid out as [warped images, target images, [target masks]] """
+        logger.trace("Randomly warping batch: %s", images.shape)
+        batchsize, height, width = images.shape[:3]
+        self.validate_size(height, width)
+        maps = self.get_warp_maps(batchsize, height)
+        target_mats = self.get_target_matrices(height)
+
+        warped = outputs[0]
+        targets = outputs[1:len(self.output_sizes) + 1]
+        masks = outputs[len(self.output_sizes) + 1] if images.shape[-1] == 4 else None
+        for idx, image in enumerate(images):
+            face = np.ascontiguousarray(image[..., :3])
+            cv2.remap(face,  # pylint:disable=no-member
+                      maps[idx],
+                      None,
+                      cv2.INTER_LINEAR,  # pylint:disable=no-member
+                      dst=warped[idx])
+            for mat, size, target in zip(target_mats, self.output_sizes, targets):
+                # pylint:disable=no-member
+                if masks is not None and size == masks.shape[1]:
+                    target_image = cv2.warpAffine(image, mat, (size, size))
+                    target[idx] = target_image[..., :3]
+                    masks[idx] = target_image[..., 3:]
+                else:
+                    cv2.warpAffine(face, mat, (size, size), dst=target[idx])
+        logger.trace("Randomly warped batch")
+
     def random_warp_landmarks(self, image, src_points=None, dst_points=None):
         """ get warped image, target image and target mask
             From DFAKER plugin """
@@ -420,7 +761,6 @@ class ImageManipulation():
 
         edge_anchors = [(0, 0), (0, p_mx), (p_mx, p_mx), (p_mx, 0),
                         (p_hf, 0), (p_hf, p_mx), (p_mx, p_hf), (0, p_hf)]
-        grid_x, grid_y = np.mgrid[0:p_mx:complex(size), 0:p_mx:complex(size)]
 
         source = src_points
         destination = (dst_points.copy().astype('float32') +
@@ -447,11 +787,15 @@ class ImageManipulation():
             source.pop(idx)
             destination.pop(idx)
 
-        grid_z = griddata(destination, source, (grid_x, grid_y), method="linear")
-        map_x = np.append([], [ar[:, 1] for ar in grid_z]).reshape(size, size)
-        map_y = np.append([], [ar[:, 0] for ar in grid_z]).reshape(size, size)
-        map_x_32 = map_x.astype('float32')
-        map_y_32 = map_y.astype('float32')
+        if self.config.get("landmarks_warp", "griddata") == "piecewise_affine":
+            map_x_32, map_y_32 = self.get_piecewise_affine_maps(size, source, destination)
+        else:
+            grid_x, grid_y = np.mgrid[0:p_mx:complex(size), 0:p_mx:complex(size)]
+            grid_z = griddata(destination, source, (grid_x, grid_y), method="linear")
+            map_x = np.append([], [ar[:, 1] for ar in grid_z]).reshape(size, size)
+            map_y = np.append([], [ar[:, 0] for ar in grid_z]).reshape(size, size)
+            map_x_32 = map_x.astype('float32')
+            map_y_32 = map_y.astype('float32')
 
         warped_image = cv2.remap(image,  # pylint:disable=no-member
                                  map_x_32,
@@ -475,6 +819,85 @@ class ImageManipulation():
         logger.trace("Target image shapea: %s", [img.shape for img in target_images])
         return self.compile_images(warped_image, target_images)
 
+    @staticmethod
+    def get_piecewise_affine_maps(size, source, destination):
+        """ Return the x and y remap maps for a landmarks warp as a piecewise affine warp.
+
+            This builds the same warp as a linear griddata interpolation over the same
+            triangulation, but rather than locating every pixel within the triangulation, each
+            triangle is rasterized into an index map and its affine transform is applied to all
+            of its pixels in one pass. Rasterization does not always give pixels on a shared edge
+            to the triangle that contains them, so any pixel near an edge that lies outside of
+            its triangle is located within the triangulation """
+        source = np.array(source, dtype="float64")
+        destination = np.array(destination, dtype="float64")
+        triangulation = Delaunay(destination)
+        triangles = triangulation.simplices
+        # [row, col, 1] @ inverse = barycentric co-ordinates of the point within each triangle,
+        # from the barycentric transforms that the triangulation holds
+        transform = triangulation.transform
+        inverse = np.empty((triangles.shape[0], 3, 3), dtype="float64")
+        inverse[:, :2, :2] = transform[:, :2].transpose(0, 2, 1)
+        inverse[:, 2, :2] = -np.einsum("ijk,ik->ij", transform[:, :2], transform[:, 2])
+        inverse[:, :, 2] = -inverse[:, :, :2].sum(axis=2)
+        inverse[:, 2, 2] += 1
+        # Affine transform for each triangle: [row, col, 1] @ coefficients = source (row, col)
+        coefficients = np.matmul(inverse, source[triangles])
+
+        # Rasterize smallest triangles first, so that pixels on shared edges are taken by the
+        # larger triangle. Vertices are passed with 4 bits of sub-pixel precision
+        sides = destination[triangles[:, 1:]] - destination[triangles[:, :1]]
+        areas = np.abs(sides[:, 0, 0] * sides[:, 1, 1] - sides[:, 0, 1] * sides[:, 1, 0])
+        vertices = np.rint(destination[:, ::-1] * 16).astype("int32")  # (x, y) for cv2
+        index = np.full((size, size), -1, dtype="int32")
+        for idx in np.argsort(areas):
+            cv2.fillConvexPoly(index,  # pylint:disable=no-member
+                               vertices[triangles[idx]],
+                               int(idx),
+                               shift=4)
+
+        # Rasterization only misplaces pixels within a pixel of a triangle's edge, and the error
+        # is the distance from the edge multiplied by the difference between the affine
+        # transforms either side of it. Only pixels near edges where that difference is more than
+        # a pixel per pixel are checked against their triangle
+        gradients = coefficients[:, :2]
+        neighbors = triangulation.neighbors
+        difference = np.abs(gradients[:, None] - gradients[np.maximum(neighbors, 0)]).sum(axis=2)
+        steep = ~(difference.max(axis=-1) <= 1.0) | (neighbors == -1)
+        tri_idx, vertex = np.nonzero(steep)
+        segments = vertices[triangles[tri_idx[:, None], (vertex[:, None] + [1, 2]) % 3]]
+        edges = np.zeros((size, size), dtype="uint8")
+        cv2.polylines(edges,  # pylint:disable=no-member
+                      list(segments),
+                      False,
+                      1,
+                      thickness=2,
+                      shift=4)
+        if index.min() == -1:
+            edges[index == -1] = 1
+        check = np.nonzero(edges)
+        point_index = index[check]
+        points = np.stack(check, axis=-1).astype("float64")
+        point_inverse = inverse[point_index]
+        barycentric = (points[:, :1] * point_inverse[:, 0] +
+                       points[:, 1:] * point_inverse[:, 1] +
+                       point_inverse[:, 2])
+        misplaced = ~(barycentric.min(axis=1) >= -1e-6) | (point_index == -1)
+        if np.any(misplaced):
+            logger.trace("Locating %s pixels outside of their rasterized triangle",
+                         np.count_nonzero(misplaced))
+            index[check[0][misplaced], check[1][misplaced]] = np.maximum(
+                triangulation.find_simplex(points[misplaced]), 0)
+
+        coefficients = coefficients.astype("float32")
+        rows = np.arange(size, dtype="float32")[:, None]
+        cols = np.arange(size, dtype="float32")[None, :]
+        map_y, map_x = [coefficients[:, 0, axis].take(index) * rows +
+                        coefficients[:, 1, axis].take(index) * cols +
+                        coefficients[:, 2, axis].take(index)
+                        for axis in range(2)]
+        return map_x, map_y
+
     def compile_images(self, warped_image, target_images):
         """ Compile the warped images, target images and mask for feed """
         warped_image, _ = self.separate_mask(warped_image)
@@ -55,17 +55,21 @@ class VGGFace():
 
     def predict(self, face):
         """ Return encodings for given image from vgg_face """
-        if face.shape[0] != self.input_size:
-            face = self.resize_face(face)
-        blob = cv2.dnn.blobFromImage(face,  # pylint: disable=no-member
-                                     1.0,
-                                     (self.input_size, self.input_size),
-                                     self.average_img,
-                                     False,
-                                     False)
+        return self.predict_batch([face])[0]
+
+    def predict_batch(self, faces):
+        """ Return encodings for a list of images from vgg_face in a single forward pass """
+        faces = [face if face.shape[0] == self.input_size else self.resize_face(face)
+                 for face in faces]
+        blob = cv2.dnn.blobFromImages(faces,  # pylint: disable=no-member
+                                      1.0,
+                                      (self.input_size, self.input_size),
+                                      self.average_img,
+                                      False,
+                                      False)
         self.model.setInput(blob)
-        preds = self.model.forward("fc7")[0, :]
-        return preds
+        preds = self.model.forward("fc7")
+        return preds.reshape(len(faces), -1)
 
     def resize_face(self, face):
         """ Resize incoming face to model_input_size """
@@ -10,12 +10,21 @@ https://creativecommons.org/licenses/by-nc/4.0/
 import logging
 import sys
 import os
+import time
 
 import cv2
 import numpy as np
+import psutil
 from fastcluster import linkage
+from sklearn.cluster import MiniBatchKMeans
+from sklearn.decomposition import PCA
 from lib.utils import GetModel, set_system_verbosity
 
+if sys.platform.startswith("win"):
+    resource = None  # pylint: disable=invalid-name
+else:
+    import resource
+
 logger = logging.getLogger(__name__)  # pylint: disable=invalid-name
 
 
@@ -61,11 +70,14 @@ class VGGFace2():
 
     def predict(self, face):
         """ Return encodings for given image from vgg_face """
-        if face.shape[0] != self.input_size:
-            face = self.resize_face(face)
-        face = np.expand_dims(face - self.average_img, axis=0)
-        preds = self.model.predict(face)
-        return preds[0, :]
+        return self.predict_batch([face])[0]
+
+    def predict_batch(self, faces):
+        """ Return encodings for a list of images from vgg_face as a single batch """
+        faces = np.array([face if face.shape[0] == self.input_size else self.resize_face(face)
+                          for face in faces]) - self.average_img
+        preds = self.model.predict(faces, batch_size=len(faces))
+        return preds
 
     def resize_face(self, face):
         """ Resize incoming face to model_input_size """
@@ -87,12 +99,15 @@ class VGGFace2():
         var_c = np.sum(np.multiply(test_face, test_face))
         return 1 - (var_a / (np.sqrt(var_b) * np.sqrt(var_c)))
 
-    def sorted_similarity(self, predictions, method="ward"):
+    @classmethod
+    def sorted_similarity(cls, predictions, method="ward", max_exact=10000):
         """ Sort a matrix of predictions by similarity Adapted from:
             https://gmarti.gitlab.io/ml/2017/09/07/how-to-sort-distance-matrix.html
         input:
             - predictions is a stacked matrix of vgg_face predictions shape: (x, 4096)
             - method = ["ward","single","average","complete"]
+            - max_exact is the largest number of predictions to cluster in a single tree.
+              Larger sets are reduced and split into clusters (see clustered_order)
         output:
             - result_order is a list of indices with the order implied by the hierarhical tree
 
@@ -100,27 +115,133 @@ class VGGFace2():
         the order implied by the hierarchical tree (dendrogram)
         """
         logger.info("Sorting face distances. Depending on your dataset this may take some time...")
+        start_time = time.time()
         num_predictions = predictions.shape[0]
+        if num_predictions <= max_exact:
+            result_order = cls.linkage_order(predictions, method)
+        else:
+            result_order = cls.clustered_order(cls.reduce_dimensions(predictions),
+                                               method,
+                                               max_exact)
+        logger.info("Sorted %s faces in %.1fs (process peak memory: %sMB)",
+                    num_predictions, time.time() - start_time, cls.peak_memory())
+        return result_order
+
+    @staticmethod
+    def peak_memory():
+        """ Return the peak resident memory of this process in MB. This includes memory allocated
+            outside of Python, such as fastcluster's distance matrix """
+        if resource is None:
+            return psutil.Process().memory_info().peak_wset // (1024 * 1024)
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # ru_maxrss is in bytes on macOS and kilobytes elsewhere
+        return peak // (1024 * 1024) if sys.platform == "darwin" else peak // 1024
+
+    @classmethod
+    def linkage_order(cls, predictions, method):
+        """ Return the order of predictions implied by a hierarchical tree of all of them.
+            Memory use is quadratic in the number of predictions """
+        num_predictions = predictions.shape[0]
+        if num_predictions < 2:
+            return list(range(num_predictions))
         result_linkage = linkage(predictions, method=method, preserve_input=False)
-        result_order = self.seriation(result_linkage,
-                                      num_predictions,
-                                      num_predictions + num_predictions - 2)
+        return cls.seriation(result_linkage,
+                             num_predictions,
+                             num_predictions + num_predictions - 2)
 
+    @staticmethod
+    def reduce_dimensions(predictions, dims=128, sample_size=10000, chunk_size=10000):
+        """ Project predictions onto their first principal components. The components are fit
+            on a random sample of the predictions and the projection is done in chunks, so
+            that the full matrix is not copied """
+        num_predictions, num_features = predictions.shape
+        dims = min(dims, num_features, num_predictions)
+        sample = np.random.RandomState(0).choice(num_predictions,
+                                                 min(sample_size, num_predictions),
+                                                 replace=False)
+        pca = PCA(n_components=dims, svd_solver="randomized", random_state=0)
+        pca.fit(predictions[np.sort(sample)])
+        logger.verbose("Reduced face encodings to %s dimensions. Explained variance: %.2f",
+                       dims, pca.explained_variance_ratio_.sum())
+        return np.concatenate([pca.transform(predictions[idx:idx + chunk_size])
+                               for idx in range(0, num_predictions, chunk_size)])
+
+    @classmethod
+    def clustered_order(cls, features, method, max_exact, cluster_size=1000):
+        """ Return an order of features too numerous to cluster in a single tree.
+
+            The features are split into clusters of roughly cluster_size with mini batch
+            k-means. Each cluster is ordered with its own hierarchical tree (or clustered again
+            if still too large) and the clusters are ordered by a tree of their centroids. Each
+            cluster's order is reversed if that places its first face closer to the last face
+            of the preceding cluster.
+
+            If k-means cannot split the features, for example because most of them are
+            identical, they are ordered in chunks instead """
+        num_features = features.shape[0]
+        if num_features <= max_exact:
+            return cls.linkage_order(features, method)
+        num_clusters = int(np.ceil(num_features / cluster_size))
+        kmeans = MiniBatchKMeans(n_clusters=num_clusters,
+                                 batch_size=max(1024, 4 * num_clusters),
+                                 n_init=3,
+                                 random_state=0)
+        labels = kmeans.fit_predict(features)
+        clusters = [np.flatnonzero(labels == label) for label in range(num_clusters)]
+        clusters = [members for members in clusters if members.size]
+        if len(clusters) == 1:
+            logger.verbose("Unable to split %s faces into clusters. Ordering in chunks",
+                           num_features)
+            return cls.chunked_order(features, method, max_exact)
+        logger.verbose("Ordering %s faces in %s clusters", num_features, len(clusters))
+
+        centroids = np.array([features[members].mean(axis=0) for members in clusters])
+        result_order = list()
+        for cluster in cls.linkage_order(centroids, method):
+            members = clusters[cluster]
+            members = members[cls.clustered_order(features[members],
+                                                  method,
+                                                  max_exact,
+                                                  cluster_size=cluster_size)]
+            if result_order:
+                last = features[result_order[-1]]
+                if (np.linalg.norm(features[members[-1]] - last) <
+                        np.linalg.norm(features[members[0]] - last)):
+                    members = members[::-1]
+            result_order.extend(members.tolist())
         return result_order
 
-    def seriation(self, tree, points, current_index):
+    @classmethod
+    def chunked_order(cls, features, method, chunk_size):
+        """ Return an order of features that cannot be clustered, by ordering consecutive
+            chunks of chunk_size with their own hierarchical tree """
+        result_order = list()
+        for idx in range(0, features.shape[0], chunk_size):
+            order = cls.linkage_order(features[idx:idx + chunk_size], method)
+            result_order.extend(idx + member for member in order)
+        return result_order
+
+    @staticmethod
+    def seriation(tree, points, current_index):
         """ Seriation method for sorted similarity
             input:
                 - tree is a hierarchical tree (dendrogram)
                 - points is the number of points given to the clustering process
-                - current_index is the position in the tree for the recursive traversal
+                - current_index is the position in the tree to start the traversal from
             output:
                 - order implied by the hierarchical tree
 
-            seriation computes the order implied by a hierarchical tree (dendrogram)
+            seriation computes the order implied by a hierarchical tree (dendrogram). The tree
+            is walked depth first with a stack rather than recursion, so that deep trees do not
+            hit the recursion limit
         """
-        if current_index < points:
-            return [current_index]
-        left = int(tree[current_index-points, 0])
-        right = int(tree[current_index-points, 1])
-        return self.seriation(tree, points, left) + self.seriation(tree, points, right)
+        order = list()
+        stack = [current_index]
+        while stack:
+            index = stack.pop()
+            if index < points:
+                order.append(index)
+                continue
+            stack.append(int(tree[index - points, 1]))
+            stack.append(int(tree[index - points, 0]))
+        return order
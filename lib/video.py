@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+""" Indexed, seekable video reader for faceswap
+
+    The packet timestamps and keyframes of a video's first video stream are read once, without
+    decoding, and cached beside the video. The index gives an exact frame count and allows
+    single frames to be served by decoding forward from the nearest keyframe, rather than from
+    the start of the video """
+
+import logging
+import os
+import subprocess
+import sys
+from bisect import bisect_right
+from threading import Lock
+
+import imageio_ffmpeg as im_ffm
+import numpy as np
+
+from lib.Serializer import JSONSerializer
+from lib.utils import FaceswapError
+
+logger = logging.getLogger(__name__)  # pylint: disable=invalid-name
+
+
+class VideoReader():
+    """ Random access to the frames of a video file.
+
+        Frames are 0 indexed and returned in BGR order for cv2 compatibility. A decoder is
+        kept open between calls, so requests for frames at or shortly after the last requested
+        frame are served by reading forward. Other requests restart the decoder at the nearest
+        keyframe prior to the requested frame. Frame requests are serialized, so a reader can be
+        shared between threads """
+    index_version = 2
+
+    def __init__(self, path):
+        logger.debug("Initializing %s: (path: '%s')", self.__class__.__name__, path)
+        self.path = path
+        self.index = self.load_index()
+        self._reader = None
+        self._position = None  # The index of the next frame the open decoder will return
+        self._dims = None
+        self._lock = Lock()
+        logger.debug("Initialized %s: (frames: %s, keyframes: %s)",
+                     self.__class__.__name__, self.count, len(self.index["keyframes"]))
+
+    @property
+    def count(self):
+        """ The exact number of frames in the video """
+        return len(self.index["pts"])
+
+    @property
+    def index_file(self):
+        """ Full path to the cached index for this video """
+        return "{}.fsidx".format(self.path)
+
+    @property
+    def source_stats(self):
+        """ Size and modified time of the video, for invalidating a cached index """
+        stats = os.stat(self.path)
+        return [stats.st_size, int(stats.st_mtime)]
+
+    def load_index(self):
+        """ Load the cached index for this video, building it if it does not exist or the video
+            or index format has changed since it was built """
+        serializer = JSONSerializer
+        if os.path.isfile(self.index_file):
+            try:
+                with open(self.index_file, serializer.roptions) as ifile:
+                    index = serializer.unmarshal(ifile.read())
+                if (index.get("version") == self.index_version and
+                        index.get("source") == self.source_stats):
+                    logger.debug("Loaded video index: '%s'", self.index_file)
+                    return index
+                logger.debug("Video or index format has changed since index was built. "
+                             "Rebuilding")
+            except (OSError, ValueError) as err:
+                logger.debug("Unable to load video index '%s': %s", self.index_file, str(err))
+        index = self.build_index()
+        try:
+            with open(self.index_file, serializer.woptions) as ifile:
+                ifile.write(serializer.marshal(index))
+            logger.debug("Saved video index: '%s'", self.index_file)
+        except OSError as err:
+            logger.debug("Unable to save video index '%s': %s", self.index_file, str(err))
+        return index
+
+    def build_index(self):
+        """ Read the presentation timestamp and keyframe flag of every packet in the video
+            stream. The stream is copied to FFmpeg's framecrc muxer, so no frames are decoded.
+
+            Timestamps are held in presentation order, with the keyframes stored as indices into
+            that order """
+        logger.verbose("Indexing video: '%s'", os.path.basename(self.path))
+        cmd = [im_ffm.get_ffmpeg_exe(), "-hide_banner", "-nostdin", "-i", self.path,
+               "-map", "0:v:0", "-c", "copy", "-f", "framecrc", "-"]
+        logger.debug("FFMPEG Command: '%s'", " ".join(cmd))
+        try:
+            out = subprocess.check_output(cmd,
+                                          stderr=subprocess.PIPE,
+                                          shell=sys.platform.startswith("win"))
+        except subprocess.CalledProcessError as err:
+            raise FaceswapError("Unable to index video '{}': {}".format(
+                self.path, err.stderr.decode(errors="ignore").strip()))
+        time_base = None
+        packets = list()
+        for line in out.decode(errors="ignore").splitlines():
+            if line.startswith("#tb 0:"):
+                time_base = [int(val) for val in line.split(":")[1].strip().split("/")]
+            if not line or line.startswith("#"):
+                continue
+            fields = [field.strip() for field in line.split(",")]
+            # Flags are omitted for plain keyframes, but side data columns (S=n) may follow
+            flags = next((int(field[2:], 16) for field in fields[6:] if field.startswith("F=")),
+                         1)
+            if flags & 4:  # Discarded packet, never output by the decoder
+                continue
+            dts, pts = int(fields[1]), int(fields[2])
+            packets.append((pts if pts != -(2 ** 63) else dts, bool(flags & 1)))
+        packets = sorted(packets)
+        index = dict(version=self.index_version,
+                     source=self.source_stats,
+                     time_base=time_base,
+                     pts=[packet[0] for packet in packets],
+                     keyframes=[idx for idx, packet in enumerate(packets) if packet[1]])
+        logger.debug("Indexed video: (time_base: %s, frames: %s, keyframes: %s)",
+                     time_base, len(index["pts"]), len(index["keyframes"]))
+        return index
+
+    def keyframe_before(self, frame_index):
+        """ The index of the last keyframe at or before the given frame """
+        keyframes = self.index["keyframes"]
+        idx = bisect_right(keyframes, frame_index) - 1
+        return keyframes[idx] if idx >= 0 else 0
+
+    def seek_time(self, frame_index):
+        """ Input seek time, in seconds, for decoding from the given frame.
+
+            FFmpeg decodes from the last keyframe prior to the seek time and drops frames
+            displayed before it, so the time is set halfway between the requested frame and the
+            frame prior, which is safe against rounding. The time is a stream timestamp rather
+            than an offset from the start of the file, so the decoder is opened with
+            seek_timestamp enabled """
+        pts = self.index["pts"]
+        num, den = self.index["time_base"]
+        return (pts[frame_index - 1] + pts[frame_index]) / 2 * num / den
+
+    def open(self, frame_index):
+        """ Start a decoder that outputs frames from the given frame onwards """
+        self.close()
+        input_params = ["-nostdin"]
+        if frame_index > 0:
+            input_params.extend(["-seek_timestamp", "1",
+                                 "-ss", "{:.6f}".format(self.seek_time(frame_index))])
+        logger.trace("Opening decoder at frame %s: %s", frame_index, input_params)
+        self._reader = im_ffm.read_frames(self.path,
+                                          pix_fmt="bgr24",
+                                          input_params=input_params,
+                                          output_params=["-map", "0:v:0", "-vsync", "0"])
+        meta = self._reader.__next__()
+        self._dims = tuple(reversed(meta["size"]))
+        self._position = frame_index
+
+    def get_frame(self, frame_index):
+        """ Return the BGR frame at the given 0 indexed position, or None if it could not be
+            decoded """
+        if not 0 <= frame_index < self.count:
+            raise IndexError("Frame {} is out of range for video '{}' with {} frames".format(
+                frame_index, self.path, self.count))
+        with self._lock:
+            return self._read(frame_index)
+
+    def _read(self, frame_index):
+        """ Decode the requested frame, restarting the decoder if it is not cheaper to read
+            forward from its current position """
+        if (self._reader is None or frame_index < self._position or
+                self.keyframe_before(frame_index) > self._position):
+            self.open(frame_index)
+        try:
+            while self._position < frame_index:
+                self._reader.__next__()
+                self._position += 1
+            frame = self._reader.__next__()
+        except StopIteration:
+            logger.warning("Unable to decode frame %s from video '%s'",
+                           frame_index + 1, os.path.basename(self.path))
+            self.close()
+            return None
+        self._position += 1
+        return np.frombuffer(frame, dtype="uint8").reshape(self._dims + (3, )).copy()
+
+    def close(self):
+        """ Stop the open decoder """
+        if self._reader is None:
+            return
+        logger.trace("Closing decoder")
+        self._reader.close()
+        self._reader = None
+        self._position = None
@@ -28,6 +28,8 @@ class Output():
         # Methods for making sure frames are written out in frame order
         self.re_search = re.compile(r"(\d+)(?=\.\w+$)")  # Identify frame numbers
         self.cache = dict()  # Cache for when frames must be written in correct order
+        self.cache_peak = 0  # Largest number of frames held in the cache
+        self.frames_written = 0  # Number of frames written out from the cache
         logger.debug("Initialized %s", self.__class__.__name__)
 
     @property
@@ -52,6 +54,7 @@ class Output():
         """ Add the incoming frame to the cache """
         frame_no = int(re.search(self.re_search, filename).group())
         self.cache[frame_no] = image
+        self.cache_peak = max(self.cache_peak, len(self.cache))
         logger.trace("Added to cache. Frame no: %s", frame_no)
         logger.trace("Current cache: %s", sorted(self.cache.keys()))
 
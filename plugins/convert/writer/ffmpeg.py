@@ -1,13 +1,19 @@
 #!/usr/bin/env python3
 """ Video output writer for faceswap.py converter """
 import os
-from collections import OrderedDict
+import queue
+import subprocess
+from collections import deque, OrderedDict
 from math import ceil
 
+import cv2
 import imageio
 import imageio_ffmpeg as im_ffm
+import numpy as np
 from ffmpy import FFmpeg, FFRuntimeError
 
+from lib.multithreading import MultiThread
+from lib.utils import FaceswapError
 from ._base import Output, logger
 
 
@@ -20,7 +26,8 @@ class Writer(Output):
         self.source_video = source_video
         self.frame_ranges = frame_ranges
         self.frame_order = self.set_frame_order(total_count)
-        self.output_dimensions = None  # Fix dims of 1st frame in case of different sized images
+        self.frame_dims = None  # Fix dims of 1st frame in case of different sized images
+        self.output_dimensions = None
         self.writer = None  # Need to know dimensions of first frame, so set writer then
 
     @property
@@ -81,20 +88,43 @@ class Writer(Output):
         logger.debug(output_args)
         return output_args
 
+    @property
+    def pipe_command(self):
+        """ FFMPEG command for encoding raw BGR frames from stdin, mapping the audio stream
+            from the source video, if it has one, in the same pass """
+        exe = im_ffm.get_ffmpeg_exe()
+        command = [exe, "-hide_banner", "-nostats", "-v", "error", "-y",
+                   "-f", "rawvideo",
+                   "-pix_fmt", "bgr24",
+                   "-s", "{}x{}".format(self.frame_dims[1], self.frame_dims[0]),
+                   "-r", str(self.video_fps),
+                   "-i", "-"]
+        if self.frame_ranges is None:
+            command.extend(["-i", self.source_video, "-map", "0:v:0", "-map", "1:a:0?",
+                            "-c:a", "copy"])
+        else:
+            self.warn_no_audio()
+        command.extend(self.output_params)
+        command.extend(["-pix_fmt", "yuv420p", self.video_file])
+        logger.debug(command)
+        return command
+
     def set_frame_order(self, total_count):
         """ Return the full list of frames to be converted in order """
         if self.frame_ranges is None:
-            retval = list(range(1, total_count + 1))
+            retval = deque(range(1, total_count + 1))
         else:
-            retval = list()
+            retval = deque()
             for rng in self.frame_ranges:
-                retval.extend(list(range(rng[0], rng[1] + 1)))
+                retval.extend(range(rng[0], rng[1] + 1))
         logger.debug("frame_order: %s", retval)
         return retval
 
     def get_writer(self):
         """ Add the requested encoding options and return the writer """
         logger.debug("writer config: %s", self.config)
+        if self.config["pipe"]:
+            return FFmpegPipe(self.pipe_command)
         return imageio.get_writer(self.video_tmp_file,
                                   fps=self.video_fps,
                                   ffmpeg_log_level="error",
@@ -110,6 +140,9 @@ class Writer(Output):
             logger.info("Outputting to: '%s'", self.video_file)
             self.set_dimensions(image.shape[:2])
             self.writer = self.get_writer()
+        if self.config["pipe"] and image.shape[:2] != self.frame_dims:
+            image = cv2.resize(image,  # pylint: disable=no-member
+                               (self.frame_dims[1], self.frame_dims[0]))
         self.cache_frame(filename, image)
         self.save_from_cache()
 
@@ -118,6 +151,7 @@ class Writer(Output):
             sized images coming in and ensure all images go out at the same size for writers
             that require it and mapped to a macro block size 16"""
         logger.debug("input dimensions: %s", frame_dims)
+        self.frame_dims = frame_dims
         self.output_dimensions = "{}:{}".format(
             int(ceil(frame_dims[1] / 16) * 16),
             int(ceil(frame_dims[0] / 16) * 16))
@@ -129,16 +163,26 @@ class Writer(Output):
             if self.frame_order[0] not in self.cache:
                 logger.trace("Next frame not ready. Continuing")
                 break
-            save_no = self.frame_order.pop(0)
+            save_no = self.frame_order.popleft()
             save_image = self.cache.pop(save_no)
             logger.trace("Rendering from cache. Frame no: %s", save_no)
-            self.writer.append_data(save_image[:, :, ::-1])
+            self.writer.append_data(save_image if self.config["pipe"] else save_image[:, :, ::-1])
+            self.frames_written += 1
         logger.trace("Current cache size: %s", len(self.cache))
 
     def close(self):
         """ Close the ffmpeg writer and mux the audio """
+        logger.info("Peak reorder buffer: %s frames", self.cache_peak)
         self.writer.close()
-        self.mux_audio()
+        if not self.config["pipe"]:
+            self.mux_audio()
+
+    @staticmethod
+    def warn_no_audio():
+        """ Warn that audio cannot be muxed for frame ranges """
+        logger.warning("Muxing audio is not currently supported for limited frame ranges."
+                       "The output video has been created but you will need to mux audio "
+                       "yourself")
 
     def mux_audio(self):
         """ Mux audio
@@ -147,9 +191,7 @@ class Writer(Output):
             A future fix could be implemented to mux audio with the frames """
         logger.info("Muxing Audio...")
         if self.frame_ranges is not None:
-            logger.warning("Muxing audio is not currently supported for limited frame ranges."
-                           "The output video has been created but you will need to mux audio "
-                           "yourself")
+            self.warn_no_audio()
             os.rename(self.video_tmp_file, self.video_file)
             logger.debug("Removing temp file")
             if os.path.isfile(self.video_tmp_file):
@@ -183,3 +225,64 @@ class Writer(Output):
         logger.debug("Removing temp file")
         if os.path.isfile(self.video_tmp_file):
             os.remove(self.video_tmp_file)
+
+
+class FFmpegPipe():
+    """ Pipe raw BGR frames into an FFmpeg subprocess.
+
+        Frames are written to FFmpeg's stdin from a background thread, so that the caller is
+        not blocked whilst FFmpeg encodes, with up to buffer_size frames queued """
+    def __init__(self, command, buffer_size=8):
+        logger.debug("Initializing %s: (command: %s, buffer_size: %s)",
+                     self.__class__.__name__, command, buffer_size)
+        self.process = subprocess.Popen(command,
+                                        stdin=subprocess.PIPE,
+                                        stderr=subprocess.PIPE)
+        self.queue = queue.Queue(maxsize=buffer_size)
+        self.thread = MultiThread(self.feed, thread_count=1, name="ffmpeg_pipe")
+        self.thread.start()
+        logger.debug("Initialized %s", self.__class__.__name__)
+
+    def feed(self):
+        """ Write queued frames to FFmpeg until a None is received """
+        while True:
+            frame = self.queue.get()
+            if frame is None:
+                break
+            self.process.stdin.write(frame.data)
+        self.process.stdin.close()
+
+    def append_data(self, frame):
+        """ Queue a BGR frame to be written to FFmpeg """
+        frame = np.ascontiguousarray(frame)
+        while True:
+            try:
+                self.thread.check_and_raise_error()
+            except (BrokenPipeError, OSError) as err:
+                logger.debug("Error writing to FFmpeg: %s", str(err))
+                self.raise_error()
+            try:
+                self.queue.put(frame, timeout=1)
+                break
+            except queue.Full:
+                continue
+
+    def close(self):
+        """ Flush the remaining frames and wait for FFmpeg to finish """
+        logger.debug("Closing FFmpeg pipe")
+        if self.thread.has_error:
+            logger.debug("Error writing to FFmpeg: %s", self.thread.errors)
+            self.raise_error()
+        self.queue.put(None)
+        self.thread.join()
+        if self.process.wait() != 0:
+            self.raise_error()
+        logger.debug("Closed FFmpeg pipe")
+
+    def raise_error(self):
+        """ Raise FFmpeg's error output once the process has exited """
+        self.process.kill()
+        returncode = self.process.wait()
+        stderr = self.process.stderr.read().decode("utf-8", errors="replace").strip()
+        raise FaceswapError("FFmpeg failed to encode the video (exit code {}): "
+                            "{}".format(returncode, stderr))
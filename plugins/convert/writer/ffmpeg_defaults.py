@@ -45,6 +45,20 @@ _HELPTEXT = "Options for encoding converted frames to video."
 
 
 _DEFAULTS = {
+    "pipe": {
+        "default": True,
+        "info": "Pipe frames straight into FFmpeg and copy the audio from the source video in "
+                "the same pass. This avoids writing a temporary video file and then reading it "
+                "back to add the audio.\nDisable to encode through ImageIO and mux the audio "
+                "afterwards.",
+        "datatype": bool,
+        "rounding": None,
+        "min_max": None,
+        "choices": [],
+        "gui_radio": False,
+        "group": "settings",
+        "fixed": True,
+    },
     "container": {
         "default": "mp4",
         "info": "Video container to use.",
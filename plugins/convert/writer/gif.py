@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
 """ Animated GIF writer for faceswap.py converter """
 import os
+from collections import deque
 
 import cv2
 import imageio
@@ -29,11 +30,11 @@ class Writer(Output):
     def set_frame_order(total_count, frame_ranges):
         """ Return the full list of frames to be converted in order """
         if frame_ranges is None:
-            retval = list(range(1, total_count + 1))
+            retval = deque(range(1, total_count + 1))
         else:
-            retval = list()
+            retval = deque()
             for rng in frame_ranges:
-                retval.extend(list(range(rng[0], rng[1] + 1)))
+                retval.extend(range(rng[0], rng[1] + 1))
         logger.debug("frame_order: %s", retval)
         return retval
 
@@ -83,12 +84,14 @@ class Writer(Output):
             if self.frame_order[0] not in self.cache:
                 logger.trace("Next frame not ready. Continuing")
                 break
-            save_no = self.frame_order.pop(0)
+            save_no = self.frame_order.popleft()
             save_image = self.cache.pop(save_no)
             logger.trace("Rendering from cache. Frame no: %s", save_no)
             self.writer.append_data(save_image[:, :, ::-1])
+            self.frames_written += 1
         logger.trace("Current cache size: %s", len(self.cache))
 
     def close(self):
         """ Close the ffmpeg writer and mux the audio """
+        logger.info("Peak reorder buffer: %s frames", self.cache_peak)
         self.writer.close()
@@ -28,10 +28,16 @@ import cv2
 from lib.aligner import Extract
 from lib.gpu_stats import GPUStats
 from lib.utils import GetModel
+from plugins.extract._config import Config
 
 logger = logging.getLogger(__name__)  # pylint:disable=invalid-name
 
 
+def get_config(plugin_name, configfile=None):
+    """ Return the config for the requested model """
+    return Config(plugin_name, configfile=configfile).config_dict
+
+
 class Aligner():
     """ Landmarks Aligner Object """
     def __init__(self, loglevel, configfile=None, normalize_method=None,
@@ -40,6 +46,7 @@ class Aligner():
                      "git_model_id: %s, model_filename: '%s', colorspace: '%s'. input_size: %s)",
                      self.__class__.__name__, loglevel, configfile, normalize_method, git_model_id,
                      model_filename, colorspace, input_size)
+        self.config = get_config(".".join(self.__module__.split(".")[-2:]), configfile=configfile)
         self.loglevel = loglevel
         self.normalize_method = normalize_method
         self.colorspace = colorspace.upper()
@@ -52,6 +59,10 @@ class Aligner():
         # See lib.queue_manager.QueueManager for getting queues
         self.queues = {"in": None, "out": None}
 
+        # Shared memory pool that frames are passed through, if used.
+        # See lib.multithreading.SharedFramePool
+        self.frame_pool = None
+
         #  Get model if required
         self.model_path = self.get_model(git_model_id, model_filename)
 
@@ -63,6 +74,10 @@ class Aligner():
         # Set to true if the plugin supports PlaidML
         self.supports_plaidml = False
 
+        # The maximum number of faces to predict landmarks for in one pass. Faces are
+        # gathered from frames already waiting in the queue up to this number.
+        self.batch_size = 1
+
         logger.debug("Initialized %s", self.__class__.__name__)
 
     # <<< OVERRIDE METHODS >>> #
@@ -77,6 +92,7 @@ class Aligner():
         self.error = kwargs["error"]
         self.queues["in"] = kwargs["in_queue"]
         self.queues["out"] = kwargs["out_queue"]
+        self.frame_pool = kwargs.get("frame_pool", None)
 
     def align_image(self, detected_face, image):
         """ Align the incoming image for feeding into aligner
@@ -125,29 +141,71 @@ class Aligner():
         """ Process landmarks """
         if not self.init:
             self.initialize(*args, **kwargs)
-        logger.debug("Launching Align: (args: %s kwargs: %s)", args, kwargs)
+        logger.debug("Launching Align: (args: %s kwargs: %s, batch_size: %s)",
+                     args, kwargs, self.batch_size)
 
-        for item in self.get_item():
-            if item == "EOF":
+        for batch in self.get_batch():
+            logger.trace("Aligning faces")
+            self.process_batch(batch)
+            for item in batch:
                 self.finalize(item)
-                break
-            image = self.convert_color(item["image"])
+        self.finalize("EOF")
+        logger.debug("Completed Align")
 
-            logger.trace("Aligning faces")
+    def process_batch(self, batch):
+        """ Align the faces for a batch of frames, predicting the landmarks for the faces of
+            every frame together, and add the landmarks to each frame """
+        feed_dicts = list()
+        face_counts = list()
+        for item in batch:
             try:
-                item["landmarks"] = self.process_landmarks(image, item["detected_faces"])
-                logger.trace("Aligned faces: %s", item["landmarks"])
+                image = self.convert_color(item["image"])
+                feeds = [self.align_image(detected_face, image)
+                         for detected_face in item["detected_faces"]]
+                for feed_dict in feeds:
+                    self.normalize_face(feed_dict)
             except ValueError as err:
-                logger.warning("Image '%s' could not be processed. This may be due to corrupted "
-                               "data: %s", item["filename"], str(err))
-                item["detected_faces"] = list()
-                item["landmarks"] = list()
-                # UNCOMMENT THIS CODE BLOCK TO PRINT TRACEBACK ERRORS
-                # import sys
-                # exc_info = sys.exc_info()
-                # traceback.print_exception(*exc_info)
-            self.finalize(item)
-        logger.debug("Completed Align")
+                self.drop_faces(item, err)
+                feeds = list()
+            feed_dicts.extend(feeds)
+            face_counts.append(len(feeds))
+
+        try:
+            landmarks = list()
+            for idx in range(0, len(feed_dicts), self.batch_size):
+                landmarks.extend(
+                    self.predict_landmarks_batch(feed_dicts[idx:idx + self.batch_size]))
+        except ValueError:
+            # Fall back to predicting a frame at a time so only the failing frame is dropped
+            logger.trace("Batch could not be processed. Processing frames individually")
+            landmarks = list()
+            remaining = feed_dicts
+            for item, count in zip(batch, face_counts):
+                feeds, remaining = remaining[:count], remaining[count:]
+                try:
+                    landmarks.extend(self.predict_landmarks_batch(feeds))
+                except ValueError as err:
+                    self.drop_faces(item, err)
+                    landmarks.extend([None] * count)
+
+        for item, count in zip(batch, face_counts):
+            frame_landmarks, landmarks = landmarks[:count], landmarks[count:]
+            if None in frame_landmarks:
+                continue
+            item["landmarks"] = frame_landmarks
+            logger.trace("Aligned faces: %s", item["landmarks"])
+
+    @staticmethod
+    def drop_faces(item, err):
+        """ Remove the faces from a frame that could not be processed """
+        logger.warning("Image '%s' could not be processed. This may be due to corrupted "
+                       "data: %s", item["filename"], str(err))
+        item["detected_faces"] = list()
+        item["landmarks"] = list()
+        # UNCOMMENT THIS CODE BLOCK TO PRINT TRACEBACK ERRORS
+        # import sys
+        # exc_info = sys.exc_info()
+        # traceback.print_exception(*exc_info)
 
     def convert_color(self, image):
         """ Convert the image to the correct colorspace """
@@ -160,17 +218,10 @@ class Aligner():
             cvt_image = image.copy()
         return cvt_image
 
-    def process_landmarks(self, image, detected_faces):
-        """ Align image and process landmarks """
-        logger.trace("Processing landmarks")
-        retval = list()
-        for detected_face in detected_faces:
-            feed_dict = self.align_image(detected_face, image)
-            self.normalize_face(feed_dict)
-            landmarks = self.predict_landmarks(feed_dict)
-            retval.append(landmarks)
-        logger.trace("Processed landmarks: %s", retval)
-        return retval
+    def predict_landmarks_batch(self, feed_dicts):
+        """ Predict the landmarks for a list of aligned faces.
+            Override for plugins which can predict a batch in a single pass """
+        return [self.predict_landmarks(feed_dict) for feed_dict in feed_dicts]
 
     # <<< FACE NORMALIZATION METHODS >>> #
     def normalize_face(self, feed_dict):
@@ -219,6 +270,8 @@ class Aligner():
         logger.trace("Item out: %s", {key: val
                                       for key, val in output.items()
                                       if key != "image"})
+        if self.frame_pool is not None:
+            self.frame_pool.put_frame(output)
         self.queues["out"].put((output))
 
     # <<< MISC METHODS >>> #
@@ -232,6 +285,27 @@ class Aligner():
                        int(vram["total"]))
         return int(vram["card_id"]), int(vram["free"]), int(vram["total"])
 
+    def get_batch(self):
+        """ Yield lists of frames from the queue.
+
+            Frames that are already waiting in the queue are added to the batch until it holds
+            batch_size faces, so that frames are never held back waiting for more to arrive """
+        batch = list()
+        faces = 0
+        for item in self.get_item():
+            if item == "EOF":
+                break
+            batch.append(item)
+            faces += len(item["detected_faces"])
+            if faces < self.batch_size and not self.queues["in"].empty():
+                continue
+            logger.trace("Returning batch: (frames: %s, faces: %s)", len(batch), faces)
+            yield batch
+            batch = list()
+            faces = 0
+        if batch:
+            yield batch
+
     def get_item(self):
         """ Yield one item from the queue """
         while True:
@@ -244,6 +318,8 @@ class Aligner():
                 if item.get("exception", None):
                     self.queues["out"].put(item)
                     exit(1)
+                if self.frame_pool is not None:
+                    self.frame_pool.get_frame(item)
             else:
                 logger.trace("Item in: %s", item)
             yield item
@@ -50,6 +50,8 @@ class Align(Aligner):
             logger.info("Initializing cv2 DNN Aligner...")
             logger.debug("cv2 DNN initialize: (args: %s kwargs: %s)", args, kwargs)
             logger.verbose("Using CPU for alignment")
+            self.batch_size = self.config["batch-size"]
+            logger.verbose("Aligning in batches of up to %s faces", self.batch_size)
 
             self.model = cv2.dnn.readNetFromTensorflow(  # pylint: disable=no-member
                 self.model_path)
@@ -168,6 +170,18 @@ class Align(Aligner):
         pts_img = self.get_pts_from_predict(prediction, feed_dict["roi"])
         return pts_img
 
+    def predict_landmarks_batch(self, feed_dicts):
+        """ Predict the 68 point landmarks for a batch of faces """
+        logger.trace("Predicting Landmarks for %s faces", len(feed_dicts))
+        if not feed_dicts:
+            return list()
+        images = np.array([np.transpose(feed_dict["image"], (2, 0, 1))
+                           for feed_dict in feed_dicts], dtype="float32")
+        self.model.setInput(images)
+        predictions = self.model.forward()
+        return [self.get_pts_from_predict(prediction, feed_dict["roi"])
+                for prediction, feed_dict in zip(predictions, feed_dicts)]
+
     @staticmethod
     def get_pts_from_predict(prediction, roi):
         """ Get points from predictor """
@@ -20,6 +20,7 @@ class Align(Aligner):
                          input_size=256,
                          **kwargs)
         self.vram = 2240
+        self.vram_per_face = 128  # Added for each face in a batch beyond the first
         self.model = None
         self.reference_scale = 195
 
@@ -29,14 +30,23 @@ class Align(Aligner):
             super().initialize(*args, **kwargs)
             logger.info("Initializing Face Alignment Network...")
             logger.debug("fan initialize: (args: %s kwargs: %s)", args, kwargs)
-
-            _, _, vram_total = self.get_vram_free()
-
-            if vram_total <= self.vram:
+            self.batch_size = self.config["batch-size"]
+
+            card_id, vram_free, vram_total = self.get_vram_free()
+            if card_id != -1:
+                fits = 1 + max(0, vram_free - self.vram) // self.vram_per_face
+                if fits < self.batch_size:
+                    logger.warning("Not enough VRAM free to align in batches of %s faces. "
+                                   "Reducing batch size to %s", self.batch_size, fits)
+                    self.batch_size = fits
+            logger.verbose("Aligning in batches of up to %s faces", self.batch_size)
+
+            vram = self.vram + self.vram_per_face * (self.batch_size - 1)
+            if vram_total <= vram:
                 tf_ratio = 1.0
             else:
-                tf_ratio = self.vram / vram_total
-            logger.verbose("Reserving %sMB for face alignments", self.vram)
+                tf_ratio = vram / vram_total
+            logger.verbose("Reserving %sMB for face alignments", vram)
 
             self.model = FAN(self.model_path, ratio=tf_ratio)
 
@@ -149,6 +159,23 @@ class Align(Aligner):
         logger.trace("Predicted Landmarks: %s", retval)
         return retval
 
+    def predict_landmarks_batch(self, feed_dicts):
+        """ Predict the 68 point landmarks for a batch of faces """
+        logger.trace("Predicting Landmarks for %s faces", len(feed_dicts))
+        if not feed_dicts:
+            return list()
+        images = np.array([feed_dict["image"].transpose((2, 0, 1))
+                           for feed_dict in feed_dicts], dtype=np.float32) / 255.0
+        predictions = self.model.predict(images)
+        retval = list()
+        for prediction, feed_dict in zip(predictions, feed_dicts):
+            pts_img = self.get_pts_from_predict(prediction,
+                                                feed_dict["center"],
+                                                feed_dict["scale"])
+            retval.append([(int(pt[0]), int(pt[1])) for pt in pts_img])
+        logger.trace("Predicted Landmarks: %s", retval)
+        return retval
+
     def get_pts_from_predict(self, prediction, center, scale):
         """ Get points from predictor """
         logger.trace("Obtain points from prediction")
@@ -32,6 +32,8 @@ class Align(Aligner):
             super().initialize(*args, **kwargs)
             logger.info("Initializing Face Alignment Network...")
             logger.debug("fan initialize: (args: %s kwargs: %s)", args, kwargs)
+            self.batch_size = self.config["batch-size"]
+            logger.verbose("Aligning in batches of up to %s faces", self.batch_size)
             self.model = FAN(self.model_path)
             self.init.set()
             logger.info("Initialized Face Alignment Network.")
@@ -142,6 +144,23 @@ class Align(Aligner):
         logger.trace("Predicted Landmarks: %s", retval)
         return retval
 
+    def predict_landmarks_batch(self, feed_dicts):
+        """ Predict the 68 point landmarks for a batch of faces """
+        logger.trace("Predicting Landmarks for %s faces", len(feed_dicts))
+        if not feed_dicts:
+            return list()
+        images = np.array([feed_dict["image"].transpose((2, 0, 1))
+                           for feed_dict in feed_dicts], dtype=np.float32) / 255.0
+        predictions = self.model.predict(images)
+        retval = list()
+        for prediction, feed_dict in zip(predictions, feed_dicts):
+            pts_img = self.get_pts_from_predict(prediction,
+                                                feed_dict["center"],
+                                                feed_dict["scale"])
+            retval.append([(int(pt[0]), int(pt[1])) for pt in pts_img])
+        logger.trace("Predicted Landmarks: %s", retval)
+        return retval
+
     def get_pts_from_predict(self, prediction, center, scale):
         """ Get points from predictor """
         logger.trace("Obtain points from prediction")
@@ -268,4 +287,4 @@ class FAN():
     def predict(self, feed_item):
         """ Predict landmarks in session """
         pred = self.model.predict(feed_item)
-        return [pred[-1].reshape((68, 64, 64))]
+        return pred[-1].reshape((-1, 68, 64, 64))
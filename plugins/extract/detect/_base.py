@@ -17,6 +17,7 @@ import logging
 import os
 import traceback
 from io import StringIO
+from time import time
 
 import cv2
 
@@ -52,6 +53,10 @@ class Detector():
         # See lib.queue_manager.QueueManager for getting queues
         self.queues = {"in": None, "out": None}
 
+        # Shared memory pool that frames are passed through, if used.
+        # See lib.multithreading.SharedFramePool
+        self.frame_pool = None
+
         #  Path to model if required
         self.model_path = self.get_model(git_model_id, model_filename)
 
@@ -72,6 +77,9 @@ class Detector():
         # will support. It is also used for holding the number of threads/
         # processes for parallel processing plugins
         self.batch_size = 1
+
+        # The number of frames passed to finalize, for reporting detection speed
+        self.frames_processed = 0
         logger.debug("Initialized _base %s", self.__class__.__name__)
 
     # <<< OVERRIDE METHODS >>> #
@@ -85,6 +93,7 @@ class Detector():
         self.error = kwargs.get("error", False)
         self.queues["in"] = kwargs["in_queue"]
         self.queues["out"] = kwargs["out_queue"]
+        self.frame_pool = kwargs.get("frame_pool", None)
 
     def detect_faces(self, *args, **kwargs):
         """ Detect faces in rgb image
@@ -150,10 +159,19 @@ class Detector():
             ]
             if self.min_size > 0 and output.get("detected_faces", None):
                 output["detected_faces"] = self.filter_small_faces(output["detected_faces"])
+            self.frames_processed += 1
+            if self.frame_pool is not None:
+                self.frame_pool.put_frame(output)
         else:
             logger.trace("Item out: %s", output)
         self.queues["out"].put(output)
 
+    def log_speed(self, start_time):
+        """ Log the number of frames detected per second since the given start time """
+        elapsed = max(time() - start_time, 1e-6)
+        logger.verbose("Detected faces in %s frames at %.2f frames/sec",
+                       self.frames_processed, self.frames_processed / elapsed)
+
     def filter_small_faces(self, detected_faces):
         """ Filter out any faces smaller than the min size threshold """
         retval = list()
@@ -274,6 +292,36 @@ class Detector():
         logger.debug("Rotation Angles: %s", rotation_angles)
         return rotation_angles
 
+    def predict_rotated_batch(self, images, predict_batch, has_faces):
+        """ Run a batch of detection images through predict_batch at each rotation angle.
+
+            Images are stacked with other images of the same shape so that each call to
+            predict_batch receives a list of identically sized images and must return a list
+            of results. Images for which has_faces(result) is False are retried at the next
+            rotation angle.
+
+            Returns a list of (result, rotation_matrix) for each image """
+        retval = [None for _ in images]
+        remaining = list(range(len(images)))
+        for angle in self.rotation:
+            if not remaining:
+                break
+            rotated = {idx: self.rotate_image(images[idx], angle) for idx in remaining}
+            groups = dict()
+            for idx in remaining:
+                groups.setdefault(rotated[idx][0].shape, list()).append(idx)
+            for indices in groups.values():
+                logger.trace("Predicting batch: (angle: %s, size: %s)", angle, len(indices))
+                results = predict_batch([rotated[idx][0] for idx in indices])
+                for idx, result in zip(indices, results):
+                    retval[idx] = (result, rotated[idx][1])
+            found = [idx for idx in remaining if has_faces(retval[idx][0])]
+            if angle != 0 and found:
+                logger.verbose("found face(s) by rotating %s image(s) %s degrees",
+                               len(found), angle)
+            remaining = [idx for idx in remaining if idx not in found]
+        return retval
+
     def rotate_image(self, image, angle):
         """ Rotate the image by given angle and return
             Image with rotation matrix """
@@ -321,6 +369,8 @@ class Detector():
         item = self.queues["in"].get()
         if isinstance(item, dict):
             logger.trace("Item in: %s", item["filename"])
+            if self.frame_pool is not None:
+                self.frame_pool.get_frame(item)
         else:
             logger.trace("Item in: %s", item)
         if item == "EOF":
@@ -4,6 +4,7 @@
 from __future__ import absolute_import, division, print_function
 
 import os
+from time import time
 
 from six import string_types, iteritems
 
@@ -105,7 +106,12 @@ class Detect(Detector):
                 raise ValueError("Insufficient VRAM available to continue "
                                  "({}MB)".format(int(alloc)))
 
-            logger.verbose("Processing in %s threads", self.batch_size)
+            if self.config["batch-mode"]:
+                if not is_gpu:
+                    self.batch_size = self.config["cpu-batch-size"]
+                logger.verbose("Processing in batches of %s", self.batch_size)
+            else:
+                logger.verbose("Processing in %s threads", self.batch_size)
 
             self.kwargs["pnet"] = pnet
             self.kwargs["rnet"] = rnet
@@ -118,15 +124,45 @@ class Detect(Detector):
             raise err
 
     def detect_faces(self, *args, **kwargs):
-        """ Detect faces in Multiple Threads """
+        """ Detect faces in batches or in Multiple Threads """
         super().detect_faces(*args, **kwargs)
-        workers = MultiThread(target=self.detect_thread, thread_count=self.batch_size)
-        workers.start()
-        workers.join()
+        start_time = time()
+        if self.config["batch-mode"]:
+            self.detect_batches()
+        else:
+            workers = MultiThread(target=self.detect_thread, thread_count=self.batch_size)
+            workers.start()
+            workers.join()
         sentinel = self.queues["in"].get()
         self.queues["out"].put(sentinel)
+        self.log_speed(start_time)
         logger.debug("Detecting Faces complete")
 
+    def detect_batches(self):
+        """ Detect faces in batches, running each stage of the network once per batch.
+            Images are batched with other images of the same detection size """
+        logger.debug("Launching Detect")
+        while True:
+            exhausted, batch = self.get_batch()
+            if batch:
+                logger.trace("Detecting faces: %s", [item["filename"] for item in batch])
+                detect_images = [self.compile_detection_image(item["image"], to_rgb=True)
+                                 for item in batch]
+                results = self.predict_rotated_batch(
+                    [image[0] for image in detect_images],
+                    lambda images: detect_face_batch(images, **self.kwargs),
+                    lambda result: result[0].any())
+                for item, detect_image, (result, rotmat) in zip(batch, detect_images, results):
+                    faces, points = result
+                    item["detected_faces"] = self.process_output(faces,
+                                                                 points,
+                                                                 rotmat,
+                                                                 detect_image[1])
+                    self.finalize(item)
+            if exhausted:
+                break
+        logger.debug("Completed Detect")
+
     def detect_thread(self):
         """ Detect faces in rgb image """
         logger.debug("Launching Detect")
@@ -669,6 +705,154 @@ def detect_face(img, minsize, pnet, rnet,  # pylint: disable=too-many-arguments
     return total_boxes, points
 
 
+def detect_face_batch(images, minsize, pnet, rnet,  # pylint: disable=too-many-arguments
+                      onet, threshold, factor):
+    """Detects faces in a batch of images of the same size, running each network once per
+    stage for the whole batch rather than once per image.
+    Returns a list of (bounding boxes, points) for each image, as returned by detect_face.
+    """
+    # pylint: disable=too-many-locals
+    height, width = images[0].shape[:2]
+    minl = np.amin([height, width])
+    var_m = 12.0 / minsize
+    minl = minl * var_m
+    # create scale pyramid
+    scales = []
+    factor_count = 0
+    while minl >= 12:
+        scales += [var_m * np.power(factor, factor_count)]
+        minl = minl * factor
+        factor_count += 1
+
+    # first stage - fast proposal network (pnet) to obtain face candidates
+    all_boxes = [np.empty((0, 9)) for _ in images]
+    for scale in scales:
+        height_scale = int(np.ceil(height * scale))
+        width_scale = int(np.ceil(width * scale))
+        im_data = np.array([imresample(img, (height_scale, width_scale)) for img in images])
+        im_data = (im_data - 127.5) * 0.0078125
+        out = pnet(np.transpose(im_data, (0, 2, 1, 3)))
+        out0 = np.transpose(out[0], (0, 2, 1, 3))
+        out1 = np.transpose(out[1], (0, 2, 1, 3))
+        for idx, total_boxes in enumerate(all_boxes):
+            boxes, _ = generate_bounding_box(out1[idx, :, :, 1].copy(),
+                                             out0[idx, :, :, :].copy(),
+                                             scale, threshold[0])
+            # inter-scale nms
+            pick = nms(boxes.copy(), 0.5, 'Union')
+            if boxes.size > 0 and pick.size > 0:
+                boxes = boxes[pick, :]
+                all_boxes[idx] = np.append(total_boxes, boxes, axis=0)
+
+    for idx, total_boxes in enumerate(all_boxes):
+        if total_boxes.shape[0] == 0:
+            continue
+        pick = nms(total_boxes.copy(), 0.7, 'Union')
+        total_boxes = total_boxes[pick, :]
+        regw = total_boxes[:, 2]-total_boxes[:, 0]
+        regh = total_boxes[:, 3]-total_boxes[:, 1]
+        qq_1 = total_boxes[:, 0]+total_boxes[:, 5] * regw
+        qq_2 = total_boxes[:, 1]+total_boxes[:, 6] * regh
+        qq_3 = total_boxes[:, 2]+total_boxes[:, 7] * regw
+        qq_4 = total_boxes[:, 3]+total_boxes[:, 8] * regh
+        total_boxes = np.transpose(np.vstack([qq_1, qq_2, qq_3, qq_4, total_boxes[:, 4]]))
+        total_boxes = rerec(total_boxes.copy())
+        total_boxes[:, 0:4] = np.fix(total_boxes[:, 0:4]).astype(np.int32)
+        all_boxes[idx] = total_boxes
+
+    # second stage - refinement of face candidates with rnet
+    for idx, (total_boxes, out) in enumerate(zip(all_boxes,
+                                                 run_candidates(images, all_boxes, 24, rnet))):
+        if out is None:
+            all_boxes[idx] = total_boxes[:0]
+            continue
+        out0 = np.transpose(out[0])
+        out1 = np.transpose(out[1])
+        score = out1[1, :]
+        ipass = np.where(score > threshold[1])
+        total_boxes = np.hstack([total_boxes[ipass[0], 0:4].copy(),
+                                 np.expand_dims(score[ipass].copy(), 1)])
+        m_v = out0[:, ipass[0]]
+        if total_boxes.shape[0] > 0:
+            pick = nms(total_boxes, 0.7, 'Union')
+            total_boxes = total_boxes[pick, :]
+            total_boxes = bbreg(total_boxes.copy(), np.transpose(m_v[:, pick]))
+            total_boxes = rerec(total_boxes.copy())
+        all_boxes[idx] = total_boxes
+
+    # third stage - further refinement and facial landmarks positions with onet
+    all_boxes = [np.fix(total_boxes).astype(np.int32) if total_boxes.shape[0] > 0
+                 else total_boxes for total_boxes in all_boxes]
+    retval = list()
+    for total_boxes, out in zip(all_boxes, run_candidates(images, all_boxes, 48, onet)):
+        if out is None:
+            retval.append((total_boxes[:0], np.empty(0)))
+            continue
+        out0 = np.transpose(out[0])
+        out1 = np.transpose(out[1])
+        out2 = np.transpose(out[2])
+        score = out2[1, :]
+        points = out1
+        ipass = np.where(score > threshold[2])
+        points = points[:, ipass[0]]
+        total_boxes = np.hstack([total_boxes[ipass[0], 0:4].copy(),
+                                 np.expand_dims(score[ipass].copy(), 1)])
+        m_v = out0[:, ipass[0]]
+
+        box_width = total_boxes[:, 2] - total_boxes[:, 0] + 1
+        box_height = total_boxes[:, 3] - total_boxes[:, 1] + 1
+        points[0:5, :] = (np.tile(box_width, (5, 1)) * points[0:5, :] +
+                          np.tile(total_boxes[:, 0], (5, 1)) - 1)
+        points[5:10, :] = (np.tile(box_height, (5, 1)) * points[5:10, :] +
+                           np.tile(total_boxes[:, 1], (5, 1)) - 1)
+        if total_boxes.shape[0] > 0:
+            total_boxes = bbreg(total_boxes.copy(), np.transpose(m_v))
+            pick = nms(total_boxes.copy(), 0.7, 'Min')
+            total_boxes = total_boxes[pick, :]
+            points = points[:, pick]
+        retval.append((total_boxes, points))
+    return retval
+
+
+def run_candidates(images, all_boxes, size, net):
+    """ Crop the candidate boxes of every image to the given size and run them through the
+        given refinement network in a single pass.
+        Returns the network outputs for each image, or None for images without candidates.
+        Candidates for an image which cannot be cropped are discarded """
+    crops = [get_candidate_crops(img, total_boxes, size) if total_boxes.shape[0] > 0 else None
+             for img, total_boxes in zip(images, all_boxes)]
+    counts = [0 if crop is None else crop.shape[0] for crop in crops]
+    if not any(counts):
+        return [None for _ in images]
+    outputs = net(np.concatenate([crop for crop in crops if crop is not None]))
+    retval = list()
+    offset = 0
+    for count in counts:
+        retval.append(None if count == 0 else [out[offset:offset + count] for out in outputs])
+        offset += count
+    return retval
+
+
+def get_candidate_crops(img, total_boxes, size):
+    """ Return the normalized candidate crops of an image at the given size, or None if a
+        candidate falls outside of the image """
+    height, width = img.shape[:2]
+    numbox = total_boxes.shape[0]
+    d_y, ed_y, d_x, ed_x, var_y, e_y, var_x, e_x, tmpw, tmph = pad(total_boxes.copy(),
+                                                                   width, height)
+    tempimg = np.zeros((size, size, 3, numbox))
+    for k in range(0, numbox):
+        tmp = np.zeros((int(tmph[k]), int(tmpw[k]), 3))
+        tmp[d_y[k] - 1:ed_y[k], d_x[k] - 1:ed_x[k], :] = img[var_y[k] - 1:e_y[k],
+                                                             var_x[k] - 1:e_x[k], :]
+        if tmp.shape[0] > 0 and tmp.shape[1] > 0 or tmp.shape[0] == 0 and tmp.shape[1] == 0:
+            tempimg[:, :, :, k] = imresample(tmp, (size, size))
+        else:
+            return None
+    tempimg = (tempimg-127.5)*0.0078125
+    return np.transpose(tempimg, (3, 1, 0, 2))
+
+
 # function [boundingbox] = bbreg(boundingbox,reg)
 def bbreg(boundingbox, reg):
     """Calibrate bounding boxes"""
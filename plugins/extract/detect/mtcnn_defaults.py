@@ -104,4 +104,26 @@ _DEFAULTS = {
         "gui_radio": False,
         "fixed": True,
     },
+    "batch-mode": {
+        "default": True,
+        "info": "Stack frames together and run each batch through the model in a single pass. "
+                "The batch size is calculated from available VRAM.\n"
+                "Disable to fall back to running each frame through the model in its own "
+                "thread.",
+        "datatype": bool,
+        "choices": [],
+        "gui_radio": False,
+        "fixed": True,
+    },
+    "cpu-batch-size": {
+        "default": 4,
+        "info": "The number of frames to batch together when running on CPU with "
+                "batch-mode enabled.",
+        "datatype": int,
+        "rounding": 1,
+        "min_max": (1, 32),
+        "choices": [],
+        "gui_radio": False,
+        "fixed": True,
+    },
 }
@@ -6,6 +6,8 @@ Adapted from S3FD Port in FAN:
 https://github.com/1adrianb/face-alignment
 """
 
+from time import time
+
 from scipy.special import logsumexp
 
 import numpy as np
@@ -62,7 +64,12 @@ class Detect(Detector):
                 raise ValueError("Insufficient VRAM available to continue "
                                  "({}MB)".format(int(alloc)))
 
-            logger.verbose("Processing in %s threads", self.batch_size)
+            if self.config["batch-mode"]:
+                if not self.model.is_gpu:
+                    self.batch_size = self.config["cpu-batch-size"]
+                logger.verbose("Processing in batches of %s", self.batch_size)
+            else:
+                logger.verbose("Processing in %s threads", self.batch_size)
 
             self.init.set()
             logger.info("Initialized S3FD Detector.")
@@ -71,15 +78,41 @@ class Detect(Detector):
             raise err
 
     def detect_faces(self, *args, **kwargs):
-        """ Detect faces in Multiple Threads """
+        """ Detect faces in batches or in Multiple Threads """
         super().detect_faces(*args, **kwargs)
-        workers = MultiThread(target=self.detect_thread, thread_count=self.batch_size)
-        workers.start()
-        workers.join()
+        start_time = time()
+        if self.config["batch-mode"]:
+            self.detect_batches()
+        else:
+            workers = MultiThread(target=self.detect_thread, thread_count=self.batch_size)
+            workers.start()
+            workers.join()
         sentinel = self.queues["in"].get()
         self.queues["out"].put(sentinel)
+        self.log_speed(start_time)
         logger.debug("Detecting Faces complete")
 
+    def detect_batches(self):
+        """ Detect faces in batches of images, running each batch through the model in a single
+            pass. Images are scaled exactly as for the threaded path and are not padded, so
+            only images of the same scaled size are stacked together """
+        logger.debug("Launching Detect")
+        while True:
+            exhausted, batch = self.get_batch()
+            if batch:
+                logger.trace("Detecting faces: %s", [item["filename"] for item in batch])
+                detect_images = [self.compile_detection_image(item["image"], is_square=True)
+                                 for item in batch]
+                results = self.predict_rotated_batch([image[0] for image in detect_images],
+                                                     self.model.detect_face_batch,
+                                                     lambda faces: faces.any())
+                for item, detect_image, (faces, rotmat) in zip(batch, detect_images, results):
+                    item["detected_faces"] = self.process_output(faces, rotmat, detect_image[1])
+                    self.finalize(item)
+            if exhausted:
+                break
+        logger.debug("Completed Detect")
+
     def detect_thread(self):
         """ Detect faces in rgb image """
         logger.debug("Launching Detect")
@@ -180,6 +213,18 @@ class S3fd():
         feed_item = feed_item.transpose(2, 0, 1)
         feed_item = feed_item.reshape((1,) + feed_item.shape).astype('float32')
         bboxlist = self.session.run(self.output, feed_dict={self.input: feed_item})
+        return self.filter_detections(bboxlist)
+
+    def detect_face_batch(self, feed_items):
+        """ Detect faces in a list of identically sized images in a single pass """
+        feed_items = np.array(feed_items) - np.array([104.0, 117.0, 123.0])
+        feed_items = feed_items.transpose(0, 3, 1, 2).astype('float32')
+        bboxlists = self.session.run(self.output, feed_dict={self.input: feed_items})
+        return [self.filter_detections([output[idx:idx + 1] for output in bboxlists])
+                for idx in range(feed_items.shape[0])]
+
+    def filter_detections(self, bboxlist):
+        """ Post process the model output for one image and return the confident faces """
         bboxlist = self.post_process(bboxlist)
 
         keep = self.nms(bboxlist, 0.3)
@@ -8,7 +8,7 @@ so that the vram is released on subprocess exit """
 import logging
 
 from lib.gpu_stats import GPUStats
-from lib.multithreading import PoolProcess, SpawnProcess
+from lib.multithreading import PoolProcess, SharedFramePool, SpawnProcess
 from lib.queue_manager import queue_manager, QueueEmpty
 from plugins.plugin_loader import PluginLoader
 
@@ -24,18 +24,19 @@ class Extractor():
     """
     def __init__(self, detector, aligner, loglevel,
                  configfile=None, multiprocess=False, rotate_images=None, min_size=20,
-                 normalize_method=None):
+                 normalize_method=None, frame_bytes=0):
         logger.debug("Initializing %s: (detector: %s, aligner: %s, loglevel: %s, configfile: %s, "
                      "multiprocess: %s, rotate_images: %s, min_size: %s, "
-                     "normalize_method: %s)", self.__class__.__name__, detector, aligner,
-                     loglevel, configfile, multiprocess, rotate_images, min_size,
-                     normalize_method)
+                     "normalize_method: %s, frame_bytes: %s)", self.__class__.__name__,
+                     detector, aligner, loglevel, configfile, multiprocess, rotate_images,
+                     min_size, normalize_method, frame_bytes)
         self.phase = "detect"
         self.detector = self.load_detector(detector, loglevel, rotate_images, min_size, configfile)
         self.aligner = self.load_aligner(aligner, loglevel, configfile, normalize_method)
         self.is_parallel = self.set_parallel_processing(multiprocess)
         self.processes = list()
         self.queues = self.add_queues()
+        self.frame_pool = self.add_frame_pool(frame_bytes)
         logger.debug("Initialized %s", self.__class__.__name__)
 
     @property
@@ -156,6 +157,25 @@ class Extractor():
         logger.debug("Queues: %s", queues)
         return queues
 
+    def add_frame_pool(self, frame_bytes, ram_budget=2048):
+        """ Add a pool of shared memory slots for passing frames between processes.
+
+            Slots are sized to frame_bytes with as many slots as fit into ram_budget (MB),
+            between 16 and 64. Returns None if frame_bytes is unknown or the detector runs in
+            a process pool, which cannot inherit shared memory """
+        if not frame_bytes or self.detector.parent_is_pool:
+            logger.debug("Not using shared frame pool: (frame_bytes: %s, parent_is_pool: %s)",
+                         frame_bytes, self.detector.parent_is_pool)
+            return None
+        slots = min(64, max(16, (ram_budget * 1024 * 1024) // frame_bytes))
+        logger.verbose("Allocating %s shared frame slots (%sMB)",
+                       slots, (slots * frame_bytes) // (1024 * 1024))
+        queue_manager.add_queue("extract_frame_pool", maxsize=slots)
+        frame_pool = SharedFramePool(frame_bytes,
+                                     slots,
+                                     queue_manager.get_queue("extract_frame_pool"))
+        return frame_pool
+
     def launch(self):
         """ Launches the plugins
             This can be called multiple times depending on the phase/whether multiprocessing
@@ -181,7 +201,8 @@ class Extractor():
         """ Launch the face aligner """
         logger.debug("Launching Aligner")
         kwargs = {"in_queue": self.queues["extract_align_in"],
-                  "out_queue": self.queues["extract_align_out"]}
+                  "out_queue": self.queues["extract_align_out"],
+                  "frame_pool": self.frame_pool}
 
         process = SpawnProcess(self.aligner.run, **kwargs)
         event = process.event
@@ -212,7 +233,8 @@ class Extractor():
         """ Launch the face detector """
         logger.debug("Launching Detector")
         kwargs = {"in_queue": self.queues["extract_detect_in"],
-                  "out_queue": self.queues["extract_align_in"]}
+                  "out_queue": self.queues["extract_align_in"],
+                  "frame_pool": self.frame_pool}
         mp_func = PoolProcess if self.detector.parent_is_pool else SpawnProcess
         process = mp_func(self.detector.run, **kwargs)
 
@@ -240,8 +262,17 @@ class Extractor():
 
         logger.debug("Launched Detector")
 
+    def put_frame(self, item):
+        """ Move the item's image into the shared frame pool, if in use, prior to queuing """
+        if self.frame_pool is None:
+            return item
+        return self.frame_pool.put_frame(item)
+
     def detected_faces(self):
-        """ Detect faces from in an image """
+        """ Detect faces from in an image
+
+            Images are viewed from the shared frame pool, if in use, and are only valid until
+            the next item is requested """
         logger.debug("Running Detection. Phase: '%s'", self.phase)
         # If not multiprocessing, intercept the align in queue for
         # detection phase
@@ -259,7 +290,11 @@ class Extractor():
             except QueueEmpty:
                 continue
 
-            yield faces
+            if self.frame_pool is None:
+                yield faces
+                continue
+            yield self.frame_pool.get_frame(faces)
+            self.frame_pool.release(faces)
         for process in self.processes:
             logger.trace("Joining process: %s", process)
             process.join()
@@ -268,6 +303,8 @@ class Extractor():
             # Cleanup queues
             for q_name in self.queues.keys():
                 queue_manager.del_queue(q_name)
+            if self.frame_pool is not None:
+                queue_manager.del_queue("extract_frame_pool")
             logger.debug("Detection Complete")
         else:
             logger.debug("Switching to align phase")
@@ -23,6 +23,7 @@
 
 import logging
 import os
+import queue as Queue
 import time
 
 import cv2
@@ -33,8 +34,11 @@ from tensorflow.python import errors_impl as tf_errors  # pylint:disable=no-name
 
 from lib.alignments import Alignments
 from lib.faces_detect import DetectedFace
+from lib.model import masks
+from lib.multithreading import MultiThread, total_cpus
+from lib.Serializer import get_serializer
 from lib.training_data import TrainingDataGenerator, stack_images
-from lib.utils import FaceswapError, get_folder, get_image_paths
+from lib.utils import FaceswapError, get_folder, get_image_paths, hash_image_file
 from plugins.train._config import Config
 
 logger = logging.getLogger(__name__)  # pylint: disable=invalid-name
@@ -105,8 +109,11 @@ class TrainerBase():
         """ Override for processing model specific training options """
         logger.debug(self.model.training_opts)
         if self.landmarks_required:
-            landmarks = Landmarks(self.model.training_opts).landmarks
-            self.model.training_opts["landmarks"] = landmarks
+            landmarks = Landmarks(self.model.training_opts, self.config, self.images)
+            self.model.training_opts["landmarks"] = landmarks.landmarks
+            self.model.training_opts["face_hashes"] = landmarks.face_hashes
+            self.model.training_opts["nearest_landmarks"] = landmarks.nearest_landmarks
+            self.model.training_opts["masks"] = landmarks.masks
 
     def set_tensorboard(self):
         """ Set up tensorboard callback """
@@ -212,6 +219,14 @@ class TrainerBase():
                 batcher.shutdown_feed()
             raise err
 
+    def log_face_cache(self):
+        """ Log the hit rate of each side's decoded face cache, if caching is enabled """
+        for side, batcher in self.batchers.items():
+            face_cache = batcher.face_cache
+            if face_cache is None:
+                continue
+            logger.info("Face cache hit rate %s: %.1f%%", side.upper(), face_cache.hit_rate)
+
     def store_history(self, side, loss):
         """ Store the history of this step """
         logger.trace("Updating loss history: '%s'", side)
@@ -254,6 +269,7 @@ class Batcher():
         generator = self.load_generator()
         self.feed = generator.minibatch_ab(images, batch_size, self.side)
         self.shutdown_feed = generator.join_subprocess
+        self.face_cache = generator.face_cache
 
         self.preview_feed = None
         self.timelapse_feed = None
@@ -674,12 +690,21 @@ class PingPong():
 
 class Landmarks():
     """ Set Landmarks for training into the model's training options"""
-    def __init__(self, training_opts):
-        logger.debug("Initializing %s: (training_opts: '%s')",
-                     self.__class__.__name__, training_opts)
+    def __init__(self, training_opts, config, images):
+        logger.debug("Initializing %s: (training_opts: '%s', config: %s, images: %s)",
+                     self.__class__.__name__, training_opts, config,
+                     {side: len(filenames) for side, filenames in images.items()})
         self.size = training_opts.get("training_size", 256)
         self.paths = training_opts["alignments"]
+        self.config = config
         self.landmarks = self.get_alignments()
+        self.face_hashes = self.get_face_hashes(images)
+        self.nearest_landmarks = None
+        if training_opts["warp_to_landmarks"]:
+            self.nearest_landmarks = self.get_nearest_landmarks()
+        self.masks = None
+        if training_opts.get("mask_type", None):
+            self.masks = self.get_masks(training_opts["mask_type"])
         logger.debug("Initialized %s", self.__class__.__name__)
 
     def get_alignments(self):
@@ -706,3 +731,238 @@ class Landmarks():
                 detected_face.load_aligned(None, size=self.size, align_eyes=False)
                 landmarks[detected_face.hash] = detected_face.aligned_landmarks
         return landmarks
+
+    def get_face_hashes(self, images):
+        """ Return the face hash for every training image, so that landmarks can be looked up
+            by filename when training.
+
+            The hashes are stored in an index next to each alignments file, so images only
+            need to be hashed again if they have been modified.
+
+            Returns a dict of {side: {filename: face_hash}} """
+        retval = dict()
+        for side, filenames in images.items():
+            index_file = "{}_face_hashes.p".format(os.path.splitext(self.paths[side])[0])
+            index = self.load_sidecar(index_file) or dict()
+            stats = {filename: self.file_stats(filename) for filename in filenames}
+            to_hash = [filename for filename in filenames
+                       if index.get(filename, (None, None))[0] != stats[filename]]
+            logger.debug("Side %s: (images: %s, indexed: %s, to_hash: %s)",
+                         side, len(filenames), len(index), len(to_hash))
+            if to_hash:
+                logger.info("Hashing %s faces for side %s...", len(to_hash), side.upper())
+                for filename, face_hash in self.hash_files(to_hash).items():
+                    index[filename] = (stats[filename], face_hash)
+                self.save_sidecar(index_file, index)
+            retval[side] = {filename: index[filename][1] for filename in filenames}
+        return retval
+
+    @staticmethod
+    def file_stats(filename):
+        """ Return the modification time and size of a file for checking whether it has
+            changed """
+        stats = os.stat(filename)
+        return stats.st_mtime, stats.st_size
+
+    @staticmethod
+    def hash_files(filenames):
+        """ Hash the given image files in parallel threads and return a dict of
+            {filename: face_hash} """
+        file_queue = Queue.Queue()
+        for filename in filenames:
+            file_queue.put(filename)
+        retval = dict()
+
+        def _hash_files():
+            """ Hash files from the queue until it is empty """
+            while True:
+                try:
+                    filename = file_queue.get(block=False)
+                except Queue.Empty:
+                    break
+                retval[filename] = hash_image_file(filename)
+
+        thread = MultiThread(_hash_files, thread_count=min(total_cpus(), len(filenames)))
+        thread.start()
+        thread.join()
+        return retval
+
+    def get_nearest_landmarks(self, count=10):
+        """ For every face on each side, find the hashes of the faces on the opposite side with
+            the closest matching landmarks, for 'warp to landmarks'.
+
+            Returns a dict of {side: {face_hash: (closest opposite face hashes)}} """
+        nearest = dict()
+        for side in self.landmarks:
+            other_side = "a" if side == "b" else "b"
+            cache_file = "{}_nearest_landmarks.p".format(os.path.splitext(self.paths[side])[0])
+            cache_key = self.nearest_cache_key(count)
+            nearest[side] = self.load_nearest_landmarks(cache_file, cache_key)
+            if nearest[side] is not None:
+                continue
+            logger.info("Calculating closest landmarks for side %s...", side.upper())
+            nearest[side] = self.find_nearest(self.landmarks[side],
+                                              self.landmarks[other_side],
+                                              count)
+            if self.config.get("save_nearest_landmarks", True):
+                self.save_nearest_landmarks(cache_file, cache_key, nearest[side])
+        return nearest
+
+    @staticmethod
+    def find_nearest(source, destination, count, block_size=256):
+        """ Return the hashes of the count destination faces whose landmarks have the lowest
+            mean squared distance to each source face's landmarks.
+
+            Distances are calculated for a block of source faces at a time with matrix
+            multiplication to keep memory use bounded """
+        src_hashes = list(source.keys())
+        dst_hashes = np.array(list(destination.keys()))
+        src_points = np.array([source[key] for key in src_hashes],
+                              dtype="float64").reshape(len(src_hashes), -1)
+        dst_points = np.array([destination[key] for key in dst_hashes],
+                              dtype="float64").reshape(len(dst_hashes), -1)
+        dst_squared = np.sum(np.square(dst_points), axis=1)
+        count = min(count, len(dst_hashes))
+
+        retval = dict()
+        for start in range(0, len(src_hashes), block_size):
+            block = src_points[start:start + block_size]
+            distances = (np.sum(np.square(block), axis=1)[:, None] + dst_squared[None, :] -
+                         2 * np.dot(block, dst_points.T))
+            if count < len(dst_hashes):
+                closest = np.argpartition(distances, count - 1, axis=1)[:, :count]
+            else:
+                closest = np.tile(np.arange(len(dst_hashes)), (len(block), 1))
+            order = np.argsort(np.take_along_axis(distances, closest, axis=1), axis=1)
+            closest = np.take_along_axis(closest, order, axis=1)
+            for idx, indices in enumerate(closest):
+                retval[src_hashes[start + idx]] = tuple(dst_hashes[indices].tolist())
+        logger.debug("Found nearest landmarks for %s faces", len(retval))
+        return retval
+
+    def nearest_cache_key(self, count):
+        """ Return the values that a saved nearest landmarks file must have been generated with
+            for it to be valid """
+        retval = dict(training_size=self.size, count=count)
+        for side, fullpath in self.paths.items():
+            retval[side] = (os.path.abspath(fullpath),
+                            os.path.getmtime(fullpath),
+                            os.path.getsize(fullpath))
+        return retval
+
+    def load_nearest_landmarks(self, filename, cache_key):
+        """ Load previously calculated nearest landmarks, if they exist and are valid """
+        data = self.load_sidecar(filename)
+        if data is None:
+            return None
+        if data.get("key", None) != cache_key:
+            logger.debug("Nearest landmarks file is out of date: '%s'", filename)
+            return None
+        return data["nearest"]
+
+    def save_nearest_landmarks(self, filename, cache_key, nearest):
+        """ Save the calculated nearest landmarks so that they can be reused """
+        self.save_sidecar(filename, dict(key=cache_key, nearest=nearest))
+
+    def get_masks(self, mask_type):
+        """ Build the training mask for every training face once, rather than for every sample.
+
+            The masks for each side are packed into a uint8 .npy file next to the alignments
+            file, with an index of the row for each face hash. The .npy file is memory mapped by
+            the training workers, so masks only need to be rebuilt if the alignments, training
+            size or mask type change.
+
+            Returns a dict of {side: (mask filename, {face_hash: row})}. A side is None if its
+            masks could not be saved, in which case masks are built when training """
+        retval = dict()
+        for side, fullpath in self.paths.items():
+            basename = "{}_{}_masks".format(os.path.splitext(fullpath)[0], mask_type)
+            mask_file = basename + ".npy"
+            index_file = basename + ".p"
+            cache_key = dict(training_size=self.size,
+                             mask_type=mask_type,
+                             alignments=(os.path.abspath(fullpath),
+                                         os.path.getmtime(fullpath),
+                                         os.path.getsize(fullpath)))
+            # Faces without landmarks are reported when training, so they are skipped here
+            face_hashes = set(face_hash for face_hash in self.face_hashes[side].values()
+                              if face_hash in self.landmarks[side])
+            index = self.load_mask_index(index_file, mask_file, cache_key, face_hashes)
+            if index is None:
+                logger.info("Building %s masks for side %s...", len(face_hashes), side.upper())
+                index = self.build_masks(mask_file, mask_type, self.landmarks[side], face_hashes)
+                if index is not None:
+                    self.save_sidecar(index_file, dict(key=cache_key, hashes=index))
+            retval[side] = None if index is None else (
+                mask_file, {face_hash: row for row, face_hash in enumerate(index)})
+        return retval
+
+    def load_mask_index(self, index_file, mask_file, cache_key, face_hashes):
+        """ Return the list of face hashes held in a previously saved mask file, if it exists,
+            is valid and holds a mask for every given face hash """
+        data = self.load_sidecar(index_file)
+        if data is None or not os.path.exists(mask_file):
+            return None
+        if data.get("key", None) != cache_key or not face_hashes.issubset(data["hashes"]):
+            logger.debug("Mask file is out of date: '%s'", mask_file)
+            return None
+        try:
+            stored = np.load(mask_file, mmap_mode="r")
+        except (OSError, ValueError) as err:
+            logger.warning("Unable to load '%s'. The masks will be rebuilt. "
+                           "Original error: %s", mask_file, str(err))
+            return None
+        if stored.shape != (len(data["hashes"]), self.size, self.size, 1):
+            logger.debug("Mask file does not match its index: '%s'", mask_file)
+            return None
+        return data["hashes"]
+
+    def build_masks(self, filename, mask_type, landmarks, face_hashes):
+        """ Build the uint8 mask for each face hash and save them to the given .npy file.
+
+            Returns the list of face hashes in the order they were saved, or None if the masks
+            could not be saved """
+        mask_class = getattr(masks, mask_type)
+        face = np.zeros((self.size, self.size, 3), dtype="uint8")  # Masks only need the shape
+        hashes = sorted(face_hashes)
+        stored = np.empty((len(hashes), self.size, self.size, 1), dtype="uint8")
+        for row, face_hash in enumerate(hashes):
+            stored[row] = mask_class(landmarks[face_hash], face, channels=1).mask
+        try:
+            np.save(filename, stored)
+        except (IOError, OSError) as err:
+            logger.warning("Unable to save '%s'. Masks will be built when training. "
+                           "Original error: %s", filename, str(err))
+            return None
+        logger.verbose("Saved '%s'", filename)
+        return hashes
+
+    @staticmethod
+    def load_sidecar(filename):
+        """ Load data that has been saved alongside an alignments file. Returns None if the
+            file does not exist or cannot be read """
+        if not os.path.exists(filename):
+            logger.debug("No file found: '%s'", filename)
+            return None
+        serializer = get_serializer("pickle")
+        try:
+            with open(filename, serializer.roptions) as s_file:
+                retval = serializer.unmarshal(s_file.read())
+        except Exception as err:  # pylint:disable=broad-except
+            logger.warning("Unable to load '%s'. The data will be recalculated. "
+                           "Original error: %s", filename, str(err))
+            return None
+        logger.verbose("Loaded '%s'", filename)
+        return retval
+
+    @staticmethod
+    def save_sidecar(filename, data):
+        """ Save data alongside an alignments file so that it can be reused """
+        serializer = get_serializer("pickle")
+        try:
+            with open(filename, serializer.woptions) as s_file:
+                s_file.write(serializer.marshal(data))
+        except (IOError, OSError) as err:
+            logger.warning("Unable to save '%s'. Original error: %s", filename, str(err))
+            return
+        logger.verbose("Saved '%s'", filename)
@@ -131,4 +131,55 @@ _DEFAULTS = {
         "min_max": (1, 8),
         "group": "color augmentation",
     },
+    "cache_size": {
+        "default": 0,
+        "info": "The amount of RAM, in megabytes, to use for caching decoded training images for "
+                "each side. Faces are decoded from disk once and then served from memory, which "
+                "can considerably reduce CPU load when training. If the training set does not "
+                "fit in the cache then the least recently used faces will be evicted. Set to 0 to "
+                "disable caching.",
+        "datatype": int,
+        "rounding": 256,
+        "min_max": (0, 16384),
+        "fixed": False,
+        "group": "performance",
+    },
+    "workers": {
+        "default": 0,
+        "info": "The number of processes to use for loading and augmenting training images for "
+                "each side. More processes can keep the GPU fed on systems with many CPU cores. "
+                "Set to 0 to split the available CPU cores between the 2 sides, up to a "
+                "maximum of 4 processes per side. Each process holds its own copy of the "
+                "training landmarks and batch memory, so more processes use more RAM.",
+        "datatype": int,
+        "rounding": 1,
+        "min_max": (0, 32),
+        "fixed": False,
+        "group": "performance",
+    },
+    "landmarks_warp": {
+        "default": "griddata",
+        "info": "The method used to build the warp when 'warp to landmarks' is enabled."
+                "\n\t griddata: Interpolates the warp for every pixel of the training image. "
+                "This is exact but slow."
+                "\n\t piecewise_affine: Applies an affine transform to each triangle between the "
+                "landmarks. Builds the same warp as griddata in around 70% of the time. Pixels "
+                "next to the edge of a triangle may differ from griddata by up to two thirds of "
+                "a pixel, which is well within the random jitter applied to the landmarks.",
+        "datatype": str,
+        "choices": ["griddata", "piecewise_affine"],
+        "gui_radio": True,
+        "fixed": False,
+        "group": "image augmentation",
+    },
+    "save_nearest_landmarks": {
+        "default": True,
+        "info": "When 'warp to landmarks' is enabled, the closest matching faces from the "
+                "opposite side are calculated for every face when training starts. Enable this "
+                "option to save these matches next to each alignments file so that they do not "
+                "need to be recalculated the next time that the model is trained.",
+        "datatype": bool,
+        "fixed": False,
+        "group": "performance",
+    },
 }
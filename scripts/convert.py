@@ -5,7 +5,8 @@ import logging
 import re
 import os
 import sys
-from threading import Event
+from threading import Condition, Event
+from time import time
 
 from cv2 import imwrite  # pylint:disable=no-name-in-module
 import numpy as np
@@ -16,7 +17,7 @@ from lib import Serializer
 from lib.convert import Converter
 from lib.faces_detect import DetectedFace
 from lib.gpu_stats import GPUStats
-from lib.multithreading import MultiThread, PoolProcess, total_cpus
+from lib.multithreading import MultiThread, PoolProcess, SharedFramePool, total_cpus
 from lib.queue_manager import queue_manager, QueueEmpty
 from lib.utils import FaceswapError, get_folder, get_image_paths, hash_image_file
 from plugins.extract.pipeline import Extractor
@@ -41,7 +42,11 @@ class Convert():
 
         self.add_queues()
         self.disk_io = DiskIO(self.alignments, self.images, arguments)
-        self.predictor = Predict(self.disk_io.load_queue, self.queue_size, arguments)
+        self.predictor = Predict(self.disk_io.load_queue,
+                                 self.queue_size,
+                                 arguments,
+                                 frame_pool=self.disk_io.frame_pool,
+                                 starving_callback=self.disk_io.set_predictor_starving)
 
         configfile = self.args.configfile if hasattr(self.args, "configfile") else None
         self.converter = Converter(get_folder(self.args.output_dir),
@@ -102,6 +107,7 @@ class Convert():
         try:
             self.convert_images()
             self.disk_io.save_thread.join()
+            self.disk_io.pre_process.close()
             queue_manager.terminate_queues()
 
             Utils.finalize(self.images.images_found,
@@ -124,7 +130,8 @@ class Convert():
         completion_queue = queue_manager.get_queue("patch_completed")
         pool = PoolProcess(self.converter.process, patch_queue, save_queue,
                            completion_queue=completion_queue,
-                           processes=self.pool_processes)
+                           processes=self.pool_processes,
+                           inherit=dict(frame_pool=self.disk_io.frame_pool))
         pool.start()
         completed_count = 0
         while True:
@@ -149,14 +156,21 @@ class Convert():
 
     def check_thread_error(self):
         """ Check and raise thread errors """
-        for thread in (self.predictor.thread, self.disk_io.load_thread, self.disk_io.save_thread):
+        for thread in (self.predictor.load_thread,
+                       self.predictor.thread,
+                       self.disk_io.load_thread,
+                       self.disk_io.save_thread):
             thread.check_and_raise_error()
 
 
 class DiskIO():
     """ Background threads to:
             Load images from disk and get the detected faces
-            Save images back to disk """
+            Save images back to disk
+
+        Frames are passed through the convert pipeline in a shared memory frame pool, where
+        possible. The load thread moves each frame into the pool and the save thread releases
+        it once written """
     def __init__(self, alignments, images, arguments):
         logger.debug("Initializing %s: (alignments: %s, images: %s, arguments: %s)",
                      self.__class__.__name__, alignments, images, arguments)
@@ -173,6 +187,14 @@ class DiskIO():
 
         # Extractor for on the fly detection
         self.extractor = self.load_extractor()
+        self.frame_bytes = self.get_frame_bytes()
+        self.frame_pool = self.add_frame_pool()
+
+        # For bounding the stream writers' reorder buffer
+        self.reorder_window = self.get_reorder_window()
+        self.frames_queued = 0
+        self.frame_written = Condition()
+        self.predictor_starving = False
 
         self.load_queue = None
         self.save_queue = None
@@ -211,7 +233,9 @@ class DiskIO():
         """ Return the writer plugin """
         args = [self.args.output_dir]
         if self.args.writer in ("ffmpeg", "gif"):
-            args.extend([self.total_count, self.frame_ranges])
+            # Unchanged frames are written too, so the writer must expect every frame
+            frame_ranges = None if self.args.keep_unchanged else self.frame_ranges
+            args.extend([self.total_count, frame_ranges])
         if self.args.writer == "ffmpeg":
             if self.images.is_video:
                 args.append(self.args.input_dir)
@@ -272,6 +296,98 @@ class DiskIO():
         logger.debug("Loaded extractor")
         return extractor
 
+    def get_frame_bytes(self):
+        """ Return the size, in bytes, of the first frame, with room for an alpha channel if the
+            writer draws transparent. Returns 0 if the first frame cannot be loaded """
+        if self.images.images_found == 0:
+            return 0
+        filename = "1" if self.images.is_video else self.images.input_images[0]
+        try:
+            image = self.images.load_one_image(filename)
+        except Exception as err:  # pylint: disable=broad-except
+            logger.debug("Unable to load first frame: %s", str(err))
+            return 0
+        retval = 0 if image is None else image.nbytes
+        if self.draw_transparent:
+            retval = (retval // 3) * 4
+        logger.debug("Frame bytes: %s", retval)
+        return retval
+
+    def add_frame_pool(self, ram_budget=2048):
+        """ Add a pool of shared memory slots for passing frames between the load thread,
+            the predictor, the patch processes and the save thread.
+
+            Slots are sized to the first frame and as many slots as fit into ram_budget (MB),
+            between 16 and 64. Returns None if the first frame cannot be loaded """
+        if not self.frame_bytes:
+            logger.debug("Not using shared frame pool")
+            return None
+        slots = min(64, max(16, (ram_budget * 1024 * 1024) // self.frame_bytes))
+        logger.verbose("Allocating %s shared frame slots (%sMB)",
+                       slots, (slots * self.frame_bytes) // (1024 * 1024))
+        queue_manager.add_queue("convert_frame_pool", maxsize=slots)
+        frame_pool = SharedFramePool(self.frame_bytes,
+                                     slots,
+                                     queue_manager.get_queue("convert_frame_pool"))
+        return frame_pool
+
+    def get_reorder_window(self, ram_budget=2048):
+        """ Return the maximum number of frames that can be queued for conversion ahead of the
+            last frame written by a stream writer.
+
+            Stream writers must write frames in order, so hold frames that arrive early until
+            the frames before them have been written. The window is as many frames as fit into
+            ram_budget (MB), between 16 and 256. Returns None for writers which write frames
+            as they arrive """
+        if not self.writer.is_stream:
+            return None
+        retval = 64
+        if self.frame_bytes:
+            retval = min(256, max(16, (ram_budget * 1024 * 1024) // self.frame_bytes))
+        logger.debug("Reorder window: %s", retval)
+        return retval
+
+    def wait_for_writer(self, timeout=60):
+        """ Block the load thread whilst the reorder window is full, so that frames which
+            are converted out of order cannot stack up in RAM whilst an earlier frame is still
+            being converted.
+
+            The predictor holds frames until it has a full batch of faces, which may be more
+            frames than the window, so one frame is let through whenever the predictor is
+            waiting on the load queue to complete a batch.
+
+            A missing frame would block loading forever, so loading continues if no frame is
+            written within timeout seconds """
+        if self.reorder_window is None:
+            return
+        with self.frame_written:
+            ready = self.frame_written.wait_for(
+                lambda: (self.frames_queued - self.writer.frames_written < self.reorder_window
+                         or self.predictor_starving
+                         or self.load_queue.shutdown.is_set()),
+                timeout=timeout)
+            self.predictor_starving = False
+        if not ready:
+            logger.debug("No frames written in %s seconds. Continuing. (queued: %s, written: "
+                         "%s)", timeout, self.frames_queued, self.writer.frames_written)
+        self.frames_queued += 1
+
+    def set_predictor_starving(self, starving):
+        """ Called by the predictor with True when it is waiting on the load queue to complete
+            a batch, and with False once it has received a frame """
+        if self.reorder_window is None:
+            return
+        with self.frame_written:
+            self.predictor_starving = starving
+            if starving:
+                self.frame_written.notify()
+
+    def put_frame(self, item):
+        """ Move the item's image into the shared frame pool, if in use, prior to queuing """
+        if self.frame_pool is None:
+            return item
+        return self.frame_pool.put_frame(item)
+
     def init_threads(self):
         """ Initialize queues and threads """
         logger.debug("Initializing DiskIO Threads")
@@ -319,16 +435,21 @@ class DiskIO():
             if self.check_skipframe(filename):
                 if self.args.keep_unchanged:
                     logger.trace("Saving unchanged frame: %s", filename)
+                    self.wait_for_writer()
                     out_file = os.path.join(self.args.output_dir, os.path.basename(filename))
-                    self.save_queue.put((out_file, image))
+                    item = (out_file, image)
+                    if self.frame_pool is not None:
+                        item = self.put_frame(dict(filename=out_file, image=image))
+                    self.save_queue.put(item)
                 else:
                     logger.trace("Discarding frame: '%s'", filename)
                 continue
 
+            self.wait_for_writer()
             detected_faces = self.get_detected_faces(filename, image)
             item = dict(filename=filename, image=image, detected_faces=detected_faces)
             self.pre_process.do_actions(item)
-            self.load_queue.put(item)
+            self.load_queue.put(self.put_frame(item))
 
         logger.debug("Putting EOF")
         self.load_queue.put("EOF")
@@ -399,6 +520,16 @@ class DiskIO():
         return final_faces
 
     # Saving tasks
+    def get_frame(self, item):
+        """ Return the filename and image for a frame pool item from the save queue.
+
+            Stream writers cache frames until they can be written in order, so frames in shared
+            memory are copied out for these writers, as the slot is released once written """
+        image = self.frame_pool.get_frame(item)["image"]
+        if self.writer.is_stream and item.get("frame_slot") is not None:
+            image = image.copy()
+        return item["filename"], image
+
     def save(self, completion_event):
         """ Save the converted images """
         logger.debug("Save Images: Start")
@@ -413,26 +544,43 @@ class DiskIO():
             if item == "EOF":
                 logger.debug("EOF Received")
                 break
-            filename, image = item
+            if isinstance(item, dict):
+                filename, image = self.get_frame(item)
+            else:
+                filename, image = item
             # Write out preview image for the GUI every 10 frames if writing to stream
             if write_preview and idx % 10 == 0 and not os.path.exists(preview_image):
                 logger.debug("Writing GUI Preview image: '%s'", preview_image)
                 imwrite(preview_image, image)
             self.writer.write(filename, image)
+            if self.frame_pool is not None:
+                self.frame_pool.release(item)
+            if self.reorder_window is not None:
+                with self.frame_written:
+                    self.frame_written.notify()
         self.writer.close()
         completion_event.set()
         logger.debug("Save Faces: Complete")
 
 
 class Predict():
-    """ Predict faces from incoming queue """
-    def __init__(self, in_queue, queue_size, arguments):
-        logger.debug("Initializing %s: (args: %s, queue_size: %s, in_queue: %s)",
-                     self.__class__.__name__, arguments, queue_size, in_queue)
-        self.batchsize = self.get_batchsize(queue_size)
+    """ Predict faces from incoming queue
+
+        Feed faces are loaded and compiled into batches in one thread whilst the predictor
+        runs in another, so that the next batch is prepared whilst the current batch is being
+        predicted """
+    def __init__(self, in_queue, queue_size, arguments, frame_pool=None, starving_callback=None):
+        logger.debug("Initializing %s: (args: %s, queue_size: %s, in_queue: %s, frame_pool: %s, "
+                     "starving_callback: %s)", self.__class__.__name__, arguments, queue_size,
+                     in_queue, frame_pool, starving_callback)
         self.args = arguments
         self.in_queue = in_queue
+        self.frame_pool = frame_pool
+        self.starving_callback = starving_callback
         self.out_queue = queue_manager.get_queue("patch")
+        self.batch_queue = queue_manager.get_queue("convert_predict_batch",
+                                                   maxsize=2,
+                                                   multiprocessing_queue=False)
         self.serializer = Serializer.get_serializer("json")
         self.faces_count = 0
         self.verify_output = False
@@ -440,9 +588,12 @@ class Predict():
         self.output_indices = {"face": self.model.largest_face_index,
                                "mask": self.model.largest_mask_index}
         self.predictor = self.model.converter(self.args.swap_model)
+        self.batchsize = self.get_batchsize(queue_size)
         self.queues = dict()
 
+        self.load_thread = MultiThread(self.load_batches, thread_count=1)
         self.thread = MultiThread(self.predict_faces, thread_count=1)
+        self.load_thread.start()
         self.thread.start()
         logger.debug("Initialized %s: (out_queue: %s)", self.__class__.__name__, self.out_queue)
 
@@ -472,16 +623,42 @@ class Predict():
         """ Return whether this model has a predicted mask """
         return bool(self.model.state.mask_shapes)
 
-    @staticmethod
-    def get_batchsize(queue_size):
-        """ Get the batchsize """
-        logger.debug("Getting batchsize")
-        is_cpu = GPUStats().device_count == 0
-        batchsize = 1 if is_cpu else 16
-        batchsize = min(queue_size, batchsize)
-        logger.debug("Batchsize: %s", batchsize)
-        logger.debug("Got batchsize: %s", batchsize)
-        return batchsize
+    def get_batchsize(self, queue_size):
+        """ Find the batch size that gives the best predictor throughput.
+
+            Batch sizes are doubled, up to the queue size, until throughput stops improving by
+            at least 5% or the predictor fails, which will normally be from running out of
+            memory. PlaidML compiles the model for each batch size, so is not probed """
+        if GPUStats().is_plaidml:
+            batchsize = min(queue_size, 16)
+            logger.debug("Not probing batchsize for PlaidML. Batchsize: %s", batchsize)
+            return batchsize
+        logger.info("Finding the best batch size for the model...")
+        feed_faces = np.zeros((queue_size, ) + tuple(self.model.input_shape), dtype="float32")
+        best = (1, 0.0)
+        batchsize = 1
+        while batchsize <= queue_size:
+            try:
+                faces_per_sec = self.time_predict(feed_faces[:batchsize])
+            except Exception as err:  # pylint: disable=broad-except
+                logger.verbose("Batchsize %s failed. Reason: %s", batchsize, str(err))
+                break
+            logger.verbose("Batchsize: %s, faces/sec: %.1f", batchsize, faces_per_sec)
+            if faces_per_sec < best[1] * 1.05:
+                break
+            best = (batchsize, faces_per_sec)
+            batchsize *= 2
+        logger.info("Batchsize: %s (%.1f faces/sec)", best[0], best[1])
+        return best[0]
+
+    def time_predict(self, feed_faces, runs=3):
+        """ Return the predictor's throughput, in faces per second, for the given feed """
+        batch_size = feed_faces.shape[0]
+        self.predict(feed_faces, batch_size=batch_size)  # Warm up
+        start = time()
+        for _ in range(runs):
+            self.predict(feed_faces, batch_size=batch_size)
+        return (feed_faces.shape[0] * runs) / max(time() - start, 1e-6)
 
     def load_model(self):
         """ Load the model requested for conversion """
@@ -521,16 +698,24 @@ class Predict():
         logger.debug("Trainer from state file: '%s'", trainer)
         return trainer
 
-    def predict_faces(self):
-        """ Get detected faces from images """
+    def load_batches(self):
+        """ Load the feed faces for incoming frames and compile them into batches for the
+            predictor """
         faces_seen = 0
         consecutive_no_faces = 0
         batch = list()
-        is_plaidml = GPUStats().is_plaidml
         while True:
+            # Let the loader know when a partial batch cannot be completed from queued frames
+            starving = bool(batch) and self.starving_callback is not None and self.in_queue.empty()
+            if starving:
+                self.starving_callback(True)
             item = self.in_queue.get()
+            if starving:
+                self.starving_callback(False)
             if item != "EOF":
                 logger.trace("Got from queue: '%s'", item["filename"])
+                if self.frame_pool is not None:
+                    self.frame_pool.get_frame(item)
                 faces_count = len(item["detected_faces"])
 
                 # Safety measure. If a large stream of frames appear that do not have faces,
@@ -560,17 +745,8 @@ class Predict():
                              len(batch), faces_seen)
                 detected_batch = [detected_face for item in batch
                                   for detected_face in item["detected_faces"]]
-                if faces_seen != 0:
-                    feed_faces = self.compile_feed_faces(detected_batch)
-                    batch_size = None
-                    if is_plaidml and feed_faces.shape[0] != self.batchsize:
-                        logger.verbose("Fallback to BS=1")
-                        batch_size = 1
-                    predicted = self.predict(feed_faces, batch_size)
-                else:
-                    predicted = list()
-
-                self.queue_out_frames(batch, predicted)
+                feed_faces = self.compile_feed_faces(detected_batch) if faces_seen != 0 else None
+                self.batch_queue.put((batch, feed_faces))
 
             consecutive_no_faces = 0
             faces_seen = 0
@@ -578,6 +754,37 @@ class Predict():
             if item == "EOF":
                 logger.debug("EOF Received")
                 break
+        logger.debug("Putting EOF to batch queue")
+        self.batch_queue.put("EOF")
+        logger.debug("Load batches complete")
+
+    def predict_faces(self):
+        """ Predict the swapped faces for each batch and queue out the frames """
+        is_plaidml = GPUStats().is_plaidml
+        faces_predicted = 0
+        predict_time = 0.0
+        while True:
+            item = self.batch_queue.get()
+            if item == "EOF":
+                logger.debug("EOF Received")
+                break
+            batch, feed_faces = item
+            if feed_faces is not None:
+                batch_size = self.batchsize
+                if is_plaidml and feed_faces.shape[0] != self.batchsize:
+                    logger.verbose("Fallback to BS=1")
+                    batch_size = 1
+                start = time()
+                predicted = self.predict(feed_faces, batch_size)
+                predict_time += time() - start
+                faces_predicted += feed_faces.shape[0]
+            else:
+                predicted = list()
+
+            self.queue_out_frames(batch, predicted)
+        if predict_time:
+            logger.verbose("Predicted %s faces at %.1f faces/sec",
+                           faces_predicted, faces_predicted / predict_time)
         logger.debug("Putting EOF")
         self.out_queue.put("EOF")
         logger.debug("Load queue complete")
@@ -654,6 +861,8 @@ class Predict():
                          item["filename"], len(item["detected_faces"]),
                          item["swapped_faces"].shape[0])
             pointer += num_faces
+            if self.frame_pool is not None:
+                self.frame_pool.put_frame(item)
         self.out_queue.put(batch)
         logger.trace("Queued out batch. Batchsize: %s", len(batch))
 
@@ -4,16 +4,17 @@
 import logging
 import os
 import sys
+from concurrent.futures import ThreadPoolExecutor, wait
 from pathlib import Path
 
 from tqdm import tqdm
 
 from lib.faces_detect import DetectedFace
-from lib.multithreading import MultiThread
+from lib.multithreading import MultiThread, total_cpus
 from lib.queue_manager import queue_manager
 from lib.utils import get_folder, hash_encode_image
 from plugins.extract.pipeline import Extractor
-from scripts.fsmedia import Alignments, Images, PostProcess, Utils
+from scripts.fsmedia import Alignments, FrameCache, Images, PostProcess, Utils
 
 tqdm.monitor_interval = 0  # workaround for TqdmSynchronisationWarning
 logger = logging.getLogger(__name__)  # pylint: disable=invalid-name
@@ -39,8 +40,13 @@ class Extract():
                                    multiprocess=not self.args.singleprocess,
                                    rotate_images=self.args.rotate_images,
                                    min_size=self.args.min_size,
-                                   normalize_method=normalization)
-        self.save_queue = queue_manager.get_queue("extract_save")
+                                   normalize_method=normalization,
+                                   frame_bytes=self.get_frame_bytes())
+        self.save_queue = queue_manager.get_queue("extract_save", multiprocessing_queue=False)
+        self.frame_cache = self.get_frame_cache()
+        self.encoder = ThreadPoolExecutor(max_workers=min(8, total_cpus()))
+        self.pending_encodes = list()
+        self.unsaved_frames = list()
         self.threads = list()
         self.verify_output = False
         self.save_interval = None
@@ -53,6 +59,34 @@ class Extract():
         """ Number of frames to skip if extract_every_n is passed """
         return self.args.extract_every_n if hasattr(self.args, "extract_every_n") else 1
 
+    def get_frame_cache(self):
+        """ Return a cache for holding frames between the detect and align passes when
+            extracting serially, or None if extracting in a single pass or the cache is
+            disabled """
+        ram_budget = self.args.frame_cache if hasattr(self.args, "frame_cache") else 0
+        if self.extractor.passes == 1 or ram_budget == 0:
+            logger.debug("Not caching frames: (passes: %s, ram_budget: %s)",
+                         self.extractor.passes, ram_budget)
+            return None
+        logger.verbose("Caching face regions for the align pass in up to %sMB of RAM",
+                       ram_budget)
+        return FrameCache(ram_budget)
+
+    def get_frame_bytes(self):
+        """ Return the size, in bytes, of the first frame for sizing the shared frame pool.
+            Returns 0 if the frame cannot be loaded """
+        if self.images.images_found == 0:
+            return 0
+        filename = "1" if self.images.is_video else self.images.input_images[0]
+        try:
+            image = self.images.load_one_image(filename)
+        except Exception as err:  # pylint: disable=broad-except
+            logger.debug("Unable to load first frame: %s", str(err))
+            return 0
+        retval = 0 if image is None else image.nbytes
+        logger.debug("Frame bytes: %s", retval)
+        return retval
+
     def process(self):
         """ Perform the extraction process """
         logger.info('Starting, this may take a while...')
@@ -62,6 +96,9 @@ class Extract():
         self.run_extraction()
         for thread in self.threads:
             thread.join()
+        self.wait_for_encodes()
+        self.encoder.shutdown()
+        self.post_process.close()
         self.alignments.save()
         Utils.finalize(self.images.images_found // self.skip_num,
                        self.alignments.faces_count,
@@ -105,16 +142,26 @@ class Extract():
                 continue
             item = {"filename": filename,
                     "image": image}
-            load_queue.put(item)
+            load_queue.put(self.extractor.put_frame(item))
         load_queue.put("EOF")
         logger.debug("Load Images: Complete")
 
     def reload_images(self, detected_faces):
-        """ Reload the images and pair to detected face """
+        """ Reload the images and pair to detected face
+
+            Frames held in the frame cache are not loaded again. The source is only read if
+            the cache is disabled, until every frame that is not in the cache has been
+            reloaded """
         logger.debug("Reload Images: Start. Detected Faces Count: %s", len(detected_faces))
         load_queue = self.extractor.input_queue
+        cache = self.frame_cache
+        to_load = sum(1 for filename in detected_faces
+                      if cache is None or filename not in cache)
+        logger.debug("Frames to reload: %s, Cached frames: %s",
+                     to_load, len(detected_faces) - to_load)
         idx = 0
-        for filename, image in self.images.load():
+        loader = self.images.load() if to_load else tuple()
+        for filename, image in loader:
             idx += 1
             if load_queue.shutdown.is_set():
                 logger.debug("Reload Queue: Stop signal received. Terminating")
@@ -123,13 +170,30 @@ class Extract():
                 logger.trace("Skipping image '%s' due to extract_every_n = %s",
                              filename, self.skip_num)
                 continue
+            if cache is not None and filename in cache:
+                continue
             logger.trace("Reloading image: '%s'", filename)
             detect_item = detected_faces.pop(filename, None)
             if not detect_item:
                 logger.warning("Couldn't find faces for: %s", filename)
                 continue
             detect_item["image"] = image
-            load_queue.put(detect_item)
+            load_queue.put(self.extractor.put_frame(detect_item))
+            to_load -= 1
+            if to_load == 0:
+                logger.debug("All uncached frames reloaded")
+                break
+        cached = list(cache.frames) if cache is not None else list()
+        for filename in cached:
+            if load_queue.shutdown.is_set():
+                break
+            detect_item = detected_faces.pop(filename, None)
+            image = cache.pop(filename)
+            if not detect_item:
+                continue
+            logger.trace("Loading cached image: '%s'", filename)
+            detect_item["image"] = image
+            load_queue.put(self.extractor.put_frame(detect_item))
         load_queue.put("EOF")
         logger.debug("Reload Images: Complete")
 
@@ -144,10 +208,11 @@ class Extract():
             logger.trace(item)
             if item == "EOF":
                 break
-            filename, face = item
+            filename, encoded = item
 
             logger.trace("Saving face: '%s'", filename)
             try:
+                face = encoded.result()
                 with open(filename, "wb") as out_file:
                     out_file.write(face)
             except Exception as err:  # pylint: disable=broad-except
@@ -186,6 +251,7 @@ class Extract():
                 break
             is_final = self.extractor.final_pass
             detected_faces = dict()
+            output_batch = list()
             self.extractor.launch()
             self.check_thread_error()
             for idx, faces in enumerate(tqdm(self.extractor.detected_faces(),
@@ -202,15 +268,29 @@ class Extract():
                 filename = faces["filename"]
 
                 if self.extractor.final_pass:
-                    self.output_processing(faces, align_eyes, size, filename)
-                    self.output_faces(filename, faces)
+                    if self.post_process.batch_size > 1:
+                        # Shared frame pool slots are released when the next frame is taken
+                        faces = dict(faces, image=faces["image"].copy())
+                    self.align_face(faces, align_eyes, size, filename)
+                    output_batch.append(faces)
+                    if len(output_batch) >= self.post_process.batch_size:
+                        self.output_processing(output_batch)
+                        output_batch = list()
                     if self.save_interval and (idx + 1) % self.save_interval == 0:
-                        self.alignments.save()
+                        self.wait_for_encodes()
+                        self.alignments.save_journal(self.unsaved_frames)
+                        self.unsaved_frames = list()
                 else:
+                    if self.frame_cache is not None:
+                        self.frame_cache.add(filename,
+                                             faces["image"],
+                                             faces.get("detected_faces", list()))
                     del faces["image"]
                     detected_faces[filename] = faces
 
             if is_final:
+                if output_batch and not exception:
+                    self.output_processing(output_batch)
                 logger.debug("Putting EOF to save")
                 self.save_queue.put("EOF")
             else:
@@ -222,18 +302,21 @@ class Extract():
         for thread in self.threads:
             thread.check_and_raise_error()
 
-    def output_processing(self, faces, align_eyes, size, filename):
-        """ Prepare faces for output """
-        self.align_face(faces, align_eyes, size, filename)
-        self.post_process.do_actions(faces)
-
-        faces_count = len(faces["detected_faces"])
-        if faces_count == 0:
-            logger.verbose("No faces were detected in image: %s",
-                           os.path.basename(filename))
+    def output_processing(self, output_batch):
+        """ Run post processing on a batch of aligned frames and output their faces. Frames
+            are batched so that post processing actions can process faces from several frames
+            at once """
+        self.post_process.do_batch_actions(output_batch)
+        for faces in output_batch:
+            filename = faces["filename"]
+            faces_count = len(faces["detected_faces"])
+            if faces_count == 0:
+                logger.verbose("No faces were detected in image: %s",
+                               os.path.basename(filename))
 
-        if not self.verify_output and faces_count > 1:
-            self.verify_output = True
+            if not self.verify_output and faces_count > 1:
+                self.verify_output = True
+            self.output_faces(filename, faces)
 
     def align_face(self, faces, align_eyes, size, filename):
         """ Align the detected face and add the destination file path """
@@ -252,6 +335,7 @@ class Extract():
 
     def output_faces(self, filename, faces):
         """ Output faces to save thread """
+        self.prune_encodes()
         final_faces = list()
         for idx, detected_face in enumerate(faces["detected_faces"]):
             output_file = detected_face["file_location"]
@@ -259,9 +343,35 @@ class Extract():
             out_filename = "{}_{}{}".format(str(output_file), str(idx), extension)
 
             face = detected_face["face"]
-            resized_face = face.aligned_face
-
-            face.hash, img = hash_encode_image(resized_face, extension)
-            self.save_queue.put((out_filename, img))
-            final_faces.append(face.to_alignment())
+            alignment = face.to_alignment()
+            encoded = self.encoder.submit(self.encode_face,
+                                          face.aligned_face,
+                                          extension,
+                                          alignment)
+            self.pending_encodes.append(encoded)
+            self.save_queue.put((out_filename, encoded))
+            final_faces.append(alignment)
         self.alignments.data[os.path.basename(filename)] = final_faces
+        if self.save_interval:
+            self.unsaved_frames.append(os.path.basename(filename))
+
+    @staticmethod
+    def encode_face(face, extension, alignment):
+        """ Encode the face for saving and add its hash to the face's alignment.
+            Runs in the encoder thread pool """
+        alignment["hash"], img = hash_encode_image(face, extension)
+        return img
+
+    def prune_encodes(self):
+        """ Drop encodes that have completed. The save queue holds its own reference to each
+            encode, so completed faces are not kept in memory once they have been saved """
+        self.pending_encodes = [encoded for encoded in self.pending_encodes
+                                if not encoded.done()]
+
+    def wait_for_encodes(self):
+        """ Block until all queued faces have been encoded, so that the hashes in the
+            alignments data are populated prior to saving """
+        self.prune_encodes()
+        logger.debug("Waiting for %s face encodes", len(self.pending_encodes))
+        wait(self.pending_encodes)
+        self.pending_encodes = list()
@@ -7,6 +7,9 @@
 
 import logging
 import os
+import tempfile
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 import cv2
@@ -15,9 +18,12 @@ import numpy as np
 
 from lib.aligner import Extract as AlignerExtract
 from lib.alignments import Alignments as AlignmentsBase
+from lib.Serializer import BinarySerializer
 from lib.face_filter import FaceFilter as FilterFunc
-from lib.utils import (camel_case_split, count_frames_and_secs, cv2_read_img, get_folder,
-                       get_image_paths, set_system_verbosity, _video_extensions)
+from lib.multithreading import total_cpus
+from lib.utils import (camel_case_split, cv2_read_img, get_folder, get_image_paths,
+                       set_system_verbosity, _video_extensions)
+from lib.video import VideoReader
 
 logger = logging.getLogger(__name__)  # pylint: disable=invalid-name
 
@@ -57,11 +63,26 @@ class Alignments(AlignmentsBase):
         self.is_extract = is_extract
         folder, filename = self.set_folder_filename(input_is_video)
         serializer = self.set_serializer()
+        self.replayed_journal = False
+        self.resumed = False
         super().__init__(folder,
                          filename=filename,
                          serializer=serializer)
+        if self.is_extract:
+            self.resolve_journal()
         logger.debug("Initialized %s", self.__class__.__name__)
 
+    @property
+    def journal_file(self):
+        """ Path to the journal of frames extracted since the alignments file was last
+            saved """
+        return "{}.journal".format(self.file)
+
+    @property
+    def have_journal_file(self):
+        """ Return whether a journal exists from an extraction that did not complete """
+        return os.path.isfile(self.journal_file)
+
     def set_folder_filename(self, input_is_video):
         """ Return the folder for the alignments file"""
         if self.args.alignments_path:
@@ -109,16 +130,18 @@ class Alignments(AlignmentsBase):
             logger.debug("No skipping selected. Returning empty dictionary")
             return data
 
-        if not self.have_alignments_file and (skip_existing or skip_faces):
+        if not self.have_alignments_file and not self.have_journal_file:
             logger.warning("Skip Existing/Skip Faces selected, but no alignments file found!")
             return data
 
-        try:
-            with open(self.file, self.serializer.roptions) as align:
-                data = self.serializer.unmarshal(align.read())
-        except IOError as err:
-            logger.error("Error: '%s' not read: %s", self.file, err.strerror)
-            exit(1)
+        self.resumed = True
+        if self.have_alignments_file:
+            try:
+                data = self.read_file()
+            except IOError as err:
+                logger.error("Error: '%s' not read: %s", self.file, err.strerror)
+                exit(1)
+        self.replay_journal(data)
 
         if skip_faces:
             # Remove items from algnments that have no faces so they will
@@ -131,6 +154,50 @@ class Alignments(AlignmentsBase):
                     del data[key]
         return data
 
+    def replay_journal(self, data):
+        """ Add the frames held in the journal of an interrupted extraction to the loaded
+            alignments data """
+        if not self.have_journal_file:
+            return
+        journal = BinarySerializer.load(self.journal_file)
+        logger.info("Recovering %s frames from interrupted extraction: '%s'",
+                    len(journal), self.journal_file)
+        data.update(journal.items())
+        journal.close()
+        self.replayed_journal = True
+
+    def resolve_journal(self):
+        """ Merge a replayed journal into the alignments file, so that new frames are journaled
+            from a clean state, or discard the journal if it has not been replayed """
+        if self.replayed_journal:
+            self.save()
+        elif self.have_journal_file:
+            logger.warning("Discarding the alignments journal of an interrupted extraction. Use "
+                           "'skip-existing' to continue the interrupted extraction instead.")
+            os.remove(self.journal_file)
+
+    def save_journal(self, frames):
+        """ Append the alignments of the given frames to the journal and sync it to disk """
+        logger.debug("Journaling %s frames", len(frames))
+        if not self.resumed and not self.have_journal_file and self.have_alignments_file:
+            # The journal is replayed on top of the alignments file, so an alignments file that
+            # this run is replacing must not be left in place while the journal exists
+            self.backup()
+        BinarySerializer.append(self.journal_file,
+                                [(frame, self.data[frame]) for frame in frames])
+
+    def save(self):
+        """ Save the alignments file, merging in any journaled frames. The journal is only
+            removed once the alignments file has been written """
+        saved = super().save()
+        if not saved and self.have_journal_file:
+            logger.warning("The alignments journal has been kept: '%s'. Run again with "
+                           "'skip-existing' to recover the journaled frames.", self.journal_file)
+        elif self.have_journal_file:
+            logger.debug("Removing journal: '%s'", self.journal_file)
+            os.remove(self.journal_file)
+        return saved
+
 
 class Images():
     """ Holds the full frames/images """
@@ -139,13 +206,22 @@ class Images():
         self.args = arguments
         self.is_video = self.check_input_folder()
         self.input_images = self.get_input_images()
+        self._vid_reader = None
         self.images_found = self.count_images()
         logger.debug("Initialized %s", self.__class__.__name__)
 
+    @property
+    def vid_reader(self):
+        """ Indexed reader for random access to the input video's frames. Created on first use
+            so that the open decoder is not held unless single frames are requested """
+        if self._vid_reader is None:
+            self._vid_reader = VideoReader(self.args.input_dir)
+        return self._vid_reader
+
     def count_images(self):
         """ Number of images or frames """
         if self.is_video:
-            retval = int(count_frames_and_secs(self.args.input_dir)[0])
+            retval = self.vid_reader.count
         else:
             retval = len(self.input_images)
         return retval
@@ -179,27 +255,69 @@ class Images():
         for filename, image in iterator():
             yield filename, image
 
+    @property
+    def load_threads(self):
+        """ Number of threads to decode frames from disk with """
+        retval = self.args.load_threads if hasattr(self.args, "load_threads") else 0
+        if retval < 1:
+            retval = min(8, total_cpus())
+        return retval
+
+    @property
+    def prefetch(self):
+        """ Maximum number of frames to decode ahead of the frame being yielded """
+        retval = self.args.prefetch if hasattr(self.args, "prefetch") else 32
+        return max(retval, self.load_threads)
+
     def load_disk_frames(self):
-        """ Load frames from disk """
-        logger.debug("Input is separate Frames. Loading images")
-        for filename in self.input_images:
-            image = cv2_read_img(filename, raise_error=False)
-            if image is None:
-                continue
-            yield filename, image
+        """ Load frames from disk.
+
+            cv2 releases the GIL whilst decoding, so frames are decoded in a thread pool. Up to
+            prefetch frames are submitted ahead of the frame being yielded and are yielded in
+            the order of the input images """
+        threads, prefetch = self.load_threads, self.prefetch
+        logger.debug("Input is separate Frames. Loading images (threads: %s, prefetch: %s)",
+                     threads, prefetch)
+        executor = ThreadPoolExecutor(max_workers=threads)
+        filenames = iter(self.input_images)
+        pending = deque()
+        try:
+            for filename in filenames:
+                pending.append((filename,
+                                executor.submit(cv2_read_img, filename, raise_error=False)))
+                if len(pending) == prefetch:
+                    break
+            while pending:
+                filename, image = pending.popleft()
+                next_file = next(filenames, None)
+                if next_file is not None:
+                    pending.append((next_file,
+                                    executor.submit(cv2_read_img, next_file, raise_error=False)))
+                image = image.result()
+                if image is None:
+                    continue
+                yield filename, image
+        finally:
+            # Don't decode frames which will not be used if the caller stops iterating early
+            for _, image in pending:
+                image.cancel()
+            executor.shutdown(wait=True)
 
     def load_video_frames(self):
         """ Return frames from a video file """
         logger.debug("Input is video. Capturing frames")
         vidname = os.path.splitext(os.path.basename(self.args.input_dir))[0]
         reader = imageio.get_reader(self.args.input_dir)
-        for i, frame in enumerate(reader):
-            # Convert to BGR for cv2 compatibility
-            frame = frame[:, :, ::-1]
-            filename = "{}_{:06d}.png".format(vidname, i + 1)
-            logger.trace("Loading video frame: '%s'", filename)
-            yield filename, frame
-        reader.close()
+        try:
+            for i, frame in enumerate(reader):
+                # Convert to BGR for cv2 compatibility
+                frame = frame[:, :, ::-1]
+                filename = "{}_{:06d}.png".format(vidname, i + 1)
+                logger.trace("Loading video frame: '%s'", filename)
+                yield filename, frame
+        finally:
+            # Close the reader if the caller stops iterating early
+            reader.close()
 
     def load_one_image(self, filename):
         """ load requested image """
@@ -218,11 +336,100 @@ class Images():
     def load_one_video_frame(self, frame_no):
         """ Load a single frame from a video file """
         logger.trace("Loading video frame: %s", frame_no)
-        reader = imageio.get_reader(self.args.input_dir)
-        reader.set_image_index(frame_no - 1)
-        frame = reader.get_next_data()[:, :, ::-1]
-        reader.close()
-        return frame
+        return self.vid_reader.get_frame(frame_no - 1)
+
+
+class FrameCache():
+    """ Holds the parts of decoded frames that the align pass needs, so that frames do not need
+        to be decoded again.
+
+        Only a region around each detected face is kept, padded on each side by the size of the
+        face, which covers the aligner's crop and the aligned face. Frames without faces are
+        held as their dimensions only. Regions are held in RAM up to a budget in megabytes, after
+        which they are written to a memory mapped temporary file on disk """
+    def __init__(self, ram_budget, padding=1.0):
+        logger.debug("Initializing %s: (ram_budget: %s, padding: %s)",
+                     self.__class__.__name__, ram_budget, padding)
+        self.budget = ram_budget * 1024 * 1024
+        self.padding = padding
+        self.size = 0
+        self.frames = OrderedDict()
+        self.spill_file = None
+        self.spill_size = 0
+        self.spill_map = None
+        logger.debug("Initialized %s", self.__class__.__name__)
+
+    def __len__(self):
+        return len(self.frames)
+
+    def __contains__(self, filename):
+        return filename in self.frames
+
+    def add(self, filename, image, detected_faces):
+        """ Add the regions of the image around each of the detected faces to the cache """
+        regions = list()
+        for face in detected_faces:
+            pad_x = int((face["right"] - face["left"]) * self.padding)
+            pad_y = int((face["bottom"] - face["top"]) * self.padding)
+            left = max(face["left"] - pad_x, 0)
+            top = max(face["top"] - pad_y, 0)
+            right = min(face["right"] + pad_x, image.shape[1])
+            bottom = min(face["bottom"] + pad_y, image.shape[0])
+            if right <= left or bottom <= top:
+                continue
+            regions.append(((left, top), self.store(image[top:bottom, left:right])))
+        self.frames[filename] = (image.shape, regions)
+        logger.trace("Cached frame: (filename: '%s', regions: %s, frames: %s, size: %sMB, "
+                     "spilled: %sMB)", filename, len(regions), len(self.frames),
+                     self.size // (1024 * 1024), self.spill_size // (1024 * 1024))
+
+    def store(self, region):
+        """ Return a copy of the region if it fits in the RAM budget, otherwise write it to the
+            spill file and return its (offset, shape) within the file """
+        if self.size + region.nbytes <= self.budget:
+            self.size += region.nbytes
+            return region.copy()
+        if self.spill_file is None:
+            logger.verbose("Frame cache RAM budget reached. Spilling frames to disk")
+            self.spill_file = tempfile.TemporaryFile(prefix="faceswap_frames_")
+        retval = (self.spill_size, region.shape)
+        self.spill_file.write(np.ascontiguousarray(region).tobytes())
+        self.spill_size += region.nbytes
+        return retval
+
+    def load(self, stored):
+        """ Return a region from RAM or from the spill file """
+        if isinstance(stored, np.ndarray):
+            self.size -= stored.nbytes
+            return stored
+        if self.spill_map is None:
+            self.spill_file.flush()
+            self.spill_map = np.memmap(self.spill_file, dtype="uint8", mode="r")
+        offset, shape = stored
+        return self.spill_map[offset:offset + int(np.prod(shape))].reshape(shape)
+
+    def pop(self, filename):
+        """ Remove the frame for the given filename from the cache and return it. Pixels
+            outside of the cached regions are black """
+        shape, regions = self.frames.pop(filename)
+        image = np.zeros(shape, dtype="uint8")
+        for (left, top), stored in regions:
+            region = self.load(stored)
+            image[top:top + region.shape[0], left:left + region.shape[1]] = region
+        if not self.frames:
+            self.close()
+        return image
+
+    def close(self):
+        """ Remove the spill file """
+        if self.spill_file is None:
+            return
+        logger.debug("Removing frame cache spill file: (size: %sMB)",
+                     self.spill_size // (1024 * 1024))
+        self.spill_map = None
+        self.spill_file.close()
+        self.spill_file = None
+        self.spill_size = 0
 
 
 class PostProcess():
@@ -284,7 +491,8 @@ class PostProcess():
             face_filter = dict(detector=detector,
                                aligner=aligner,
                                loglevel=self.args.loglevel,
-                               multiprocess=not self.args.singleprocess)
+                               multiprocess=not self.args.singleprocess,
+                               cache_dir=getattr(self.args, "output_dir", None))
             filter_lists = dict()
             if hasattr(self.args, "ref_threshold"):
                 face_filter["ref_threshold"] = self.args.ref_threshold
@@ -298,12 +506,29 @@ class PostProcess():
         logger.debug("Postprocess Items: %s", postprocess_items)
         return postprocess_items
 
+    @property
+    def batch_size(self):
+        """ The number of output items that the actions would like to process together """
+        return max([action.batch_size for action in self.actions] + [1])
+
     def do_actions(self, output_item):
         """ Perform the requested post-processing actions """
         for action in self.actions:
             logger.debug("Performing postprocess action: '%s'", action.__class__.__name__)
             action.process(output_item)
 
+    def do_batch_actions(self, output_items):
+        """ Perform the requested post-processing actions on a list of output items """
+        for action in self.actions:
+            logger.debug("Performing postprocess action: '%s' (items: %s)",
+                         action.__class__.__name__, len(output_items))
+            action.process_batch(output_items)
+
+    def close(self):
+        """ Perform any clean up required by the actions """
+        for action in self.actions:
+            action.close()
+
 
 class PostProcessAction():  # pylint: disable=too-few-public-methods
     """ Parent class for Post Processing Actions
@@ -313,12 +538,22 @@ class PostProcessAction():  # pylint: disable=too-few-public-methods
         logger.debug("Initializing %s: (args: %s, kwargs: %s)",
                      self.__class__.__name__, args, kwargs)
         self.valid = True  # Set to False if invalid params passed in to disable
+        self.batch_size = 1  # Set to process more than one output item at a time
         logger.debug("Initialized base class %s", self.__class__.__name__)
 
     def process(self, output_item):
         """ Override for specific post processing action """
         raise NotImplementedError
 
+    def process_batch(self, output_items):
+        """ Override for actions that benefit from processing output items together """
+        for output_item in output_items:
+            self.process(output_item)
+
+    def close(self):
+        """ Override for actions that need to clean up when processing is complete """
+        return
+
 
 class BlurryFaceFilter(PostProcessAction):  # pylint: disable=too-few-public-methods
     """ Move blurry faces to a different folder
@@ -403,10 +638,11 @@ class FaceFilter(PostProcessAction):
         super().__init__(*args, **kwargs)
         logger.info("Extracting and aligning face for Face Filter...")
         self.filter = self.load_face_filter(**kwargs)
+        self.batch_size = 16
         logger.debug("Initialized %s", self.__class__.__name__)
 
     def load_face_filter(self, filter_lists, ref_threshold, aligner, detector, loglevel,
-                         multiprocess):
+                         multiprocess, cache_dir=None):
         """ Load faces to filter out of images """
         if not any(val for val in filter_lists.values()):
             return None
@@ -422,7 +658,8 @@ class FaceFilter(PostProcessAction):
                                     aligner,
                                     loglevel,
                                     multiprocess,
-                                    ref_threshold)
+                                    ref_threshold,
+                                    cache_dir=cache_dir)
             logger.debug("Face filter: %s", facefilter)
         else:
             self.valid = False
@@ -445,17 +682,34 @@ class FaceFilter(PostProcessAction):
 
     def process(self, output_item):
         """ Filter in/out wanted/unwanted faces """
+        self.process_batch([output_item])
+
+    def process_batch(self, output_items):
+        """ Filter in/out wanted/unwanted faces from a list of output items, checking the faces
+            from all of the items together """
         if not self.filter:
             return
-        ret_faces = list()
-        for idx, detect_face in enumerate(output_item["detected_faces"]):
-            check_item = detect_face["face"] if isinstance(detect_face, dict) else detect_face
-            check_item.load_aligned(output_item["image"])
-            if not self.filter.check(check_item):
-                logger.verbose("Skipping not recognized face: (Frame: %s Face %s)",
-                               output_item["filename"], idx)
-                continue
-            logger.trace("Accepting recognised face. Frame: %s. Face: %s",
-                         output_item["filename"], idx)
-            ret_faces.append(detect_face)
-        output_item["detected_faces"] = ret_faces
+        check_items = list()
+        for output_item in output_items:
+            for detect_face in output_item["detected_faces"]:
+                check_item = detect_face["face"] if isinstance(detect_face, dict) else detect_face
+                check_item.load_aligned(output_item["image"])
+                check_items.append(check_item)
+        accepted = iter(self.filter.check_batch(check_items))
+
+        for output_item in output_items:
+            ret_faces = list()
+            for idx, detect_face in enumerate(output_item["detected_faces"]):
+                if not next(accepted):
+                    logger.verbose("Skipping not recognized face: (Frame: %s Face %s)",
+                                   output_item["filename"], idx)
+                    continue
+                logger.trace("Accepting recognised face. Frame: %s. Face: %s",
+                             output_item["filename"], idx)
+                ret_faces.append(detect_face)
+            output_item["detected_faces"] = ret_faces
+
+    def close(self):
+        """ Save the face filter's encodings cache """
+        if self.filter:
+            self.filter.save_cache()
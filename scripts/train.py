@@ -224,6 +224,7 @@ class Train():
                 break
             if save_iteration:
                 logger.trace("Save Iteration: (iteration: %s", iteration)
+                trainer.log_face_cache()
                 if self.args.pingpong:
                     model.save_models()
                     trainer.pingpong.switch()
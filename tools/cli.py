@@ -62,7 +62,9 @@ class AlignmentsArgs(FaceSwapArgs):
                     "\nL|'no-faces': Identify frames that exist within the alignment file but no "
                     "faces were detected." + output_opts + frames_dir +
                     "\nL|'reformat': Save a copy of alignments file in a different format. "
-                    "Specify a format with the -fmt option. Alignments can be converted from "
+                    "Specify a format with the -fmt option. Use '-fmt binary' to convert to the "
+                    "compact binary format, or any other format to convert from it. "
+                    "Alignments can be converted from "
                     "DeepFaceLab by specifing: '-a dfl -fc <source faces folder>'"
                     "\nL|'remove-faces': Remove deleted faces from an alignments file. The "
                     "original alignments file will be backed up. A different file format for the "
@@ -109,7 +111,7 @@ class AlignmentsArgs(FaceSwapArgs):
                                       "that faces were extracted from."})
         argument_list.append({"opts": ("-fmt", "--alignment_format"),
                               "type": str,
-                              "choices": ("json", "pickle", "yaml"),
+                              "choices": ("json", "pickle", "yaml", "binary"),
                               "group": "data",
                               "help": "The file format to save the alignment "
                                       "data in. Defaults to same as source."})
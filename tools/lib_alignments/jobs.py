@@ -139,7 +139,7 @@ class Check():
     def get_missing_alignments(self):
         """ yield each frame that does not exist in alignments file """
         self.output_message = "Frames missing from alignments file"
-        exclude_filetypes = set(["yaml", "yml", "p", "json", "txt"])
+        exclude_filetypes = set(["yaml", "yml", "p", "json", "fsa", "journal", "txt"])
         for frame in tqdm(self.items, desc=self.output_message):
             frame_name = frame["frame_fullname"]
             if (frame["frame_extension"] not in exclude_filetypes
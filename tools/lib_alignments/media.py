@@ -7,13 +7,12 @@ import os
 from tqdm import tqdm
 
 import cv2
-# TODO imageio single frame seek seems slow. Look into this
-# import imageio
 
 from lib.alignments import Alignments
 from lib.faces_detect import DetectedFace
-from lib.utils import (_image_extensions, _video_extensions, count_frames_and_secs, cv2_read_img,
-                       hash_image_file, hash_encode_image)
+from lib.utils import (_image_extensions, _video_extensions, cv2_read_img, hash_image_file,
+                       hash_encode_image)
+from lib.video import VideoReader
 
 logger = logging.getLogger(__name__)  # pylint: disable=invalid-name
 
@@ -60,7 +59,8 @@ class AlignmentData(Alignments):
         extensions = {".json": "json",
                       ".p": "pickle",
                       ".yml": "yaml",
-                      ".yaml": "yaml"}
+                      ".yaml": "yaml",
+                      ".fsa": "binary"}
         dst_fmt = None
         file_ext = os.path.splitext(self.file)[1].lower()
         logger.debug("File extension: '%s'", file_ext)
@@ -112,14 +112,14 @@ class MediaLoader():
         if self._count is not None:
             return self._count
         if self.is_video:
-            self._count = int(count_frames_and_secs(self.folder)[0])
+            self._count = self.vid_reader.count
         else:
             self._count = len(self.file_list_sorted)
         return self._count
 
     def check_input_folder(self):
         """ makes sure that the frames or faces folder exists
-            If frames folder contains a video file return imageio reader object """
+            If frames folder contains a video file return an indexed video reader """
         err = None
         loadtype = self.__class__.__name__
         if not self.folder:
@@ -135,9 +135,7 @@ class MediaLoader():
                 os.path.isfile(self.folder) and
                 os.path.splitext(self.folder)[1] in _video_extensions):
             logger.verbose("Video exists at: '%s'", self.folder)
-            retval = cv2.VideoCapture(self.folder)  # pylint: disable=no-member
-            # TODO ImageIO single frame seek seems slow. Look into this
-            # retval = imageio.get_reader(self.folder)
+            retval = VideoReader(self.folder)
         else:
             logger.verbose("Folder exists at '%s'", self.folder)
             retval = None
@@ -181,12 +179,7 @@ class MediaLoader():
         frame = os.path.splitext(filename)[0]
         logger.trace("Loading video frame: '%s'", frame)
         frame_no = int(frame[frame.rfind("_") + 1:]) - 1
-        self.vid_reader.set(cv2.CAP_PROP_POS_FRAMES, frame_no)  # pylint: disable=no-member
-        _, image = self.vid_reader.read()
-        # TODO imageio single frame seek seems slow. Look into this
-        # self.vid_reader.set_image_index(frame_no)
-        # image = self.vid_reader.get_next_data()[:, :, ::-1]
-        return image
+        return self.vid_reader.get_frame(frame_no)
 
     @staticmethod
     def save_image(output_folder, filename, image):
@@ -6,17 +6,22 @@ import logging
 import os
 import sys
 import operator
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from hashlib import sha1
 from shutil import copyfile
 
 import numpy as np
 import cv2
+from scipy.spatial import cKDTree  # pylint:disable=no-name-in-module
 from tqdm import tqdm
 
 # faceswap imports
 from lib.cli import FullHelpArgumentParser
 from lib import Serializer
+from lib.embeddings import EmbeddingCache
 from lib.faces_detect import DetectedFace
-from lib.multithreading import SpawnProcess
+from lib.multithreading import MultiThread, SpawnProcess, total_cpus
 from lib.queue_manager import queue_manager, QueueEmpty
 from lib.utils import cv2_read_img
 from lib.vgg_face2_keras import VGGFace2 as VGGFace
@@ -35,6 +40,7 @@ class Sort():
         self.changes = None
         self.serializer = None
         self.vgg_face = None
+        self.feature_cache = None
 
     def process(self):
         """ Main processing function of the sort tool """
@@ -56,10 +62,6 @@ class Sort():
             elif method == 'hist':
                 self.args.min_threshold = 0.3
 
-        # Load VGG Face if sorting by face
-        if self.args.sort_method.lower() == "face":
-            self.vgg_face = VGGFace(backend=self.args.backend, loglevel=self.args.loglevel)
-
         # If logging is enabled, prepare container
         if self.args.log_changes:
             self.changes = dict()
@@ -72,6 +74,8 @@ class Sort():
             # Set serializer based on logfile extension
             serializer_ext = os.path.splitext(
                 self.args.log_file_path)[-1]
+            if serializer_ext == ".fsa":  # Binary format only holds alignments
+                serializer_ext = ".json"
             self.serializer = Serializer.get_serializer_from_ext(
                 serializer_ext)
 
@@ -88,7 +92,7 @@ class Sort():
     def launch_aligner(self):
         """ Load the aligner plugin to retrieve landmarks """
         out_queue = queue_manager.get_queue("out")
-        kwargs = {"in_queue": queue_manager.get_queue("in"),
+        kwargs = {"in_queue": queue_manager.get_queue("in", maxsize=32),
                   "out_queue": out_queue}
 
         for plugin in ("fan", "cv2_dnn"):
@@ -122,22 +126,98 @@ class Sort():
             logger.error("Error initializing FAN. Trying CV2-DNN")
 
     @staticmethod
-    def alignment_dict(image):
+    def alignment_dict(filename, image):
         """ Set the image to a dict for alignment """
         height, width = image.shape[:2]
         face = DetectedFace(x=0, w=width, y=0, h=height)
         face = face.to_bounding_box_dict()
-        return {"image": image,
+        return {"filename": filename,
+                "image": image,
                 "detected_faces": [face]}
 
     @staticmethod
-    def get_landmarks(filename):
-        """ Extract the face from a frame (If not alignments file found) """
-        image = cv2_read_img(filename, raise_error=True)
-        queue_manager.get_queue("in").put(Sort.alignment_dict(image))
-        face = queue_manager.get_queue("out").get()
-        landmarks = face["landmarks"][0]
-        return landmarks
+    def feed_aligner(filenames):
+        """ Load images and queue them for the aligner. Runs in a background thread so that
+            images are loaded while the aligner works and it can align them in batches """
+        in_queue = queue_manager.get_queue("in")
+        for filename in filenames:
+            image = cv2_read_img(filename, raise_error=True)
+            in_queue.put(Sort.alignment_dict(filename, image))
+        in_queue.put("EOF")
+
+    def get_features(self, feature):
+        """ Return a list of [filename, value] of the requested feature for each image in the
+            input folder. feature is one of "blur", "hist" or "landmarks".
+
+            Features are held in a cache in the input folder, so only images that are new or
+            have changed since they were last sorted have their features calculated """
+        filenames = self.find_images(self.args.input_dir)
+        if self.feature_cache is None:
+            self.feature_cache = FeatureCache(self.args.input_dir)
+        cache = self.feature_cache
+        hashes = cache.hashes(filenames)
+        if feature == "landmarks":
+            self.add_landmarks(cache, filenames, hashes)
+        else:
+            self.add_image_features(cache, filenames, hashes)
+        cache.save()
+        return [[filename, cache.get(file_hash, feature)]
+                for filename, file_hash in zip(filenames, hashes)]
+
+    @staticmethod
+    def add_image_features(cache, filenames, hashes, chunksize=16):
+        """ Calculate the blur and histogram of images missing from the cache in a process
+            pool and add them to the cache """
+        missing = cache.missing(filenames, hashes, "blur")
+        if not missing:
+            return
+        processes = min(total_cpus(), len(missing) // chunksize)
+        logger.debug("Calculating image features: (images: %s, processes: %s)",
+                     len(missing), processes)
+        executor = ProcessPoolExecutor(max_workers=processes) if processes > 1 else None
+        try:
+            results = (map(image_features, missing.values()) if executor is None
+                       else executor.map(image_features, missing.values(), chunksize=chunksize))
+            for file_hash, features in zip(missing,
+                                           tqdm(results,
+                                                total=len(missing),
+                                                desc="Loading",
+                                                file=sys.stdout)):
+                cache.add(file_hash, **features)
+        finally:
+            if executor is not None:
+                executor.shutdown()
+
+    def add_landmarks(self, cache, filenames, hashes):
+        """ Get the landmarks of images missing from the cache from the aligner and add them to
+            the cache """
+        missing = cache.missing(filenames, hashes, "landmarks")
+        if not missing:
+            return
+        self.launch_aligner()
+        feeder = MultiThread(self.feed_aligner, list(missing.values()))
+        feeder.start()
+        file_hashes = {filename: file_hash for file_hash, filename in missing.items()}
+        out_queue = queue_manager.get_queue("out")
+        for _ in tqdm(range(len(missing)), desc="Loading", file=sys.stdout):
+            face = self.get_aligned(out_queue, feeder)
+            if isinstance(face, dict) and face.get("exception"):
+                raise ValueError("Error in aligner process {}. {}".format(
+                    face["exception"][0], face["exception"][1].getvalue()))
+            landmarks = face["landmarks"][0] if face["landmarks"] else None
+            cache.add(file_hashes[face["filename"]],
+                      landmarks=np.array(landmarks) if landmarks else np.zeros((68, 2)))
+        feeder.join()
+        out_queue.get()  # The aligner's EOF
+
+    @staticmethod
+    def get_aligned(out_queue, feeder):
+        """ Return the next item from the aligner, raising any error from the feeder thread """
+        while True:
+            try:
+                return out_queue.get(True, 1)
+            except QueueEmpty:
+                feeder.check_and_raise_error()
 
     def sort_process(self):
         """
@@ -165,14 +245,8 @@ class Sort():
     # Methods for sorting
     def sort_blur(self):
         """ Sort by blur amount """
-        input_dir = self.args.input_dir
-
         logger.info("Sorting by blur...")
-        img_list = [[img, self.estimate_blur(img)]
-                    for img in
-                    tqdm(self.find_images(input_dir),
-                         desc="Loading",
-                         file=sys.stdout)]
+        img_list = self.get_features("blur")
         logger.info("Sorting...")
 
         img_list = sorted(img_list, key=operator.itemgetter(1), reverse=True)
@@ -186,78 +260,66 @@ class Sort():
         logger.info("Sorting by face similarity...")
 
         images = np.array(self.find_images(input_dir))
-        preds = np.array([self.vgg_face.predict(cv2_read_img(img, raise_error=True))
-                          for img in tqdm(images, desc="loading", file=sys.stdout)])
+        preds = self.get_face_embeddings(images, EmbeddingCache(input_dir, "vggface2"))
         logger.info("Sorting. Depending on ths size of your dataset, this may take a few "
                     "minutes...")
-        indices = self.vgg_face.sorted_similarity(preds, method="ward")
+        indices = VGGFace.sorted_similarity(preds, method="ward")
         img_list = images[indices]
         return img_list
 
+    def get_face_embeddings(self, images, cache, batch_size=32):
+        """ Return the VGG Face embeddings for a list of image files as a stacked array.
+
+            Embeddings are looked up in the cache by face hash. Faces without a cached
+            embedding are run through the model in batches and added to the cache, which is
+            saved at the end """
+        hashes = list()
+        batch = dict()
+        for img in tqdm(images, desc="loading", file=sys.stdout):
+            face = cv2_read_img(img, raise_error=True)
+            face_hash = sha1(face).hexdigest()
+            hashes.append(face_hash)
+            if face_hash in cache or face_hash in batch:
+                continue
+            batch[face_hash] = face
+            if len(batch) == batch_size:
+                self.add_face_embeddings(batch, cache)
+                batch = dict()
+        if batch:
+            self.add_face_embeddings(batch, cache)
+        cache.save()
+        return np.array([cache.get(face_hash) for face_hash in hashes])
+
+    def add_face_embeddings(self, batch, cache):
+        """ Predict the embeddings for a batch of {hash: face} and add them to the cache.
+            VGG Face is loaded on first use, so it is not loaded if every face is cached """
+        if self.vgg_face is None:
+            self.vgg_face = VGGFace(backend=self.args.backend, loglevel=self.args.loglevel)
+        preds = self.vgg_face.predict_batch(list(batch.values()))
+        for face_hash, pred in zip(batch, preds):
+            cache.add(face_hash, pred)
+
     def sort_face_cnn(self):
         """ Sort by CNN similarity """
-        self.launch_aligner()
-        input_dir = self.args.input_dir
-
         logger.info("Sorting by face-cnn similarity...")
-        img_list = []
-        for img in tqdm(self.find_images(input_dir),
-                        desc="Loading",
-                        file=sys.stdout):
-            landmarks = self.get_landmarks(img)
-            img_list.append([img, np.array(landmarks)
-                             if landmarks
-                             else np.zeros((68, 2))])
-
-        queue_manager.terminate_queues()
-        img_list_len = len(img_list)
-        for i in tqdm(range(0, img_list_len - 1),
-                      desc="Sorting",
-                      file=sys.stdout):
-            min_score = float("inf")
-            j_min_score = i + 1
-            for j in range(i + 1, len(img_list)):
-                fl1 = img_list[i][1]
-                fl2 = img_list[j][1]
-                score = np.sum(np.absolute((fl2 - fl1).flatten()))
-
-                if score < min_score:
-                    min_score = score
-                    j_min_score = j
-            (img_list[i + 1],
-             img_list[j_min_score]) = (img_list[j_min_score],
-                                       img_list[i + 1])
+        img_list = self.get_features("landmarks")
+
+        landmarks = self.stack_landmarks(img_list)
+        order = self.sort_nearest_chain(landmarks,
+                                        "cityblock",
+                                        self.score_faces_cnn(landmarks))
+        img_list = [img_list[idx] for idx in order]
         return img_list
 
     def sort_face_cnn_dissim(self):
         """ Sort by CNN dissimilarity """
-        self.launch_aligner()
-        input_dir = self.args.input_dir
-
         logger.info("Sorting by face-cnn dissimilarity...")
 
-        img_list = []
-        for img in tqdm(self.find_images(input_dir),
-                        desc="Loading",
-                        file=sys.stdout):
-            landmarks = self.get_landmarks(img)
-            img_list.append([img, np.array(landmarks)
-                             if landmarks
-                             else np.zeros((68, 2)), 0])
-
-        img_list_len = len(img_list)
-        for i in tqdm(range(0, img_list_len - 1),
-                      desc="Sorting",
-                      file=sys.stdout):
-            score_total = 0
-            for j in range(i + 1, len(img_list)):
-                if i == j:
-                    continue
-                fl1 = img_list[i][1]
-                fl2 = img_list[j][1]
-                score_total += np.sum(np.absolute((fl2 - fl1).flatten()))
+        img_list = [[img, landmarks, 0] for img, landmarks in self.get_features("landmarks")]
 
-            img_list[i][2] = score_total
+        scores = self.sum_distance_to_later(self.stack_landmarks(img_list))
+        for item, score in zip(img_list, scores):
+            item[2] = score
 
         logger.info("Sorting...")
         img_list = sorted(img_list, key=operator.itemgetter(2), reverse=True)
@@ -266,16 +328,8 @@ class Sort():
 
     def sort_face_yaw(self):
         """ Sort by yaw of face """
-        self.launch_aligner()
-        input_dir = self.args.input_dir
-
-        img_list = []
-        for img in tqdm(self.find_images(input_dir),
-                        desc="Loading",
-                        file=sys.stdout):
-            landmarks = self.get_landmarks(img)
-            img_list.append(
-                [img, self.calc_landmarks_face_yaw(np.array(landmarks))])
+        img_list = [[img, self.calc_landmarks_face_yaw(landmarks)]
+                    for img, landmarks in self.get_features("landmarks")]
 
         logger.info("Sorting by face-yaw...")
         img_list = sorted(img_list, key=operator.itemgetter(1), reverse=True)
@@ -284,57 +338,26 @@ class Sort():
 
     def sort_hist(self):
         """ Sort by histogram of face similarity """
-        input_dir = self.args.input_dir
-
         logger.info("Sorting by histogram similarity...")
 
-        img_list = [
-            [img, cv2.calcHist([cv2_read_img(img, raise_error=True)], [0], None, [256], [0, 256])]
-            for img in
-            tqdm(self.find_images(input_dir), desc="Loading", file=sys.stdout)
-        ]
+        img_list = self.get_features("hist")
 
-        img_list_len = len(img_list)
-        for i in tqdm(range(0, img_list_len - 1), desc="Sorting",
-                      file=sys.stdout):
-            min_score = float("inf")
-            j_min_score = i + 1
-            for j in range(i + 1, len(img_list)):
-                score = cv2.compareHist(img_list[i][1],
-                                        img_list[j][1],
-                                        cv2.HISTCMP_BHATTACHARYYA)
-                if score < min_score:
-                    min_score = score
-                    j_min_score = j
-            (img_list[i + 1],
-             img_list[j_min_score]) = (img_list[j_min_score],
-                                       img_list[i + 1])
+        histograms = self.stack_histograms(img_list)
+        order = self.sort_nearest_chain(histograms,
+                                        "cosine",
+                                        self.score_hist(img_list))
+        img_list = [img_list[idx] for idx in order]
         return img_list
 
     def sort_hist_dissim(self):
         """ Sort by histigram of face dissimilarity """
-        input_dir = self.args.input_dir
-
         logger.info("Sorting by histogram dissimilarity...")
 
-        img_list = [
-            [img,
-             cv2.calcHist([cv2_read_img(img, raise_error=True)], [0], None, [256], [0, 256]), 0]
-            for img in
-            tqdm(self.find_images(input_dir), desc="Loading", file=sys.stdout)
-        ]
-
-        img_list_len = len(img_list)
-        for i in tqdm(range(0, img_list_len), desc="Sorting", file=sys.stdout):
-            score_total = 0
-            for j in range(0, img_list_len):
-                if i == j:
-                    continue
-                score_total += cv2.compareHist(img_list[i][1],
-                                               img_list[j][1],
-                                               cv2.HISTCMP_BHATTACHARYYA)
+        img_list = [[img, hist, 0] for img, hist in self.get_features("hist")]
 
-            img_list[i][2] = score_total
+        scores = self.sum_hist_distance(img_list)
+        for item, score in zip(img_list, scores):
+            item[2] = score
 
         logger.info("Sorting...")
         img_list = sorted(img_list, key=operator.itemgetter(2), reverse=True)
@@ -570,43 +593,16 @@ class Sort():
         :return: img_list but with the comparative values that the chosen
         grouping method expects.
         """
-        input_dir = self.args.input_dir
         logger.info("Preparing to group...")
         if group_method == 'group_blur':
-            temp_list = [[img, self.estimate_blur(cv2_read_img(img, raise_error=True))]
-                         for img in
-                         tqdm(self.find_images(input_dir),
-                              desc="Reloading",
-                              file=sys.stdout)]
+            temp_list = self.get_features("blur")
         elif group_method == 'group_face_cnn':
-            self.launch_aligner()
-            temp_list = []
-            for img in tqdm(self.find_images(input_dir),
-                            desc="Reloading",
-                            file=sys.stdout):
-                landmarks = self.get_landmarks(img)
-                temp_list.append([img, np.array(landmarks)
-                                  if landmarks
-                                  else np.zeros((68, 2))])
+            temp_list = self.get_features("landmarks")
         elif group_method == 'group_face_yaw':
-            self.launch_aligner()
-            temp_list = []
-            for img in tqdm(self.find_images(input_dir),
-                            desc="Reloading",
-                            file=sys.stdout):
-                landmarks = self.get_landmarks(img)
-                temp_list.append(
-                    [img,
-                     self.calc_landmarks_face_yaw(np.array(landmarks))])
+            temp_list = [[img, self.calc_landmarks_face_yaw(landmarks)]
+                         for img, landmarks in self.get_features("landmarks")]
         elif group_method == 'group_hist':
-            temp_list = [
-                [img,
-                 cv2.calcHist([cv2_read_img(img, raise_error=True)], [0], None, [256], [0, 256])]
-                for img in
-                tqdm(self.find_images(input_dir),
-                     desc="Reloading",
-                     file=sys.stdout)
-            ]
+            temp_list = self.get_features("hist")
         else:
             raise ValueError("{} group_method not found.".format(group_method))
 
@@ -629,14 +625,13 @@ class Sort():
         but the values corresponding to each image are from new_vals_list.
         """
         new_list = []
-        # Make new list of just image paths to serve as an index
-        val_index_list = [i[0] for i in new_vals_list]
+        # Index the new values by image path
+        new_vals = {i[0]: i[1] for i in new_vals_list}
         for i in tqdm(range(len(sorted_list)),
                       desc="Splicing",
                       file=sys.stdout):
             current_img = sorted_list[i] if isinstance(sorted_list[i], str) else sorted_list[i][0]
-            new_val_index = val_index_list.index(current_img)
-            new_list.append([current_img, new_vals_list[new_val_index][1]])
+            new_list.append([current_img, new_vals[current_img]])
 
         return new_list
 
@@ -657,7 +652,11 @@ class Sort():
         Estimate the amount of blur an image has with the variance of the Laplacian.
         Normalize by pixel number to offset the effect of image size on pixel gradients & variance
         """
-        image = cv2_read_img(image_file, raise_error=True)
+        return Sort.blur_score(cv2_read_img(image_file, raise_error=True))
+
+    @staticmethod
+    def blur_score(image):
+        """ Return the normalized variance of the Laplacian of an image """
         if image.ndim == 3:
             image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
         blur_map = cv2.Laplacian(image, cv2.CV_32F)
@@ -748,6 +747,184 @@ class Sort():
                 return src, dst
         return renaming
 
+    @staticmethod
+    def stack_landmarks(img_list):
+        """ Return the landmarks of each item in img_list as rows of a float64 array """
+        return np.array([np.ravel(item[1]) for item in img_list], dtype="float64")
+
+    @staticmethod
+    def stack_histograms(img_list):
+        """ Return the square root of each item's normalized histogram as rows of a float64
+            array. The Bhattacharyya distance between two histograms is the square root of the
+            cosine distance between their rows """
+        hists = np.array([np.ravel(item[1]) for item in img_list], dtype="float64")
+        if not img_list:
+            return hists
+        return np.sqrt(hists / hists.sum(axis=1, keepdims=True))
+
+    @staticmethod
+    def score_faces_cnn(landmarks):
+        """ Return a function scoring an item's landmarks against a set of other items """
+        def score(idx, others):
+            return np.sum(np.absolute(landmarks[others] - landmarks[idx]), axis=1)
+        return score
+
+    @staticmethod
+    def score_hist(img_list):
+        """ Return a function scoring an item's histogram against a set of other items """
+        def score(idx, others):
+            return np.array([cv2.compareHist(img_list[idx][1],
+                                             img_list[other][1],
+                                             cv2.HISTCMP_BHATTACHARYYA)
+                             for other in others])
+        return score
+
+    @staticmethod
+    def sort_nearest_chain(features, metric, score, tolerance=1e-7):
+        """ Order items so that each item is followed by the remaining item nearest to it.
+
+            metric is "cityblock" to find the nearest features with a KD-Tree, or "cosine" to
+            find them from the dot products of unit length features. Candidates within
+            tolerance of the nearest distance are then scored with score(idx, others). The
+            lowest score wins, with ties going to the candidate earliest in the list. Chosen
+            items are swapped into place, so the result matches the pairwise comparison of each
+            item against every item after it.
+
+            Returns the indices of the items in sorted order """
+        count = len(features)
+        if count < 2:
+            return list(range(count))
+        order = np.arange(count)
+        position = np.arange(count)
+        remaining = np.ones((count, ), dtype="bool")
+        pool = np.arange(count)
+        pool_features = features
+        tree = cKDTree(features) if metric == "cityblock" else None
+        for i in tqdm(range(0, count - 1), desc="Sorting", file=sys.stdout):
+            current = order[i]
+            remaining[current] = False
+            if len(pool) > max(64, 2 * (count - i - 1)):
+                # Drop chained items from the pool once they make up most of it
+                pool = np.flatnonzero(remaining)
+                pool_features = features[pool]
+                tree = cKDTree(pool_features) if tree is not None else None
+
+            if tree is None:
+                distances = 1. - np.dot(pool_features, features[current])
+                valid = remaining[pool]
+                radius = distances[valid].min() + tolerance
+                candidates = pool[valid & (distances <= radius)]
+            else:
+                k = min(16, len(pool))
+                while True:
+                    distances, indices = tree.query(features[current], k=k, p=1)
+                    distances, indices = np.atleast_1d(distances), np.atleast_1d(indices)
+                    valid = remaining[pool[indices]]
+                    if valid.any() or k == len(pool):
+                        break
+                    k = min(k * 2, len(pool))
+                radius = distances[valid][0] * (1 + tolerance) + tolerance
+                candidates = pool[tree.query_ball_point(features[current], radius, p=1)]
+                candidates = candidates[remaining[candidates]]
+
+            scores = score(current, candidates)
+            best = candidates[scores == scores.min()]
+            chosen = best[np.argmin(position[best])]
+
+            swap_pos, swapped = position[chosen], order[i + 1]
+            order[i + 1], order[swap_pos] = chosen, swapped
+            position[chosen], position[swapped] = i + 1, swap_pos
+        return order.tolist()
+
+    @staticmethod
+    def sum_distance_to_later(features):
+        """ Return, for each row of features, the sum of the L1 distances to every row after it.
+
+            Rows are processed from last to first, with each column's values held in a Fenwick
+            tree of counts and sums over the column's sorted values. The distance to the rows
+            already processed is then found from the count and sum of the values either side of
+            the row's value in O(log N) per column """
+        if not len(features):  # pylint:disable=len-as-condition
+            return list()
+        count, dims = features.shape
+        ranks = np.empty((count, dims), dtype="int64")
+        for dim in range(dims):
+            ranks[:, dim] = np.unique(features[:, dim], return_inverse=True)[1].ravel() + 1
+        columns = np.arange(dims)
+        counts = np.zeros((count + 2, dims), dtype="float64")
+        sums = np.zeros((count + 2, dims), dtype="float64")
+        total = np.zeros((dims, ), dtype="float64")
+        retval = np.zeros((count, ), dtype="float64")
+        levels = int(count).bit_length() + 1
+        for i in tqdm(range(count - 1, -1, -1), desc="Sorting", file=sys.stdout):
+            values, rank = features[i], ranks[i]
+            idx = rank.copy()
+            below_count = np.zeros((dims, ), dtype="float64")
+            below_sum = np.zeros((dims, ), dtype="float64")
+            for _ in range(levels):
+                below_count += counts[idx, columns]
+                below_sum += sums[idx, columns]
+                idx -= idx & -idx
+            later = count - 1 - i
+            retval[i] = np.sum(values * below_count - below_sum +
+                               (total - below_sum) - values * (later - below_count))
+            idx = rank.copy()
+            for _ in range(levels):
+                counts[idx, columns] += 1
+                sums[idx, columns] += values
+                idx = np.minimum(idx + (idx & -idx), count + 1)
+            total += values
+        return retval.tolist()
+
+    @staticmethod
+    def sum_hist_distance(img_list, batch_size=256, tolerance=1e-7):
+        """ Return, for each item in img_list, the sum of the Bhattacharyya distances between
+            its histogram and every other item's histogram.
+
+            Distances are calculated in batches of rows from the dot products of the square
+            rooted histograms. Identical histograms share a sum, so they keep their order in
+            img_list. Other items whose sums are within tolerance of another item's are summed
+            again with cv2, so that they are ordered as cv2 orders them """
+        count = len(img_list)
+        if not count:
+            return list()
+        hists = np.array([np.ravel(item[1]) for item in img_list], dtype="float64")
+        roots = np.sqrt(hists)
+        norms = hists.sum(axis=1)
+        retval = np.zeros((count, ), dtype="float64")
+        for start in tqdm(range(0, count, batch_size), desc="Sorting", file=sys.stdout):
+            end = min(start + batch_size, count)
+            scale = np.outer(norms[start:end], norms)
+            scale = np.where(np.abs(scale) > np.finfo("float32").eps,
+                             1. / np.sqrt(np.abs(scale)),
+                             1.)
+            distances = np.sqrt(np.maximum(1. - np.dot(roots[start:end], roots.T) * scale, 0.))
+            distances[np.arange(end - start), np.arange(start, end)] = 0.
+            retval[start:end] = distances.sum(axis=1)
+
+        # Identical histograms are given identical scores, so keep their input order
+        _, first_index, groups = np.unique(hists, axis=0, return_index=True, return_inverse=True)
+        groups = groups.ravel()
+        retval = retval[first_index][groups]
+        ordered = np.argsort(retval)
+        close = np.flatnonzero(np.diff(retval[ordered]) <=
+                               tolerance * np.abs(retval[ordered][1:]) + tolerance)
+        first, second = groups[ordered[close]], groups[ordered[close + 1]]
+        distinct = first != second
+        recheck = np.unique(np.concatenate((first[distinct], second[distinct])))
+        logger.debug("Rechecking %s close histogram scores", len(recheck))
+        for group in recheck:
+            members = np.flatnonzero(groups == group)
+            score_total = 0
+            for j in range(0, count):
+                if j == members[0]:
+                    continue
+                score_total += cv2.compareHist(img_list[members[0]][1],
+                                               img_list[j][1],
+                                               cv2.HISTCMP_BHATTACHARYYA)
+            retval[members] = score_total
+        return retval.tolist()
+
     @staticmethod
     def get_avg_score_hist(img1, references):
         """ Return the average histogram score between a face and
@@ -769,6 +946,118 @@ class Sort():
         return sum(scores) / len(scores)
 
 
+class FeatureCache():
+    """ Per image features for the sort tool, held in a sidecar file in the input folder.
+
+        Features are keyed by the sha1 hash of each image file, so they are found again if
+        files are renamed or moved within the folder. The size and modification time of each
+        file are stored with its hash, so unchanged files are not read to be hashed again """
+    version = 1
+
+    def __init__(self, folder):
+        logger.debug("Initializing %s: (folder: '%s')", self.__class__.__name__, folder)
+        self.folder = folder
+        self.filename = os.path.join(folder, ".sort_features.p")
+        self.serializer = Serializer.get_serializer("pickle")
+        self.files = dict()
+        self.features = dict()
+        self.changed = False
+        self.load()
+        logger.debug("Initialized %s", self.__class__.__name__)
+
+    def load(self):
+        """ Load the cache from the input folder if it exists """
+        if not os.path.exists(self.filename):
+            logger.debug("No sort features cache found at '%s'", self.filename)
+            return
+        try:
+            with open(self.filename, self.serializer.roptions) as in_file:
+                data = self.serializer.unmarshal(in_file.read())
+        except Exception as err:  # pylint: disable=broad-except
+            logger.warning("Unable to load sort features cache '%s'. It will be rebuilt: %s",
+                           self.filename, str(err))
+            return
+        if not isinstance(data, dict) or data.get("version") != self.version:
+            logger.debug("Discarding sort features cache of a different version")
+            return
+        self.files = data["files"]
+        self.features = data["features"]
+        logger.verbose("Loaded cached sort features for %s images", len(self.features))
+
+    def save(self):
+        """ Save the cache to the input folder if it has changed. Features of images that are
+            no longer in the folder are dropped """
+        if not self.changed:
+            return
+        in_use = set(stats[2] for stats in self.files.values())
+        self.features = {file_hash: features for file_hash, features in self.features.items()
+                         if file_hash in in_use}
+        logger.debug("Saving sort features for %s images to '%s'",
+                     len(self.features), self.filename)
+        tmp_file = self.filename + ".tmp"
+        with open(tmp_file, self.serializer.woptions) as out_file:
+            out_file.write(self.serializer.marshal({"version": self.version,
+                                                    "files": self.files,
+                                                    "features": self.features}))
+        os.replace(tmp_file, self.filename)
+        self.changed = False
+
+    @staticmethod
+    def hash_file(filename):
+        """ Return the sha1 hash of a file's contents """
+        with open(filename, "rb") as in_file:
+            return sha1(in_file.read()).hexdigest()
+
+    def hashes(self, filenames):
+        """ Return the hash of each of the given files, which should be every image in the
+            folder. Files that are new or have changed since they were last hashed are read and
+            hashed in a thread pool """
+        keys = [os.path.relpath(filename, self.folder) for filename in filenames]
+        stats = list()
+        for filename in filenames:
+            stat = os.stat(filename)
+            stats.append((stat.st_size, stat.st_mtime_ns))
+        stale = [idx for idx, (key, stat) in enumerate(zip(keys, stats))
+                 if self.files.get(key, (None, None))[:2] != stat]
+        if stale or len(self.files) != len(keys):
+            self.changed = True
+        files = {key: self.files[key] for key in keys if key in self.files}
+        if stale:
+            logger.debug("Hashing %s new or changed images", len(stale))
+            with ThreadPoolExecutor(max_workers=min(8, total_cpus())) as executor:
+                file_hashes = executor.map(self.hash_file, [filenames[idx] for idx in stale])
+                for idx, file_hash in zip(stale, file_hashes):
+                    files[keys[idx]] = stats[idx] + (file_hash, )
+        self.files = files
+        return [self.files[key][2] for key in keys]
+
+    def missing(self, filenames, hashes, feature):
+        """ Return an ordered dict of hash to filename for the files that do not have the
+            given feature in the cache """
+        retval = OrderedDict()
+        for filename, file_hash in zip(filenames, hashes):
+            if feature not in self.features.get(file_hash, dict()):
+                retval.setdefault(file_hash, filename)
+        return retval
+
+    def add(self, file_hash, **features):
+        """ Add features for the given file hash """
+        self.features.setdefault(file_hash, dict()).update(features)
+        self.changed = True
+
+    def get(self, file_hash, feature):
+        """ Return the requested feature for the given file hash """
+        return self.features[file_hash][feature]
+
+
+def image_features(filename):
+    """ Return the blur score and histogram of an image file. Module level so that it can be
+        run in a process pool """
+    image = cv2_read_img(filename, raise_error=True)
+    return {"blur": Sort.blur_score(image),
+            "hist": cv2.calcHist([image], [0], None, [256], [0, 256])}
+
+
 def bad_args(args):  # pylint: disable=unused-argument
     """ Print help on bad arguments """
     PARSER.print_help()